@@ -1,12 +1,34 @@
 # -*- encoding: utf-8 -*-
+import concurrent.futures
+import hashlib
 import json
+import os
 import socket
+import tempfile
+import threading
 import time
 
 import logging
 
+import salt.utils.data
+import salt.utils.yaml
+
 log = logging.getLogger(__name__)
 
+# SSH connections to the same host share a single ControlMaster connection,
+# whose socket is kept in this directory
+SSH_CONTROL_DIR = '/run/ceph-salt-ssh'
+# seconds a ControlMaster connection is kept open after its last use
+SSH_CONTROL_PERSIST = 600
+# remote grains are cached in this directory, and shared by all jobs of this minion
+REMOTE_GRAINS_CACHE_DIR = '/run/ceph-salt-grains'
+# seconds a cached copy of the remote grains is used
+REMOTE_GRAINS_TTL = 5
+# seconds a single DNS lookup may take before the hostname is considered unresolvable
+DNS_LOOKUP_TIMEOUT = 5
+# maximum number of concurrent DNS lookups
+DNS_LOOKUP_WORKERS = 16
+
 
 def _send_event(tag, data):
     __salt__['event.send'](tag, data=data)
@@ -34,16 +56,81 @@ def end_step(name):
     return _send_event('ceph-salt/step/end', data={'desc': name})
 
 
+def _cephadm_home():
+    if 'ceph_salt.cephadm_home' not in __context__:
+        __context__['ceph_salt.cephadm_home'] = __salt__['user.info']('cephadm')['home']
+    return __context__['ceph_salt.cephadm_home']
+
+
+def _ssh_stats():
+    return __context__.setdefault('ceph_salt.ssh_stats', {'handshakes': 0, 'reused': 0})
+
+
+def _ssh_control_path(host):
+    # hashed, because UNIX socket paths are limited to 108 characters
+    digest = hashlib.sha1('cephadm@{}'.format(host).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(SSH_CONTROL_DIR, digest)
+
+
+def _ssh_options(host):
+    """
+    Returns the SSH options used to connect to `host`, reusing the ControlMaster
+    connection to `host` if there is one.
+    """
+    options = ("-o StrictHostKeyChecking=no "
+               "-o UserKnownHostsFile=/dev/null "
+               "-o ConnectTimeout=30 "
+               "-i {}/.ssh/id_rsa".format(_cephadm_home()))
+    try:
+        os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+    except OSError as exc:
+        log.warning("ceph_salt.ssh: unable to create '%s', SSH connections will not be "
+                    "reused: %s", SSH_CONTROL_DIR, exc)
+        return options
+    control_path = _ssh_control_path(host)
+    stats = _ssh_stats()
+    if os.path.exists(control_path):
+        stats['reused'] += 1
+    else:
+        stats['handshakes'] += 1
+    return ("{} -o ControlMaster=auto -o ControlPath={} "
+            "-o ControlPersist={}".format(options, control_path, SSH_CONTROL_PERSIST))
+
+
+def ssh_stats():
+    """
+    Returns the number of SSH connections that were established and the number
+    of SSH commands that reused an existing connection, in the current job.
+    """
+    return dict(_ssh_stats())
+
+
+def ssh_close_all():
+    """
+    Closes all ControlMaster connections. Returns the number of closed connections.
+    """
+    closed = 0
+    if not os.path.isdir(SSH_CONTROL_DIR):
+        return closed
+    for socket_name in os.listdir(SSH_CONTROL_DIR):
+        control_path = os.path.join(SSH_CONTROL_DIR, socket_name)
+        ret = __salt__['cmd.run_all']("ssh -o ControlPath={} -O exit "
+                                      "cephadm@localhost".format(control_path))
+        if ret['retcode'] == 0:
+            closed += 1
+        else:
+            log.warning("ceph_salt.ssh_close_all: unable to close '%s': %s",
+                        control_path, ret.get('stderr'))
+    log.info("ceph_salt.ssh_close_all: closed %s connections, stats: %s",
+             closed, _ssh_stats())
+    return closed
+
+
 def ssh(host, cmd, attempts=1):
     assert attempts > 0
     attempts_count = 0
     retry = True
-    cephadm_home = __salt__['user.info']('cephadm')['home']
-    full_cmd = ("ssh -o StrictHostKeyChecking=no "
-                "-o UserKnownHostsFile=/dev/null "
-                "-o ConnectTimeout=30 "
-                "-i {}/.ssh/id_rsa "
-                "cephadm@{} \"{}\"".format(cephadm_home, host, cmd))
+    full_cmd = "ssh {} cephadm@{} \"{}\"".format(_ssh_options(host), host, cmd)
     log.info("ceph_salt.ssh: running SSH command {}".format(full_cmd))
     while retry:
         ret = __salt__['cmd.run_all'](full_cmd)
@@ -63,34 +150,75 @@ def ssh(host, cmd, attempts=1):
 
 def sudo_rsync(src, dest, ignore_existing):
     ignore_existing_option = '--ignore-existing ' if ignore_existing else ''
-    cephadm_home = __salt__['user.info']('cephadm')['home']
+    # either 'src' or 'dest' is remote, e.g. 'cephadm@node1:/etc/ceph/'
+    remote = src if ':' in src else dest
+    host = remote.split(':', 1)[0].split('@')[-1]
     return __salt__['cmd.run_all']("sudo rsync --rsync-path='sudo rsync' "
-                                   "-e 'ssh -o StrictHostKeyChecking=no "
-                                   "-o UserKnownHostsFile=/dev/null "
-                                   "-o ConnectTimeout=30 "
-                                   "-i {}/.ssh/id_rsa' "
-                                   "{}{} {} ".format(cephadm_home, ignore_existing_option, src, dest))
+                                   "-e 'ssh {}' "
+                                   "{}{} {} ".format(_ssh_options(host),
+                                                     ignore_existing_option, src, dest))
+
+
+def _remote_grains_cache_path(host):
+    digest = hashlib.sha1(host.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(REMOTE_GRAINS_CACHE_DIR, '{}.json'.format(digest))
+
+
+def _load_cached_remote_grains(host, ttl):
+    cache_path = _remote_grains_cache_path(host)
+    try:
+        if time.time() - os.path.getmtime(cache_path) > ttl:
+            return None
+        with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_cached_remote_grains(host, grains):
+    try:
+        content = json.dumps(grains)
+        os.makedirs(REMOTE_GRAINS_CACHE_DIR, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=REMOTE_GRAINS_CACHE_DIR)
+        with os.fdopen(fd, 'w') as cache_file:
+            cache_file.write(content)
+        os.rename(tmp_path, _remote_grains_cache_path(host))
+    except (OSError, TypeError, ValueError) as exc:
+        log.warning("ceph_salt.get_remote_grains: unable to cache grains of '%s': %s",
+                    host, exc)
+
+
+def get_remote_grains(host, grains, ttl=REMOTE_GRAINS_TTL):
+    """
+    Reads several remote host grains at once, by reading '/etc/salt/grains' file directly.
+    The remote grains are cached for `ttl` seconds, so that all waiters on this minion
+    share a single SSH call.
+
+    Returns a dict with the value of each grain, or None if the remote grains couldn't be read.
+    """
+    remote_grains = _load_cached_remote_grains(host, ttl)
+    if remote_grains is None:
+        ret = __salt__['ceph_salt.ssh'](host, "sudo cat /etc/salt/grains")
+        if ret['retcode'] != 0:
+            return None
+        try:
+            remote_grains = salt.utils.yaml.safe_load(ret['stdout']) or {}
+        except salt.utils.yaml.YAMLError as exc:
+            log.error("ceph_salt.get_remote_grains: invalid grains file on '%s': %s", host, exc)
+            return None
+        _save_cached_remote_grains(host, remote_grains)
+    return {grain: salt.utils.data.traverse_dict_and_list(remote_grains, grain)
+            for grain in grains}
 
 
 def get_remote_grain(host, grain):
     """
     Reads remote host grain by accessing '/etc/salt/grains' file directly.
     """
-    python_script = '''
-import json
-import salt.utils.data
-import yaml
-with open('/etc/salt/grains') as grains_file:
-    grains = yaml.full_load(grains_file)
-val = salt.utils.data.traverse_dict_and_list(grains, '{}')
-print(json.dumps({{'local': val}}))
-'''.format(grain)
-    ret = __salt__['ceph_salt.ssh'](
-                   host,
-                   "sudo python3 - <<EOF\n{}\nEOF".format(python_script))
-    if ret['retcode'] != 0:
+    remote_grains = get_remote_grains(host, [grain])
+    if remote_grains is None:
         return None
-    return json.loads(ret['stdout'])['local']
+    return remote_grains[grain]
 
 
 def probe_ntp(ahost):
@@ -115,25 +243,73 @@ def is_safety_disengaged():
     return False
 
 
-def probe_dns(*hostnames):
+def probe_dns(*hostnames, timeout=DNS_LOOKUP_TIMEOUT, workers=DNS_LOOKUP_WORKERS):
     """
     given a list of hostnames, verify that all can be resolved to IP addresses
+
+    Hostnames are resolved concurrently, and a lookup that takes longer than
+    'timeout' seconds counts as unresolvable. Returns a dict with:
+    'ok' - True if all hostnames were resolved
+    'unresolvable' - sorted list of hostnames that could not be resolved
+    'latencies' - lookup time, in seconds, of each resolved hostname
     """
-    ret_status = True
-    for hostname in hostnames:
-        log_msg = "probe_dns: attempting to resolve minion hostname ->{}<-".format(hostname)
-        log.info(log_msg)
+    hostnames = sorted(set(hostnames))
+    unresolvable = set()
+    latencies = {}
+
+    def _resolve(hostname, future):
+        log.info("probe_dns: attempting to resolve minion hostname ->%s<-", hostname)
+        started = time.time()
         try:
             socket.gethostbyname(hostname)
         except Exception as exc:
-            log.error(exc)
-            ret_status = False
-        if not ret_status:
-            break
-    return ret_status
+            future.set_exception(exc)
+        else:
+            future.set_result(round(time.time() - started, 3))
+
+    # lookups run in daemon threads, because a 'gethostbyname' call cannot be
+    # interrupted, and a lookup that timed out must not keep the job running
+    queued = list(reversed(hostnames))
+    running = {}
+    while queued or running:
+        while queued and len(running) < workers:
+            hostname = queued.pop()
+            future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            running[future] = (hostname, time.time() + timeout)
+            threading.Thread(target=_resolve, args=(hostname, future),
+                             name='probe_dns-{}'.format(hostname), daemon=True).start()
+        deadline = min(deadline for _, deadline in running.values())
+        done, _ = concurrent.futures.wait(list(running), timeout=max(deadline - time.time(), 0),
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            hostname, _ = running.pop(future)
+            try:
+                latencies[hostname] = future.result()
+            except Exception as exc:
+                log.error("probe_dns: cannot resolve '%s': %s", hostname, exc)
+                unresolvable.add(hostname)
+        now = time.time()
+        for future, (hostname, deadline) in list(running.items()):
+            if now >= deadline:
+                # its thread is left behind, and no longer counts as a worker
+                log.error("probe_dns: lookup of '%s' timed out after %ss", hostname, timeout)
+                unresolvable.add(hostname)
+                del running[future]
+    return {
+        'ok': not unresolvable,
+        'unresolvable': sorted(unresolvable),
+        'latencies': latencies,
+    }
 
 
 def probe_time_sync():
+    """
+    Checks if a time sync service is enabled and running. Returns a dict with:
+    'ok' - True if a time sync service is enabled and running
+    'unit' - name of the unit that is enabled and running, or None
+    'units' - enabled/installed/state of each candidate unit
+    """
     units = [
         'chrony.service',  # 18.04 (at least)
         'chronyd.service', # el / opensuse
@@ -141,45 +317,65 @@ def probe_time_sync():
         'ntpd.service', # el7 (at least)
         'ntp.service',  # 18.04 (at least)
     ]
-    if not _check_units(units):
-        log_msg = ('No time sync service is running; checked for: '
+    units_state = _check_units(units)
+    found = None
+    for unit in units:
+        if units_state[unit]['enabled'] and units_state[unit]['state'] == 'running':
+            log.info('Unit %s is enabled and running' % unit)
+            found = unit
+            break
+    if found is None:
+        log_msg = ('No time sync service is running; checked for: {}'
                    .format(', '.join(units)))
         log.warning(log_msg)
-        return False
-    return True
+    return {
+        'ok': found is not None,
+        'unit': found,
+        'units': units_state,
+    }
+
+
+# 'UnitFileState' values for which 'systemctl is-enabled' succeeds
+_UNIT_ENABLED_STATES = ['enabled', 'enabled-runtime', 'static', 'alias', 'indirect',
+                        'generated', 'transient']
 
 
 def _check_units(units):
-    for unit in units:
-        (enabled, installed, state) = __check_unit(unit)
-        if enabled and state == 'running':
-            log.info('Unit %s is enabled and running' % unit)
-            return True
-    return False
+    """
+    Queries the state of all units with a single 'systemctl show' call.
+    Returns a dict with the enabled/installed/state of each unit.
+    """
+    # NOTE: we ignore the exit code here because the properties of units that
+    # do not exist are shown as well
+    cmd_ret = __salt__['cmd.run_all'](
+        "systemctl show --property=UnitFileState,ActiveState,SubState {}"
+        .format(' '.join(units)), python_shell=False)
+    # one block of properties per unit, in the order units were given
+    blocks = cmd_ret.get('stdout', '').strip().split('\n\n')
+    ret = {}
+    for i, unit in enumerate(units):
+        props = {}
+        if i < len(blocks):
+            for line in blocks[i].splitlines():
+                key, _, value = line.partition('=')
+                props[key.strip()] = value.strip()
+        ret[unit] = __unit_state(props)
+    return ret
 
 
-def __check_unit(unit_name):
-    # NOTE: we ignore the exit code here because systemctl outputs
-    # various exit codes based on the state of the service, but the
-    # string result is more explicit (and sufficient).
-    enabled = False
-    installed = False
-    cmd_ret = __salt__['cmd.run_all']("systemctl is-enabled {}".format(unit_name))
-    if cmd_ret['retcode'] == 0:
-        enabled = True
-        installed = True
-    elif cmd_ret['stdout'] and "disabled" in cmd_ret['stdout']:
-        installed = True
+def __unit_state(props):
+    file_state = props.get('UnitFileState', '')
+    enabled = file_state in _UNIT_ENABLED_STATES
+    installed = enabled or file_state == 'disabled'
     state = 'unknown'
-    cmd_ret = __salt__['cmd.run_all']("systemctl is-active {}".format(unit_name))
-    out = cmd_ret.get('stdout', '').strip()
-    if out in ['active']:
+    active_state = props.get('ActiveState', '')
+    if active_state in ['active']:
         state = 'running'
-    elif out in ['inactive']:
-        state = 'stopped'
-    elif out in ['failed', 'auto-restart']:
+    elif props.get('SubState') in ['auto-restart'] or active_state in ['failed']:
         state = 'error'
-    return (enabled, installed, state)
+    elif active_state in ['inactive']:
+        state = 'stopped'
+    return {'enabled': enabled, 'installed': installed, 'state': state}
 
 
 def hostname():
@@ -201,3 +397,27 @@ def probe_fqdn():
     if '.' in retval:
         return 'YES'
     return 'NO'
+
+
+def preflight(state, hostnames):
+    """
+    Runs, in a single job, all the probes needed by the ceph-salt pre-flight checks.
+    Returns a dict with the result of each probe, and the time (in seconds) each
+    probe took in 'timings'.
+    """
+    probes = [
+        ('sls_exists', lambda: __salt__['state.sls_exists'](state)),
+        ('dns', lambda: probe_dns(*hostnames)),
+        ('time_sync', probe_time_sync),
+        ('fqdn', probe_fqdn),
+    ]
+    ret = {'timings': {}}
+    for name, probe in probes:
+        start = time.time()
+        try:
+            ret[name] = probe()
+        except Exception as exc:
+            log.error("preflight: probe '%s' failed: %s", name, exc)
+            ret[name] = None
+        ret['timings'][name] = round(time.time() - start, 3)
+    return ret
@@ -3,9 +3,17 @@ import logging
 import subprocess
 import time
 
+import salt.utils.event
+
 
 logger = logging.getLogger(__name__)
 
+GRAIN_EVENT_TAG = 'ceph-salt/grain/set'
+FAILED_GRAIN = 'ceph-salt:execution:failed'
+# how often remote grains are polled while waiting, in case grain events are not
+# relayed (e.g. the formula was applied without ceph-salt)
+GRAIN_POLL_INTERVAL = 15
+
 
 def _send_event(tag, data):
     __salt__['event.send'](tag, data=data)
@@ -85,27 +93,110 @@ def reboot_if_needed(name):
     return ret
 
 
+def set_grain(name, value=True):
+    """
+    Sets the grain ``name`` and publishes a 'ceph-salt/grain/set' event, so that minions
+    waiting for it (see ``wait_for_grain``) can resume without waiting for the next poll.
+    """
+    ret = {'name': name, 'changes': {}, 'comment': '', 'result': False}
+    set_ret = __salt__['grains.set'](name, value)
+    if not set_ret.get('result'):
+        ret['comment'] = set_ret.get('comment', "Failed to set grain '{}'".format(name))
+        return ret
+    __salt__['event.send'](GRAIN_EVENT_TAG, data={'grain': name, 'value': value})
+    ret['changes'] = {name: value}
+    ret['result'] = True
+    return ret
+
+
+def _listen_grain_events():
+    """
+    Subscribes to this minion's event bus, where ceph-salt relays the grain events of
+    the other minions. Returns None if the event bus is not available.
+    """
+    try:
+        return salt.utils.event.get_event('minion', opts=__opts__, listen=True)
+    except Exception as ex:  # pylint: disable=broad-except
+        logger.warning("Unable to listen to grain events, falling back to polling: %s", ex)
+        return None
+
+
+def _wait_grain_event(event_bus, hosts, wait):
+    """
+    Waits up to ``wait`` seconds for a grain event of one of ``hosts``.
+    Returns the event data, or None if there was no such event.
+    """
+    if event_bus is None:
+        time.sleep(wait)
+        return None
+    timelimit = time.time() + wait
+    while True:
+        remaining = timelimit - time.time()
+        if remaining <= 0:
+            return None
+        data = event_bus.get_event(wait=remaining, tag=GRAIN_EVENT_TAG)
+        if data and data.get('id') in hosts:
+            return data
+
+
+def _wait_for_hosts_grain(grain, hosts, timeout):
+    """
+    Waits until ``grain`` is set on all ``hosts``.
+    Grain events are used to resume as soon as possible, the remote grains are polled
+    every ``GRAIN_POLL_INTERVAL`` seconds in case an event is missed.
+
+    Returns a tuple ``(result, failed_host)``, where ``result`` is None on timeout.
+    """
+    pending = set(hosts)
+    timelimit = time.time() + timeout
+    event_bus = _listen_grain_events()
+    try:
+        while True:
+            for host in sorted(pending):
+                remote_grains = __salt__['ceph_salt.get_remote_grains'](host,
+                                                                       [FAILED_GRAIN, grain])
+                if remote_grains is None:
+                    continue
+                if remote_grains[FAILED_GRAIN]:
+                    return False, host
+                if remote_grains[grain]:
+                    pending.discard(host)
+            logger.info("Waiting for grain '%s' (%s/%s)",
+                        grain, len(hosts) - len(pending), len(hosts))
+            if not pending:
+                return True, None
+            polltime = min(time.time() + GRAIN_POLL_INTERVAL, timelimit)
+            while pending:
+                remaining = polltime - time.time()
+                if remaining <= 0:
+                    break
+                data = _wait_grain_event(event_bus, pending, remaining)
+                if data is None:
+                    break
+                if not data.get('value'):
+                    continue
+                if data.get('grain') == FAILED_GRAIN:
+                    return False, data['id']
+                if data.get('grain') == grain:
+                    pending.discard(data['id'])
+            if not pending:
+                return True, None
+            if time.time() > timelimit:
+                return None, None
+    finally:
+        if event_bus is not None:
+            event_bus.destroy()
+
+
 def wait_for_grain(name, grain, hosts, timeout=1800):
     ret = {'name': name, 'changes': {}, 'comment': '', 'result': False}
-    completed_counter = 0
-    starttime = time.time()
-    timelimit = starttime + timeout
-    while completed_counter < len(hosts):
-        is_timedout = time.time() > timelimit
-        if is_timedout:
-            ret['comment'] = 'Timeout value reached.'
-            return ret
-        time.sleep(15)
-        completed_counter = 0
-        for host in hosts:
-            grain_value = __salt__['ceph_salt.get_remote_grain'](host, 'ceph-salt:execution:failed')
-            if grain_value:
-                ret['comment'] = 'One or more minions failed.'
-                return ret
-            grain_value = __salt__['ceph_salt.get_remote_grain'](host, grain)
-            if grain_value:
-                completed_counter += 1
-        logger.info("Waiting for grain '%s' (%s/%s)", grain, completed_counter, len(hosts))
+    result, _ = _wait_for_hosts_grain(grain, hosts, timeout)
+    if result is None:
+        ret['comment'] = 'Timeout value reached.'
+        return ret
+    if not result:
+        ret['comment'] = 'One or more minions failed.'
+        return ret
     ret['result'] = True
     return ret
 
@@ -132,29 +223,27 @@ def wait_for_ancestor_minion_grain(name, grain, if_grain, timeout=36000):
                 break
         if ancestor_minion:
             begin_stage("Wait for '{}'".format(ancestor_minion))
-            ancestor_minion_ready = False
-            starttime = time.time()
-            timelimit = starttime + timeout
-            while not ancestor_minion_ready:
-                is_timedout = time.time() > timelimit
-                if is_timedout:
-                    ret['comment'] = 'Timeout value reached.'
-                    return ret
-                grain_value = __salt__['ceph_salt.get_remote_grain'](ancestor_minion, 'ceph-salt:execution:failed')
-                if grain_value:
-                    ret['comment'] = 'Minion {} failed.'.format(ancestor_minion)
-                    return ret
-                grain_value = __salt__['ceph_salt.get_remote_grain'](ancestor_minion, grain)
-                if grain_value:
-                    ancestor_minion_ready = True
-                if not ancestor_minion_ready:
-                    logger.info("Waiting for grain '%s' on '%s'", grain, ancestor_minion)
-                    time.sleep(15)
+            result, _ = _wait_for_hosts_grain(grain, [ancestor_minion], timeout)
+            if result is None:
+                ret['comment'] = 'Timeout value reached.'
+                return ret
+            if not result:
+                ret['comment'] = 'Minion {} failed.'.format(ancestor_minion)
+                return ret
             end_stage("Wait for '{}'".format(ancestor_minion))
     ret['result'] = True
     return ret
 
 
+def close_ssh_connections(name):
+    ret = {'name': name, 'changes': {}, 'comment': '', 'result': True}
+    stats = __salt__['ceph_salt.ssh_stats']()
+    closed = __salt__['ceph_salt.ssh_close_all']()
+    ret['comment'] = ("Closed {} SSH connections ({} established, "
+                      "{} reused)".format(closed, stats['handshakes'], stats['reused']))
+    return ret
+
+
 def check_safety(name):
     ret = {'name': name, 'changes': {}, 'comment': '', 'result': False}
     cmd_ret = __salt__['ceph_salt.is_safety_disengaged']()
@@ -10,8 +10,10 @@ import pkg_resources
 from .config_shell import run_config_cmdline, run_config_shell, run_status, run_export, run_import
 from .exceptions import CephSaltException
 from .logging_utils import LoggingUtil
+from .profiling import SaltProfiler
+from .salt_utils import SaltClient
 from .terminal_utils import check_root_privileges, PrettyPrinter as PP
-from .execute import CephSaltExecutor, run_disengage_safety, run_purge, run_stop
+from .execute import CephSaltExecutor, run_disengage_safety, run_purge, run_replay, run_stop
 
 
 logger = logging.getLogger(__name__)
@@ -25,6 +27,8 @@ def ceph_salt_main():
         logger.exception(ex)
         PP.pl_red(str(ex))
         sys.exit(1)
+    finally:
+        logger.debug("Salt client pool stats: %s", SaltClient.pool_stats())
 
 
 @click.group()
@@ -34,10 +38,28 @@ def ceph_salt_main():
 @click.option('--log-file', default='/var/log/ceph-salt.log',
               type=click.Path(dir_okay=False),
               help="the file path for the log to be stored")
+@click.option('--profile', is_flag=True, default=False,
+              help="report the time spent in Salt calls and pillar YAML at exit")
+@click.option('--profile-file', default=None, type=click.Path(dir_okay=False),
+              help="write the profile report to a file instead of stderr (implies --profile)")
 @click.version_option(pkg_resources.get_distribution('ceph-salt'), message="%(version)s")
 @check_root_privileges
-def cli(log_level, log_file):
+@click.pass_context
+def cli(ctx, log_level, log_file, profile, profile_file):
     LoggingUtil.setup_logging(log_level, log_file)
+    if profile or profile_file:
+        SaltProfiler.enable()
+        ctx.call_on_close(lambda: _write_profile(profile_file))
+
+
+def _write_profile(profile_file):
+    # stdout is reserved for the command output (e.g. 'export')
+    if profile_file:
+        with open(profile_file, 'w') as file:
+            SaltProfiler.write_report(file)
+    else:
+        SaltProfiler.write_report(sys.stderr)
+    SaltProfiler.disable()
 
 
 @cli.command(name='config')
@@ -84,12 +106,16 @@ def export_config(pretty):
 
 
 @cli.command(name='import')
-@click.argument('config_file', required=True)
-def import_config(config_file):
+@click.option('-r', '--resume', is_flag=True, default=False,
+              help='Resume an interrupted import')
+@click.argument('config_file', required=False)
+def import_config(resume, config_file):
     """
     Import configuration
     """
-    if not run_import(config_file):
+    if not resume and not config_file:
+        raise click.UsageError("Missing argument 'CONFIG_FILE'.")
+    if not run_import(config_file, resume):
         sys.exit(1)
 
 
@@ -106,13 +132,15 @@ def _prompt_proceed(msg, default):
 @cli.command(name='apply')
 @click.option('-n', '--non-interactive', is_flag=True, default=False,
               help='Apply config in non-interactive mode')
+@click.option('-j', '--journal', type=click.Path(dir_okay=False),
+              help='Record the execution events in a journal file that can be replayed')
 @click.argument('minion_id', required=False)
-def apply(non_interactive, minion_id):
+def apply(non_interactive, journal, minion_id):
     """
     Apply configuration by running ceph-salt formula
     """
     executor = CephSaltExecutor(not non_interactive, minion_id,
-                                'ceph-salt', {}, _prompt_proceed)
+                                'ceph-salt', {}, _prompt_proceed, journal)
     retcode = executor.run()
     sys.exit(retcode)
 
@@ -144,8 +172,10 @@ def purge(non_interactive, yes_i_really_really_mean_it):
               help='Apply config in non-interactive mode')
 @click.option('-r', '--reboot', is_flag=True, default=False,
               help='Reboot if needed')
+@click.option('-j', '--journal', type=click.Path(dir_okay=False),
+              help='Record the execution events in a journal file that can be replayed')
 @click.argument('minion_id', required=False)
-def update(non_interactive, reboot, minion_id):
+def update(non_interactive, reboot, journal, minion_id):
     """
     Update all packages
     """
@@ -156,7 +186,7 @@ def update(non_interactive, reboot, minion_id):
                                             'reboot-if-needed': reboot
                                         }
                                     }
-                                }, _prompt_proceed)
+                                }, _prompt_proceed, journal)
     retcode = executor.run()
     sys.exit(retcode)
 
@@ -166,8 +196,10 @@ def update(non_interactive, reboot, minion_id):
               help='Reboot in non-interactive mode')
 @click.option('-f', '--force', is_flag=True, default=False,
               help='Force reboot even if not needed')
+@click.option('-j', '--journal', type=click.Path(dir_okay=False),
+              help='Record the execution events in a journal file that can be replayed')
 @click.argument('minion_id', required=False)
-def reboot_cmd(non_interactive, force, minion_id):
+def reboot_cmd(non_interactive, force, journal, minion_id):
     """
     Reboot hosts if needed
     """
@@ -176,11 +208,25 @@ def reboot_cmd(non_interactive, force, minion_id):
                                     'ceph-salt': {
                                         'force-reboot': force
                                     }
-                                }, _prompt_proceed)
+                                }, _prompt_proceed, journal)
     retcode = executor.run()
     sys.exit(retcode)
 
 
+@cli.command(name='replay')
+@click.option('-n', '--non-interactive', is_flag=True, default=False,
+              help='Replay in non-interactive mode')
+@click.option('-s', '--speed', default=10.0, type=float,
+              help='Replay speed factor, 0 replays as fast as possible (default: 10)')
+@click.argument('journal_file', required=True, type=click.Path(exists=True, dir_okay=False))
+def replay(non_interactive, speed, journal_file):
+    """
+    Replay an execution journal recorded with '--journal'
+    """
+    retcode = run_replay(journal_file, not non_interactive, speed)
+    sys.exit(retcode)
+
+
 @cli.command(name='stop')
 @click.option('-n', '--non-interactive', is_flag=True, default=False,
               help="Stop ceph cluster in non-interactive mode")
@@ -1,8 +1,8 @@
 # pylint: disable=arguments-differ
-from copy import deepcopy
 import itertools
 import logging
 import fnmatch
+import hashlib
 import json
 import os
 from pathlib import Path
@@ -16,14 +16,14 @@ from pyparsing import alphanums, OneOrMore, Optional, Regex, Suppress, Word, Quo
 import configshell_fb as configshell
 from configshell_fb.shell import locatedExpr
 
-from .core import CephNodeManager, SshKeyManager, CephNode
+from .core import CephNode, CephNodeManager, SshKeyManager
 from .exceptions import (
     CephSaltException,
     MinionDoesNotExistInConfiguration,
     ParamsException
 )
 from .params_helper import BooleanStringValidator, BooleanStringTransformer
-from .salt_utils import GrainsManager, PillarManager, CephOrch
+from .salt_utils import atomic_write, GrainsManager, PillarManager, CephOrch, SaltClient
 from .terminal_utils import PrettyPrinter as PP
 from .validate.config import validate_config
 from .validate.salt_master import check_salt_master_status, CephSaltPillarNotConfigured
@@ -157,6 +157,35 @@ class RoleHandler(OptionHandler):
 
         self._value = set(value)
 
+    def _bulk_save(self, minions, change, undo):
+        nodes = [CephNodeManager.ceph_salt_nodes()[minion] for minion in minions]
+        for node in nodes:
+            change(node)
+        failures = CephNodeManager.save_nodes(nodes)
+        for node in nodes:
+            if node.minion_id in failures:
+                undo(node)
+        if len(failures) < len(nodes):
+            CephNodeManager.save_in_pillar()
+        self._load()
+        return failures
+
+    def add(self, minions):
+        """
+        Adds the role to several minions at once
+        :return: dict of ``CephSaltException`` by minion id, of the minions it failed on
+        """
+        return self._bulk_save(minions, lambda node: node.add_role(self.role),
+                               lambda node: node.roles.discard(self.role))
+
+    def remove(self, minions):
+        """
+        Removes the role from several minions at once
+        :return: dict of ``CephSaltException`` by minion id, of the minions it failed on
+        """
+        return self._bulk_save(minions, lambda node: node.roles.discard(self.role),
+                               lambda node: node.add_role(self.role))
+
     def children_handler(self, child_name):
         return RoleElementHandler(CephNodeManager.ceph_salt_nodes()[child_name], self.role)
 
@@ -193,6 +222,24 @@ class CephSaltNodesHandler(OptionHandler):
 
         self._ceph_salt_nodes = set(value)
 
+    def add(self, minions):
+        """
+        Adds several minions at once
+        :return: dict of ``CephSaltException`` by minion id, of the minions not added
+        """
+        failures = CephNodeManager.add_nodes(minions)
+        self._ceph_salt_nodes.update(set(minions) - set(failures))
+        return failures
+
+    def remove(self, minions):
+        """
+        Removes several minions at once
+        :return: dict of ``CephSaltException`` by minion id, of the minions not removed
+        """
+        failures = CephNodeManager.remove_nodes(minions)
+        self._ceph_salt_nodes.difference_update(set(minions) - set(failures))
+        return failures
+
     def possible_values(self):
         if not self._minions:
             self._minions = set(CephNodeManager.list_all_minions())
@@ -1092,54 +1139,55 @@ class MinionsOptionNode(OptionNode):
             return "Minions: {}".format(str(len(value_list))), val_type
         return 'no minions', False
 
+    @staticmethod
+    def _print_failures(failures):
+        for minion in sorted(failures):
+            logger.error(failures[minion])
+            PP.pl_red(failures[minion])
+
     def ui_command_add(self, minion_id):
-        matching = fnmatch.filter(self.option_dict['handler'].possible_values(), minion_id)
-        counter = 0
-        has_errors = False
-        for match in matching:
-            if match not in self.value:
+        handler = self.option_dict['handler']
+        matching = [match for match in fnmatch.filter(handler.possible_values(), minion_id)
+                    if match not in self.value]
+        failures = {}
+        if matching:
+            for match in matching:
                 PP.println('Adding {}...'.format(match))
-                new_value = list(self.value)
-                new_value.append(match)
-                try:
-                    self.option_dict['handler'].save(new_value)
-                    self.value = new_value
-                    MinionOptionNode(match, self.option_dict['handler'].children_handler(match),
-                                     self)
-                    counter += 1
-                except CephSaltException as ex:
-                    logger.exception(ex)
-                    PP.pl_red(ex)
-                    has_errors = True
+            with PillarManager.transaction():
+                failures = handler.add(matching)
+            self._print_failures(failures)
+        added = [match for match in matching if match not in failures]
+        self.value = self.value + added
+        for match in added:
+            MinionOptionNode(match, handler.children_handler(match), self)
+        counter = len(added)
         if counter == 1:
             PP.pl_green('1 minion added.')
         elif counter > 1:
             PP.pl_green('{} minions added.'.format(counter))
-        elif not has_errors:
+        elif not failures:
             PP.pl_red('No minions added.')
 
     def ui_command_remove(self, minion_id):
+        handler = self.option_dict['handler']
         matching = fnmatch.filter(self.value, minion_id)
-        counter = 0
-        has_errors = False
-        for match in matching:
-            PP.println('Removing {}...'.format(match))
-            new_value = list(self.value)
-            new_value.remove(match)
-            try:
-                self.option_dict['handler'].save(new_value)
-                self.value = new_value
-                self.remove_child(self.get_child(match))
-                counter += 1
-            except CephSaltException as ex:
-                logger.exception(ex)
-                PP.pl_red(ex)
-                has_errors = True
+        failures = {}
+        if matching:
+            for match in matching:
+                PP.println('Removing {}...'.format(match))
+            with PillarManager.transaction():
+                failures = handler.remove(matching)
+            self._print_failures(failures)
+        removed = [match for match in matching if match not in failures]
+        self.value = [value for value in self.value if value not in removed]
+        for match in removed:
+            self.remove_child(self.get_child(match))
+        counter = len(removed)
         if counter == 1:
             PP.pl_green('1 minion removed.')
         elif counter > 1:
             PP.pl_green('{} minions removed.'.format(counter))
-        elif not has_errors:
+        elif not failures:
             PP.pl_red('No minions removed.')
 
     # pylint: disable=unused-argument
@@ -1264,6 +1312,25 @@ class CephSaltConfigShell(configshell.ConfigShell):
         parser = Optional(path) + Optional(command) + Optional(parameters)
         self._parser = parser
 
+    def run_cmdline(self, cmdline):
+        if cmdline and PillarManager.refresh_if_changed():
+            self.refresh_tree()
+        super(CephSaltConfigShell, self).run_cmdline(cmdline)
+
+    def refresh_tree(self):
+        """
+        Rebuilds the configuration tree from the current pillar and grains, staying
+        at the current path if it still exists
+        """
+        # pylint: disable=access-member-before-definition,protected-access
+        path = self._current_node.path if self._current_node else '/'
+        CephNodeManager.invalidate()
+        generate_config_shell_tree(self)
+        try:
+            self._current_node = self._root_node.get_node(path)
+        except ValueError:
+            pass
+
 
 def check_config_prerequesites(sync_modules_target=None):
     try:
@@ -1282,15 +1349,13 @@ def run_status():
     status = {}
     result = True
     host_ls = CephOrch.host_ls()
-    all = PillarManager.get('ceph-salt:minions:all', [])
-    all.sort()
+    all = sorted(PillarManager.get('ceph-salt:minions:all', []))
     status['Cluster'] = '{} minions, {} hosts managed by cephadm'.format(len(all), len(host_ls))
     deployed = CephOrch.deployed()
-    nodes = {}
+    nodes = CephNodeManager.prefetch(all, ['os_codename', 'ceph_version', 'ipsv4', 'ipsv6'])
     os_codenames = {}
     ceph_versions = {}
     for minion in all:
-        nodes[minion] = CephNode(minion)
         os_codenames[minion] = nodes[minion].os_codename
         ceph_versions[minion] = nodes[minion].ceph_version.split(' (')[0]
     num_os_codenames = len(set(os_codenames.values()))
@@ -1355,7 +1420,8 @@ def run_config_cmdline(cmdline):
 
 
 def run_export(pretty):
-    config = deepcopy(PillarManager.get('ceph-salt'))
+    # only top-level keys are dropped, so a shallow copy is enough
+    config = dict(PillarManager.get('ceph-salt'))
     config.pop('execution', None)
     if pretty:
         PP.println(json.dumps(config, indent=4, sort_keys=True))
@@ -1364,9 +1430,64 @@ def run_export(pretty):
     return True
 
 
-def run_import(config_file):
-    with open(config_file) as json_file:
-        config = json.load(json_file)
+# steps of 'ceph-salt import', in order
+IMPORT_STEPS = ['remove_grains', 'set_grains', 'set_pillar']
+IMPORT_JOURNAL_FILE = '.ceph-salt-import.journal'
+
+
+def _import_journal_path():
+    return os.path.join(SaltClient.pillar_fs_path(), IMPORT_JOURNAL_FILE)
+
+
+def _write_import_journal(journal):
+    atomic_write(_import_journal_path(), json.dumps(journal), 0o600)
+
+
+def _read_import_journal():
+    try:
+        with open(_import_journal_path()) as journal_file:
+            return json.load(journal_file)
+    except FileNotFoundError:
+        return None
+
+
+def _read_import_config(config_file):
+    """
+    :return: the configuration in `config_file`, and the SHA-256 digest of the file
+    """
+    with open(config_file, 'rb') as json_file:
+        content = json_file.read()
+    return json.loads(content.decode('utf-8')), hashlib.sha256(content).hexdigest()
+
+
+def run_import(config_file, resume=False):
+    """
+    Imports a configuration in steps recorded in a journal, next to the pillar file, so
+    that an interrupted import can be resumed with `resume=True`.
+    The journal holds the path and the digest of the configuration file, not the
+    configuration itself, which contains secrets.
+    """
+    if resume:
+        journal = _read_import_journal()
+        if journal is None:
+            PP.pl_red('There is no interrupted import to resume.')
+            return False
+        PP.println("Resuming import of '{}'...".format(journal['config_file']))
+        try:
+            config, digest = _read_import_config(journal['config_file'])
+        except FileNotFoundError:
+            PP.pl_red("Cannot resume import, '{}' does not exist anymore.".format(
+                journal['config_file']))
+            return False
+        if digest != journal.get('sha256'):
+            PP.pl_red("Cannot resume import, '{}' changed since the import was "
+                      "interrupted.".format(journal['config_file']))
+            return False
+    else:
+        config, digest = _read_import_config(config_file)
+        if _read_import_journal() is not None:
+            PP.pl_orange('Discarding an interrupted import.')
+        journal = {'config_file': os.path.abspath(config_file), 'sha256': digest, 'done': []}
     salt_minions = CephNodeManager.list_all_minions()
     minions_config = config.get('minions', {})
     # Validate
@@ -1374,18 +1495,46 @@ def run_import(config_file):
         if minion not in salt_minions:
             PP.pl_red("Cannot find minion '{}'".format(minion))
             return False
-    # Update grains
-    minions = GrainsManager.filter_by('ceph-salt', 'member')
-    if minions:
-        GrainsManager.del_grain(minions, 'ceph-salt')
-    for minion in minions_config.get('all', []):
-        node = CephNode(minion)
-        if minion in minions_config.get('admin', []):
-            node.add_role('admin')
-        if minion in minions_config.get('cephadm', []):
-            node.add_role('cephadm')
-        node.save()
-    # Update pillar
-    PillarManager.set('ceph-salt', config)
+    _write_import_journal(journal)
+
+    def _remove_grains():
+        minions = GrainsManager.filter_by('ceph-salt', 'member')
+        if minions:
+            GrainsManager.del_grain(minions, 'ceph-salt')
+        return True
+
+    def _set_grains():
+        # minions that do not respond are reported by 'save_nodes', and do not stop
+        # the others from being saved
+        nodes = {minion: CephNode(minion) for minion in minions_config.get('all', [])}
+        for minion, node in nodes.items():
+            if minion in minions_config.get('admin', []):
+                node.add_role('admin')
+            if minion in minions_config.get('cephadm', []):
+                node.add_role('cephadm')
+        failures = CephNodeManager.save_nodes(nodes.values())
+        for minion in sorted(failures):
+            logger.error(failures[minion])
+            PP.pl_red(failures[minion])
+        return not failures
+
+    def _set_pillar():
+        PillarManager.set('ceph-salt', config)
+        return True
+
+    steps = {'remove_grains': _remove_grains, 'set_grains': _set_grains,
+             'set_pillar': _set_pillar}
+    for step in IMPORT_STEPS:
+        if step in journal['done']:
+            continue
+        if not steps[step]():
+            PP.pl_red("Import interrupted, run 'ceph-salt import --resume' to retry.")
+            return False
+        journal['done'].append(step)
+        _write_import_journal(journal)
+    os.remove(_import_journal_path())
+    missing = PillarManager.wait_for_refresh()
+    if missing:
+        PP.pl_orange('Pillar refresh did not return from: {}'.format(', '.join(missing)))
     PP.pl_green('Configuration imported.')
     return True
@@ -2,13 +2,14 @@ import base64
 import copy
 import hashlib
 import ipaddress
+import json
 import logging
 import os
 
 from Cryptodome.PublicKey import RSA
 import salt
 
-from .exceptions import CephNodeHasRolesException
+from .exceptions import CephNodeHasRolesException, SaltCallException
 from .salt_utils import GrainsManager, PillarManager, SaltClient
 
 
@@ -16,6 +17,7 @@ logger = logging.getLogger(__name__)
 
 
 CEPH_SALT_GRAIN_KEY = 'ceph-salt'
+CEPH_VERSION_CMD = 'test -e /usr/bin/ceph && ceph --version || echo "Not installed"'
 
 
 class CephNode:
@@ -45,25 +47,31 @@ class CephNode:
             self._ipsv6 = result[self.minion_id]
         return self._ipsv6
 
+    @staticmethod
+    def _is_loopback(addr):
+        return ipaddress.ip_address(addr).is_loopback
+
+    def _select_public_ip(self, fqdn_ips4, ipsv4_getter):
+        _public_ip = fqdn_ips4[0]
+        if self._is_loopback(_public_ip):
+            logger.debug("fqdn_ipv4 grain is '%s', falling back to ipv4 grain", _public_ip)
+            for addr in ipsv4_getter():
+                if not self._is_loopback(addr):
+                    _public_ip = addr
+                    break
+            if self._is_loopback(_public_ip):
+                logger.warning("'%s' public IP is the loopback interface IP ('%s')",
+                               self.minion_id, _public_ip)
+        return _public_ip
+
     @property
     def public_ip(self):
-        def _is_loopback(addr):
-            return ipaddress.ip_address(addr).is_loopback
-
         if self._public_ip is None:
             result = GrainsManager.get_grain(self.minion_id, 'fqdn_ip4')
-            _public_ip = result[self.minion_id][0]
-            if _is_loopback(_public_ip):
-                logger.debug("fqdn_ipv4 grain is '%s', falling back to ipv4 grain", _public_ip)
-                result = GrainsManager.get_grain(self.minion_id, 'ipv4')
-                for addr in result[self.minion_id]:
-                    if not _is_loopback(addr):
-                        _public_ip = addr
-                        break
-                if _is_loopback(_public_ip):
-                    logger.warning("'%s' public IP is the loopback interface IP ('%s')",
-                                   self.minion_id, _public_ip)
-            self._public_ip = _public_ip
+
+            def _ipsv4():
+                return GrainsManager.get_grain(self.minion_id, 'ipv4')[self.minion_id]
+            self._public_ip = self._select_public_ip(result[self.minion_id], _ipsv4)
         return self._public_ip
 
     @property
@@ -94,13 +102,17 @@ class CephNode:
             self._roles = _roles
         return self._roles
 
+    @staticmethod
+    def _execution_from_grain(grain):
+        if 'execution' in grain:
+            return grain['execution']
+        return {}
+
     @property
     def execution(self):
         if self._execution is None:
             result = GrainsManager.get_grain(self.minion_id, CEPH_SALT_GRAIN_KEY)
-            self._execution = {}
-            if 'execution' in result[self.minion_id]:
-                self._execution = result[self.minion_id]['execution']
+            self._execution = self._execution_from_grain(result[self.minion_id])
         return self._execution
 
     @property
@@ -113,9 +125,7 @@ class CephNode:
     @property
     def ceph_version(self):
         if self._ceph_version is None:
-            result = SaltClient.local_cmd(self.minion_id, 'cmd.shell', [
-                'test -e /usr/bin/ceph && ceph --version || echo "Not installed"'
-            ])
+            result = SaltClient.local_cmd(self.minion_id, 'cmd.shell', [CEPH_VERSION_CMD])
             self._ceph_version = result[self.minion_id]
         return self._ceph_version
 
@@ -141,28 +151,45 @@ class CephNode:
 class CephNodeManager:
     _ceph_salt_nodes = {}
 
+    # grains needed to fill each prefetchable ``CephNode`` property
+    _PREFETCH_GRAINS = {
+        'ipsv4': ['ipv4'],
+        'ipsv6': ['ipv6'],
+        'os_codename': ['oscodename'],
+        'execution': [CEPH_SALT_GRAIN_KEY],
+        'public_ip': ['fqdn_ip4', 'ipv4'],
+    }
+
     @classmethod
     def _load(cls):
         if not cls._ceph_salt_nodes:
             minions = GrainsManager.filter_by(CEPH_SALT_GRAIN_KEY)
             cls._ceph_salt_nodes = {minion: CephNode(minion) for minion in minions}
 
+    @classmethod
+    def invalidate(cls):
+        """
+        Drops the cached nodes, so that they are loaded again on next access
+        """
+        cls._ceph_salt_nodes = {}
+
     @classmethod
     def save_in_pillar(cls):
         minions = [n.minion_id for n in cls._ceph_salt_nodes.values()]
-        PillarManager.set('ceph-salt:minions:all', minions)
-        PillarManager.set('ceph-salt:minions:admin',
-                          [n.minion_id for n in cls._ceph_salt_nodes.values()
-                           if 'admin' in n.roles])
-        PillarManager.set('ceph-salt:minions:cephadm',
-                          [n.minion_id for n in cls._ceph_salt_nodes.values()
-                           if 'cephadm' in n.roles])
-        PillarManager.set('ceph-salt:minions:latency',
-                          [n.minion_id for n in cls._ceph_salt_nodes.values()
-                           if 'latency' in n.roles])
-        PillarManager.set('ceph-salt:minions:throughput',
-                          [n.minion_id for n in cls._ceph_salt_nodes.values()
-                           if 'throughput' in n.roles])
+        with PillarManager.transaction():
+            PillarManager.set('ceph-salt:minions:all', minions)
+            PillarManager.set('ceph-salt:minions:admin',
+                              [n.minion_id for n in cls._ceph_salt_nodes.values()
+                               if 'admin' in n.roles])
+            PillarManager.set('ceph-salt:minions:cephadm',
+                              [n.minion_id for n in cls._ceph_salt_nodes.values()
+                               if 'cephadm' in n.roles])
+            PillarManager.set('ceph-salt:minions:latency',
+                              [n.minion_id for n in cls._ceph_salt_nodes.values()
+                               if 'latency' in n.roles])
+            PillarManager.set('ceph-salt:minions:throughput',
+                              [n.minion_id for n in cls._ceph_salt_nodes.values()
+                               if 'throughput' in n.roles])
 
     @classmethod
     def ceph_salt_nodes(cls):
@@ -187,6 +214,143 @@ class CephNodeManager:
         GrainsManager.del_grain(minion_id, CEPH_SALT_GRAIN_KEY)
         cls.save_in_pillar()
 
+    @classmethod
+    def _prefetch_execution(cls, nodes):
+        """
+        Loads the 'execution' property of the nodes that did not load it yet, with a
+        single 'grains.item' job.
+        :return: dict of ``SaltCallException`` by minion id, of the minions that did not respond
+        """
+        missing = [node for node in nodes if node._execution is None]
+        if not missing:
+            return {}
+        fetched = cls.prefetch([node.minion_id for node in missing], ['execution'])
+        failures = {}
+        for node in missing:
+            execution = fetched[node.minion_id]._execution
+            if execution is None:
+                failures[node.minion_id] = SaltCallException(node.minion_id, 'grains.item',
+                                                             'minion did not respond')
+            else:
+                node._execution = execution
+        return failures
+
+    @classmethod
+    def save_nodes(cls, nodes):
+        """
+        Saves the 'ceph-salt' grain of several nodes with a single 'grains.setval' job per
+        distinct grain value, i.e. usually a single job, plus a single 'grains.item' job if
+        the 'execution' property of some nodes is not loaded yet.
+        :return: dict of ``CephSaltException`` by minion id, of the nodes that were not saved
+        """
+        nodes = list(nodes)
+        failures = cls._prefetch_execution(nodes)
+        groups = {}
+        for node in nodes:
+            if node.minion_id in failures:
+                continue
+            value = node._grains_value()
+            key = json.dumps(value, sort_keys=True, default=str)
+            groups.setdefault(key, (value, []))[1].append(node.minion_id)
+        for value, minions in groups.values():
+            failures.update(GrainsManager.bulk_set_grain(minions, CEPH_SALT_GRAIN_KEY, value))
+        return failures
+
+    @classmethod
+    def add_nodes(cls, minion_ids):
+        """
+        Adds several minions with a single 'grains.item' job, a single 'grains.setval' job
+        and a single pillar update. Minions that fail are reported, not added, and do not
+        stop the others from being added.
+        :return: dict of ``CephSaltException`` by minion id, of the minions not added
+        """
+        cls._load()
+        nodes = {minion: CephNode(minion) for minion in minion_ids}
+        failures = cls.save_nodes(nodes.values())
+        added = [minion for minion in nodes if minion not in failures]
+        for minion in added:
+            cls._ceph_salt_nodes[minion] = nodes[minion]
+        if added:
+            cls.save_in_pillar()
+        return failures
+
+    @classmethod
+    def remove_nodes(cls, minion_ids):
+        """
+        Removes several minions with a single 'grains.delkey' job and a single pillar
+        update. Minions that have roles, or fail, are reported and not removed.
+        :return: dict of ``CephSaltException`` by minion id, of the minions not removed
+        """
+        cls._load()
+        failures = {}
+        removable = []
+        for minion_id in minion_ids:
+            roles = cls.all_roles(cls._ceph_salt_nodes[minion_id])
+            if roles:
+                failures[minion_id] = CephNodeHasRolesException(minion_id, sorted(roles))
+            else:
+                removable.append(minion_id)
+        if removable:
+            failures.update(GrainsManager.bulk_del_grain(removable, CEPH_SALT_GRAIN_KEY))
+        removed = [minion for minion in removable if minion not in failures]
+        for minion in removed:
+            del cls._ceph_salt_nodes[minion]
+        if removed:
+            cls.save_in_pillar()
+        return failures
+
+    @classmethod
+    def prefetch(cls, minions, fields):
+        """
+        Loads the given ``CephNode`` properties of all ``minions`` in bulk: a single
+        'grains.item' job, plus at most one 'network.subnets' and one 'cmd.shell' job,
+        regardless of the number of minions.
+        Properties of minions that do not return are left to be lazily loaded.
+        :param fields: names of ``CephNode`` properties, e.g. ``['ipsv4', 'os_codename']``
+        :return: dict of ``CephNode`` objects by minion id
+        """
+        minions = list(minions)
+        nodes = {minion: CephNode(minion) for minion in minions}
+        if not minions:
+            return nodes
+        fields = set(fields)
+        unknown = fields - set(cls._PREFETCH_GRAINS) - {'subnets', 'ceph_version'}
+        if unknown:
+            raise ValueError("Cannot prefetch CephNode fields: {}".format(sorted(unknown)))
+
+        grain_keys = sorted({key for field in fields
+                             for key in cls._PREFETCH_GRAINS.get(field, [])})
+        if grain_keys:
+            result = GrainsManager.get_grains(minions, grain_keys)
+            for minion, grains in result.items():
+                node = nodes.get(minion)
+                if node is None:
+                    continue
+                if 'ipsv4' in fields:
+                    node._ipsv4 = grains.get('ipv4', '')
+                if 'ipsv6' in fields:
+                    node._ipsv6 = grains.get('ipv6', '')
+                if 'os_codename' in fields:
+                    node._os_codename = grains.get('oscodename', '')
+                if 'execution' in fields:
+                    node._execution = node._execution_from_grain(
+                        grains.get(CEPH_SALT_GRAIN_KEY) or {})
+                if 'public_ip' in fields and grains.get('fqdn_ip4'):
+                    node._public_ip = node._select_public_ip(
+                        grains['fqdn_ip4'], lambda _grains=grains: _grains.get('ipv4', []))
+        if 'subnets' in fields:
+            result = SaltClient.local_cmd(minions, 'network.subnets', tgt_type='list')
+            for minion, subnets in result.items():
+                if minion in nodes:
+                    nodes[minion]._subnets = subnets
+        if 'ceph_version' in fields:
+            result = SaltClient.local_cmd(minions, 'cmd.shell', [CEPH_VERSION_CMD],
+                                          tgt_type='list')
+            for minion, version in result.items():
+                if minion in nodes and isinstance(version, str):
+                    nodes[minion]._ceph_version = version
+        return nodes
+
     @classmethod
     def list_all_minions(cls):
         return os.listdir(SaltClient.pki_minions_fs_path())
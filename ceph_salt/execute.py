@@ -8,14 +8,15 @@ import signal
 import threading
 import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 
 import yaml
 
-from .core import CephNode, CephNodeManager
+from .core import CephNodeManager
 from .exceptions import MinionDoesNotExistInConfiguration, ValidationException
 from .logging_utils import LoggingUtil
-from .salt_event import EventListener, SaltEventProcessor
+from .salt_event import EventJournal, EventListener, SaltEventProcessor
 from .salt_utils import SaltClient, GrainsManager, CephOrch, PillarManager
 from .terminal_utils import PrettyPrinter as PP
 from .validate.config import validate_config
@@ -62,8 +63,12 @@ class CursesScreen:
     COLOR_ERROR = 9
     COLOR_WARNING = 10
 
-    def __init__(self, num_rows=1000):
-        self.num_rows = num_rows
+    def __init__(self, margin=100):
+        # the body pad only holds the visible rows plus `margin` rows above and below them,
+        # starting at body row `pad_top`
+        self.margin = margin
+        self.num_rows = None
+        self.pad_top = 0
         self.height = None
         self.width = None
         self.stdscr = None
@@ -72,6 +77,10 @@ class CursesScreen:
         self.body_height = None
         self.body_width = None
         self.body_pos = 0
+        # number of rows of the body content, maintained by the renderer
+        self.body_rows = 0
+        # when set, `write_body` doesn't write anything, which allows measuring content
+        self.dry_run = False
         self.footer = None
         self.scrollbar = None
         self.key_listeners = []
@@ -80,15 +89,39 @@ class CursesScreen:
     def add_key_listener(self, listener):
         self.key_listeners.append(listener)
 
-    @property
-    def body_current_row(self):
-        return self.body.getyx()[0]
+    def _clamp_body_pos(self):
+        if self.body_pos > self.body_rows - self.body_height:
+            self.body_pos = max(0, self.body_rows - self.body_height)
+
+    def update_window(self):
+        """
+        Moves the pad window, if needed, so that it holds the visible body rows.
+        Returns True if the window moved, in which case the pad was erased and must be
+        rendered again.
+        """
+        if self.body is None:
+            return False
+        self._clamp_body_pos()
+        if self.pad_top <= self.body_pos and \
+                self.body_pos + self.body_height <= self.pad_top + self.num_rows:
+            return False
+        self.pad_top = max(0, self.body_pos - self.margin)
+        self.body.erase()
+        logger.debug("moved body window: top=%s rows=%s", self.pad_top, self.num_rows)
+        return True
+
+    def in_window(self, row, lines):
+        """
+        Returns True if any of the `lines` body rows starting at `row` is in the pad window
+        """
+        if self.body is None:
+            return False
+        return row < self.pad_top + self.num_rows and row + lines > self.pad_top
 
     def refresh(self):
         if self.body:
-            if self.body_pos > self.body_current_row - self.body_height:
-                self.body_pos = max(0, self.body_current_row - self.body_height)
-            self.body.refresh(self.body_pos, 0, self.HEADER_HEIGHT, 0,
+            self._clamp_body_pos()
+            self.body.refresh(self.body_pos - self.pad_top, 0, self.HEADER_HEIGHT, 0,
                               self.height - self.FOOTER_HEIGHT - 1, self.body_width)
 
         if self.scrollbar:
@@ -137,6 +170,8 @@ class CursesScreen:
                                         self.height - self.FOOTER_HEIGHT, 0)
 
         if self.height > 5:
+            self.num_rows = self.body_height + 2 * self.margin
+            self.pad_top = 0
             self.body = curses.newpad(self.num_rows, self.width - 1)
             self.body.scrollok(True)
             self.scrollbar = curses.newwin(self.body_height + 1, 1, self.HEADER_HEIGHT,
@@ -180,11 +215,11 @@ class CursesScreen:
     def has_scroll(self):
         if self.body is None:
             return False
-        return self.body_current_row > self.body_height
+        return self.body_rows > self.body_height
 
     def _render_body_scrollbar(self):
         self.scrollbar.clear()
-        current_row = self.body_current_row
+        current_row = self.body_rows
 
         if current_row <= self.body_height:
             # no scrollbar needed
@@ -215,10 +250,16 @@ class CursesScreen:
             self.body.clear()
 
     def clear_row(self, row):
-        if self.body:
-            self.body.move(row, 0)
+        if self.body and self.in_window(row, 1):
+            self.body.move(row - self.pad_top, 0)
             self.body.clrtoeol()
 
+    def clear_rows(self, row, count):
+        if self.body is None:
+            return
+        for i in range(max(row, self.pad_top), min(row + count, self.pad_top + self.num_rows)):
+            self.clear_row(i)
+
     def _write(self, window, row, col, text, color, bold, reverse, line_padding, width):
         if window is None:
             return
@@ -245,7 +286,10 @@ class CursesScreen:
         self._write(self.footer, row + 1, col, text, color, bold, reverse, line_padding, self.width)
 
     def write_body(self, row, col, text, color, bold=False, reverse=False, line_padding=False):
-        self._write(self.body, row, col, text, color, bold, reverse, line_padding, self.body_width)
+        if self.dry_run or self.body is None or not self.in_window(row, 1):
+            return
+        self._write(self.body, row - self.pad_top, col, text, color, bold, reverse, line_padding,
+                    self.body_width)
 
     def wait_for_event(self):
         try:
@@ -254,16 +298,16 @@ class CursesScreen:
                 return False
             if ch == curses.KEY_NPAGE:
                 if self.body:
-                    if self.body_pos < self.body_current_row - self.body_height:
+                    if self.body_pos < self.body_rows - self.body_height:
                         self.body_pos += min(
                             self.body_height - 1,
-                            self.body_current_row - self.body_pos - self.body_height)
+                            self.body_rows - self.body_pos - self.body_height)
             elif ch == curses.KEY_PPAGE and self.body_pos > 0:
                 if self.body:
                     self.body_pos -= min(self.body_pos, self.body_height - 1)
             elif ch == ord('j'):
                 if self.body:
-                    if self.body_pos < self.body_current_row - self.body_height:
+                    if self.body_pos < self.body_rows - self.body_height:
                         self.body_pos += 1
             elif ch == ord('k'):
                 if self.body:
@@ -522,17 +566,18 @@ class MinionExecution:
 
 
 class CephSaltModel:
-    def __init__(self, minion_id, state, pillar):
+    def __init__(self, minion_id, state, pillar, minions=None):
         self.minion_id = minion_id
         self.state = state
         self.pillar = pillar
         self._minions: Dict[str, MinionExecution] = {}
         self.begin_time = None
         self.end_time = None
-        self._init_minions()
+        self._init_minions(minions)
 
-    def _init_minions(self) -> None:
-        minions = GrainsManager.filter_by('ceph-salt', 'member')
+    def _init_minions(self, minions) -> None:
+        if minions is None:
+            minions = GrainsManager.filter_by('ceph-salt', 'member')
         if self.minion_id is not None:
             if self.minion_id not in minions:
                 raise MinionDoesNotExistInConfiguration(self.minion_id)
@@ -602,7 +647,8 @@ class Renderer:
     def run(self):
         logger.info("started renderer")
         self.running = True
-        while self.running:
+        # the execution may have ended before the renderer started, e.g. in a fast replay
+        while self.running and not self.model.finished():
             time.sleep(0.5)
         logger.info("ended renderer")
 
@@ -663,7 +709,10 @@ class CephSaltController(EventListener):
             self.renderer.minion_update(event.minion)
         if 'ceph-salt' in self.model.pillar:
             self.model.pillar['ceph-salt'].pop('force-reboot', None)
-        executor = CephSaltExecutorThread(self, event.minion)
+        self._apply_minion(event.minion)
+
+    def _apply_minion(self, minion):
+        executor = CephSaltExecutorThread(self, minion)
         executor.start()
 
     def handle_warning_stage(self, event):
@@ -677,6 +726,22 @@ class CephSaltController(EventListener):
     def handle_state_apply_return(self, event):
         if not event.success:
             SaltClient.local().cmd(event.minion, 'grains.set', ['ceph-salt:execution:failed', True])
+            self._relay_grain_set(event.minion, 'ceph-salt:execution:failed', True)
+
+    def handle_grain_set(self, event):
+        self._relay_grain_set(event.minion, event.grain, event.value)
+
+    def _relay_grain_set(self, minion, grain, value):
+        """
+        Fires the grain change on the event bus of every minion of this execution, where
+        the `ceph_salt.wait_for_grain*` states are listening for it
+        """
+        minions = self.model.minions_names()
+        logger.debug("relaying grain '%s=%s' of '%s' to %s", grain, value, minion, minions)
+        SaltClient.local().cmd_async(minions, 'event.fire',
+                                     [{'id': minion, 'grain': grain, 'value': value},
+                                      'ceph-salt/grain/set'],
+                                     tgt_type='list')
 
     def minion_finished(self, minion_name, timestamp, success):
         minion = self.model.get_minion(minion_name)
@@ -689,7 +754,62 @@ class CephSaltController(EventListener):
         self.renderer.minion_failure(minion_name, failure)
 
 
+# name of the states sent by the 'ceph_salt' begin/end stage and step states
+STATE_EVENT_RE = re.compile(r'^ceph_salt_\|-([a-z]+_[a-z]+)_.+_\|-(.+)_\|.*$')
+
+
+def _parse_state_event(state_name):
+    match = STATE_EVENT_RE.match(state_name)
+    if match:
+        return match.group(1), match.group(2)
+    return None
+
+
+def process_failures(controller, minion, states):
+    """
+    Reports the failed states of a 'state.apply' return to the controller, each one in
+    the stage/step it ran in
+    """
+    if isinstance(states, list):
+        controller.minion_failure(minion, None, states)
+        return
+
+    exec_seq = sorted(states.items(), key=lambda e: e[1]['__run_num__'])
+
+    failures = []
+    # the outer event of a failure is the last stage/step event that ran before it,
+    # which is tracked in a single pass over the execution sequence
+    outer_event = None
+    stage_event = None
+
+    for state, data in exec_seq:
+        if not data['result']:
+            if outer_event is None:
+                logger.warning("could not find the outer event for state: %s: %s",
+                               state, data)
+            logger.info("Reporting failure: [%s] %s %s", minion, data['__id__'],
+                        outer_event)
+            data['state'] = state
+            failures.append((outer_event, data))
+        event = _parse_state_event(state)
+        if event:
+            if 'step' in event[0]:
+                outer_event = Event(event[0], event[1], stage_event)
+            else:
+                stage_event = Event(event[0], event[1])
+                outer_event = stage_event
+
+    # We need to revert the failure list because the insertion algorithm of `report_failure`
+    # is adding the failure at the head. For instance, if there are two failures that happened
+    # in the same stage, then report_failure adds them reversed.
+    for event, data in reversed(failures):
+        controller.minion_failure(minion, event, data)
+
+
 class CephSaltExecutorThread(threading.Thread):
+    # maximum number of characters of a full minion response written to the debug log
+    RESPONSE_LOG_MAX_SIZE = 64 * 1024
+
     def __init__(self, controller: CephSaltController, minion_id=None):
         super(CephSaltExecutorThread, self).__init__()
         self.controller = controller
@@ -713,12 +833,12 @@ class CephSaltExecutorThread(threading.Thread):
                                                        "pillar={}".format(model.pillar)],
                                                       tgt_type='grain')
             for ret in returns:
-                logger.info("Response:\n%s", json.dumps(ret, sort_keys=True, indent=2))
                 now = datetime.datetime.utcnow()
                 for minion, data in ret.items():
-                    self.controller.minion_finished(minion, now, ret[minion]['retcode'] == 0)
-                    self._process_failures(minion, data['ret'])
-                    if ret[minion]['retcode'] != 0:
+                    self._log_response(minion, data)
+                    self.controller.minion_finished(minion, now, data['retcode'] == 0)
+                    process_failures(self.controller, minion, data['ret'])
+                    if data['retcode'] != 0:
                         self.controller.set_retcode(2)  # failure in state execution
         except Exception as ex:  # pylint: disable=broad-except
             logger.error("Failure in CephSaltExecutor execution")
@@ -730,50 +850,75 @@ class CephSaltExecutorThread(threading.Thread):
             self.controller.end()
         self.controller.executors -= 1
 
-    def _find_outer_event(self, exec_seq, failure_idx, ev_type=None):
-        def parse_event(state_name):
-            logger.debug("Parse event: %s", state_name)
-            match = re.match(r'^ceph_salt_\|-([a-z]+_[a-z]+)_.+_\|-(.+)_\|.*$', state_name)
-            if match:
-                if ev_type is None or ev_type in match[1]:
-                    return match[1], match[2]
-            return None
-
-        logger.debug("find outer event: %s", failure_idx)
-        for idx in range(failure_idx - 1, -1, -1):
-            event = parse_event(exec_seq[idx][0])
-            if event:
-                if 'step' in event[0]:
-                    stage_event = self._find_outer_event(exec_seq, idx, 'stage')
-                    return Event(event[0], event[1], stage_event)
-                return Event(event[0], event[1])
-        return None
+    def _log_response(self, minion, data):
+        states = data.get('ret')
+        if isinstance(states, dict):
+            failed = sum(1 for state in states.values()
+                         if isinstance(state, dict) and not state.get('result'))
+            logger.info("Response from %s: retcode=%s, %s states, %s failed",
+                        minion, data.get('retcode'), len(states), failed)
+        else:
+            logger.info("Response from %s: retcode=%s, %s",
+                        minion, data.get('retcode'), states)
+        if logger.isEnabledFor(logging.DEBUG):
+            response = json.dumps(data, sort_keys=True, indent=2, default=str)
+            if len(response) > self.RESPONSE_LOG_MAX_SIZE:
+                response = "{}\n... ({} characters truncated)".format(
+                    response[:self.RESPONSE_LOG_MAX_SIZE],
+                    len(response) - self.RESPONSE_LOG_MAX_SIZE)
+            logger.debug("Response from %s:\n%s", minion, response)
+
+
+class ReplayController(CephSaltController):
+    """
+    Controller of a journal replay: updates the model and the renderer like
+    ``CephSaltController``, but never calls Salt
+    """
+    def _apply_minion(self, minion):
+        pass
 
-    def _process_failures(self, minion, states):
-        if isinstance(states, list):
-            self.controller.minion_failure(minion, None, states)
-            return
+    def handle_state_apply_return(self, event):
+        # the job return event carries the same return as 'cmd_iter' in CephSaltExecutorThread
+        data = event.raw_event['data']
+        retcode = data.get('retcode', 0 if event.success else 1)
+        self.minion_finished(event.minion, event.stamp, retcode == 0)
+        process_failures(self, event.minion, data.get('return', {}))
+        if retcode != 0:
+            self.set_retcode(2)
+
+    def _relay_grain_set(self, minion, grain, value):
+        pass
 
-        exec_seq = list(states.items())
-        exec_seq.sort(key=lambda e: e[1]['__run_num__'])
 
-        failures = []
+class CephSaltReplayThread(threading.Thread):
+    def __init__(self, controller: ReplayController, event_proc: SaltEventProcessor,
+                 events, speed):
+        super(CephSaltReplayThread, self).__init__()
+        self.controller = controller
+        self.event_proc = event_proc
+        self.events = events
+        self.speed = speed
+        self.stopped = False
 
-        for idx, (state, data) in enumerate(exec_seq):
-            if not data['result']:
-                event = self._find_outer_event(exec_seq, idx)
-                if event is None:
-                    logger.warning("could not find the outer event for state: %s: %s",
-                                   state, data)
-                logger.info("Reporting failure: [%s] %s %s", minion, data['__id__'], event)
-                data['state'] = state
-                failures.append((event, data))
+    def run(self):
+        self.controller.begin()
+        last_time = None
+        try:
+            for record in self.events:
+                if self.stopped:
+                    break
+                if self.speed > 0 and last_time is not None:
+                    time.sleep(max(0, record['time'] - last_time) / self.speed)
+                last_time = record['time']
+                self.event_proc.process({'tag': record['tag'], 'data': record['data']})
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.error("Failure in journal replay")
+            logger.exception(ex)
+            self.controller.set_retcode(3)
+        self.controller.end()
 
-        # We need to revert the failure list because the insertion algorithm of `report_failure`
-        # is adding the failure at the head. For instance, if there are two failures that happened
-        # in the same stage, then report_failure adds them reversed.
-        for event, data in reversed(failures):
-            self.controller.minion_failure(minion, event, data)
+    def stop(self):
+        self.stopped = True
 
 
 class LoadingWidget(threading.Thread):
@@ -804,18 +949,32 @@ class LoadingWidget(threading.Thread):
 
 
 class CursesRenderer(Renderer, ScreenKeyListener):
+    # number of frames between two frame time reports in the log
+    FRAME_STATS_INTERVAL = 100
+
     def __init__(self, model: CephSaltModel):
         super(CursesRenderer, self).__init__(model)
         self.selected = None
         self.screen = CursesScreen()
         self.screen.add_key_listener(self)
+        # the minions of an execution don't change, so they are only sorted once
+        self.minions = self.model.minions_list()
         self.minions_ui = {}
-        for minion_id, minion in enumerate(self.model.minions_list()):
+        for minion_id, minion in enumerate(self.minions):
             self.minions_ui[minion_id] = {
                 'expanded': False,
                 'jump_to': False,
                 'minion': minion.name
             }
+        self._minion_ids = {minion.name: minion_id
+                            for minion_id, minion in enumerate(self.minions)}
+        # number of body rows used by each minion (None if not rendered yet), and the minions
+        # that must be rendered again in the next frame
+        self._rows = [None] * len(self.minions)
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._body = None
+        self._frame_stats = {'frames': 0, 'time': 0.0, 'max_time': 0.0, 'minions_rendered': 0}
         self._render_lock = threading.Lock()
         self.running = None
         self.paused = None
@@ -1114,30 +1273,92 @@ class CursesRenderer(Renderer, ScreenKeyListener):
 
         return idx
 
+    def _mark_dirty(self, *minion_ids):
+        with self._dirty_lock:
+            self._dirty.update(minion_ids)
+
+    def _measure_minion(self, minion, minion_id, selected, now):
+        self.screen.dry_run = True
+        try:
+            return self._render_minion(minion, minion_id, 0, selected, now)
+        finally:
+            self.screen.dry_run = False
+
     def _update_screen(self):
         with self._render_lock:
+            start_time = time.monotonic()
             now = datetime.datetime.utcnow()
             self._render_header(now)
             self._render_footer()
 
-            self.screen.clear_body()
+            if self.screen.body is not self._body:
+                # first frame, or a new pad after a terminal resize
+                self._body = self.screen.body
+                self._rows = [None] * len(self.minions)
+                self.screen.clear_body()
+            with self._dirty_lock:
+                dirty = self._dirty
+                self._dirty = set()
+
+            # update the number of body rows of changed minions, all minions rendered after
+            # the first one whose number of rows changed are moved
+            moved_from = len(self.minions)
+            for minion_id in sorted(dirty.union(
+                    i for i, rows in enumerate(self._rows) if rows is None)):
+                # one blank row separates minions
+                rows = self._measure_minion(self.minions[minion_id], minion_id,
+                                            self.selected == minion_id, now) + 1
+                if rows != self._rows[minion_id]:
+                    self._rows[minion_id] = rows
+                    moved_from = min(moved_from, minion_id)
+
+            offsets = []
             row = 0
-            for minion_id, minion in enumerate(self.model.minions_list()):
-                num_rows = self._render_minion(minion, minion_id, row, self.selected == minion_id,
-                                               now)
-                if self.selected == minion_id and self.minions_ui[minion_id]['jump_to']:
-                    self.minions_ui[minion_id]['row'] = row
-                    self.minions_ui[minion_id]['lines'] = num_rows
-
-                self.screen.clear_row(row + num_rows)
-                row += num_rows + 1
-
-            for minion in self.minions_ui.values():
-                if minion['jump_to']:
-                    minion['jump_to'] = False
-                    self.screen.make_visible(minion['row'], minion['lines'])
+            for minion_id, rows in enumerate(self._rows):
+                offsets.append(row)
+                if self.minions_ui[minion_id]['jump_to']:
+                    self.minions_ui[minion_id]['jump_to'] = False
+                    self.screen.make_visible(row, rows - 1)
+                row += rows
+            self.screen.body_rows = max(row - 1, 0)
+            window_moved = self.screen.update_window()
+
+            # only the minions in the pad window are rendered, and only if they changed,
+            # were moved, or are running (which show timers and a loading animation)
+            minions_rendered = 0
+            for minion_id, minion in enumerate(self.minions):
+                row, rows = offsets[minion_id], self._rows[minion_id]
+                if not self.screen.in_window(row, rows):
+                    continue
+                if window_moved or minion_id in dirty or minion_id >= moved_from \
+                        or not minion.finished():
+                    self.screen.clear_rows(row, rows)
+                    self._render_minion(minion, minion_id, row, self.selected == minion_id, now)
+                    minions_rendered += 1
+            if moved_from < len(self.minions):
+                # rows that are no longer used
+                self.screen.clear_rows(self.screen.body_rows + 1, self.screen.num_rows)
 
             self.screen.refresh()
+            self._update_frame_stats(time.monotonic() - start_time, minions_rendered)
+
+    def _update_frame_stats(self, frame_time, minions_rendered):
+        stats = self._frame_stats
+        stats['frames'] += 1
+        stats['time'] += frame_time
+        stats['max_time'] = max(stats['max_time'], frame_time)
+        stats['minions_rendered'] += minions_rendered
+        if stats['frames'] % self.FRAME_STATS_INTERVAL == 0:
+            self._log_frame_stats()
+
+    def _log_frame_stats(self):
+        stats = self._frame_stats
+        if stats['frames'] == 0:
+            return
+        logger.debug("rendered %s frames: avg_time=%.2fms max_time=%.2fms "
+                     "avg_minions_rendered=%.1f/%s", stats['frames'],
+                     stats['time'] * 1000 / stats['frames'], stats['max_time'] * 1000,
+                     stats['minions_rendered'] / stats['frames'], len(self.minions))
 
     def _is_minion_expanded(self, idx):
         return self.minions_ui[idx]['expanded']
@@ -1147,7 +1368,9 @@ class CursesRenderer(Renderer, ScreenKeyListener):
             self.selected = 0
         else:
             if self.selected > 0:
+                self._mark_dirty(self.selected)
                 self.selected -= 1
+        self._mark_dirty(self.selected)
         self.minions_ui[self.selected]['jump_to'] = True
 
     def down_key(self):
@@ -1155,7 +1378,9 @@ class CursesRenderer(Renderer, ScreenKeyListener):
             self.selected = 0
         else:
             if self.selected + 1 < self.model.minions_total():
+                self._mark_dirty(self.selected)
                 self.selected += 1
+        self._mark_dirty(self.selected)
         self.minions_ui[self.selected]['jump_to'] = True
 
     def action_key(self):
@@ -1163,6 +1388,7 @@ class CursesRenderer(Renderer, ScreenKeyListener):
             return
         self.minions_ui[self.selected]['expanded'] = not self.minions_ui[self.selected]['expanded']
         self.minions_ui[self.selected]['jump_to'] = True
+        self._mark_dirty(self.selected)
 
     def quit_key(self):
         if self.model.finished():
@@ -1184,6 +1410,7 @@ class CursesRenderer(Renderer, ScreenKeyListener):
         all_collap = self._all_collapsed()
         for minion in self.minions_ui.values():
             minion['expanded'] = all_collap
+        self._mark_dirty(*self.minions_ui)
 
     @staticmethod
     def ftime(tr):
@@ -1194,11 +1421,13 @@ class CursesRenderer(Renderer, ScreenKeyListener):
     def execution_stopped(self):
         pass
 
+    def minion_update(self, minion: str):
+        self._mark_dirty(self._minion_ids[minion])
+
     def minion_failure(self, minion: str, failure: dict):
-        for minion_ui in self.minions_ui.values():
-            if minion_ui['minion'] == minion:
-                minion_ui['expanded'] = True
-                break
+        minion_id = self._minion_ids[minion]
+        self.minions_ui[minion_id]['expanded'] = True
+        self._mark_dirty(minion_id)
 
     def run(self):
         self.loading.start()
@@ -1221,6 +1450,7 @@ class CursesRenderer(Renderer, ScreenKeyListener):
                         paused = True
                     self._update_screen()
             logger.info("finished render loop")
+            self._log_frame_stats()
         except Exception as ex:  # pylint: disable=broad-except
             logger.exception(ex)
             has_failed = True
@@ -1292,9 +1522,55 @@ class TerminalRenderer(Renderer):
                            self.model.minions_failed()))
 
 
+class PreflightChecks:
+    """
+    Runs checks concurrently, each one as soon as the checks it depends on succeeded.
+    The output of the checks is printed in the order they were added, up to the first
+    failing check, whose return code is returned, just like if they ran sequentially.
+    """
+    def __init__(self):
+        self._checks = OrderedDict()
+
+    def add(self, name, func, depends=None):
+        """
+        :param func: function returning the check return code (0 on success)
+        :param depends: names of previously added checks that must succeed before this one
+        """
+        self._checks[name] = (func, depends or [])
+
+    @staticmethod
+    def _run_check(func, depends):
+        for future in depends:
+            if future.result()[0] != 0:
+                return None, [], None
+        with PP.capture() as output:
+            try:
+                return func(), output, None
+            except Exception as ex:  # pylint: disable=broad-except
+                return None, output, ex
+
+    def run(self):
+        futures = OrderedDict()
+        with ThreadPoolExecutor(max_workers=max(len(self._checks), 1)) as executor:
+            for name, (func, depends) in self._checks.items():
+                futures[name] = executor.submit(self._run_check, func,
+                                                [futures[dep] for dep in depends])
+        for name, future in futures.items():
+            retcode, output, exception = future.result()
+            for line in output:
+                PP.println(line)
+            if exception is not None:
+                raise exception
+            logger.info("pre-flight check '%s' returned %s", name, retcode)
+            if retcode != 0:
+                return retcode
+        return 0
+
+
 class CephSaltExecutor:
-    def __init__(self, interactive, minion_id, state, pillar, prompt_proceed):
+    def __init__(self, interactive, minion_id, state, pillar, prompt_proceed, journal=None):
         self.prompt_proceed = prompt_proceed
+        self.journal = journal
         self.pillar = pillar
         self.state = state
         self.minion_id = minion_id
@@ -1306,11 +1582,37 @@ class CephSaltExecutor:
         self.executor = None
 
     @staticmethod
-    def check_formula(state, prompt_proceed):
+    def probe_minions(state):
+        """
+        Runs all the minion probes needed by the pre-flight checks in a single
+        'ceph_salt.preflight' job.
+        :return: 'ceph_salt.preflight' returns by minion, or None if the probe is not
+                 available on all minions, in which case each check runs its own job
+        """
+        minion_hostnames = PillarManager.get('ceph-salt:minions:all', [])
+        PP.println("Probing {} minions...".format(len(minion_hostnames)))
+        result = SaltClient.local_cmd('ceph-salt:member', 'ceph_salt.preflight',
+                                      [state, minion_hostnames], tgt_type='grain')
+        for minion, ret in result.items():
+            if not isinstance(ret, dict):
+                logger.warning("ceph_salt.preflight not available on %s: %s", minion, ret)
+                return None
+            logger.info("ceph_salt.preflight timings on %s: %s", minion, ret.get('timings'))
+        return result
+
+    @staticmethod
+    def _probe_values(probe, key):
+        return {minion: ret.get(key) for minion, ret in probe.items()}
+
+    @staticmethod
+    def check_formula(state, prompt_proceed, probe=None):
         # verify that ceph-salt formula is available
         PP.println("Checking if {} formula is available...".format(state))
-        result = SaltClient.local_cmd('ceph-salt:member', 'state.sls_exists', [state],
-                                      tgt_type='grain')
+        if probe is None:
+            result = SaltClient.local_cmd('ceph-salt:member', 'state.sls_exists', [state],
+                                          tgt_type='grain')
+        else:
+            result = CephSaltExecutor._probe_values(probe, 'sls_exists')
         if not all(result.values()):
             # check running jobs
             logger.error("%s formula not found: checking for running Salt jobs", state)
@@ -1331,15 +1633,18 @@ class CephSaltExecutor:
                 logger.warning('failed to restart salt-master process')
                 PP.pl_red('Failed to restart salt-master service, please restart it manually')
                 return 6
-
-        # check ceph-salt formula again after salt-master restart
-        result = SaltClient.local_cmd('ceph-salt:member', 'state.sls_exists', [state],
-                                      tgt_type='grain')
-        if not all(result.values()):
-            PP.pl_red("Unable to use {state} formula. Please check if ceph-salt-formula "
-                      "package is installed. For more information try running "
-                      "`salt -G ceph-salt:member state.show_sls {state}`".format(state=state))
-            return 7
+            # pooled clients are bound to the old 'salt-master' process
+            SaltClient.invalidate()
+
+            # check ceph-salt formula again after salt-master restart
+            result = SaltClient.local_cmd('ceph-salt:member', 'state.sls_exists', [state],
+                                          tgt_type='grain')
+            if not all(result.values()):
+                PP.pl_red("Unable to use {state} formula. Please check if ceph-salt-formula "
+                          "package is installed. For more information try running "
+                          "`salt -G ceph-salt:member state.show_sls {state}`"
+                          .format(state=state))
+                return 7
 
         return 0
 
@@ -1380,13 +1685,17 @@ class CephSaltExecutor:
         return 0
 
     @staticmethod
-    def ping_minions():
+    def ping_minions(probe=None):
         # verify that all minions are alive
         PP.println("Checking if minions respond to ping...")
         all_minions = PillarManager.get('ceph-salt:minions:all', [])
         minion_count = len(all_minions)
         PP.println("Pinging {} minions...".format(minion_count))
-        result = SaltClient.local_cmd('ceph-salt:member', 'test.ping', tgt_type='grain')
+        if probe is None:
+            result = SaltClient.local_cmd('ceph-salt:member', 'test.ping', tgt_type='grain')
+        else:
+            # minions that returned the probe are alive
+            result = {minion: True for minion in probe}
         # result will be something like {'node3.ses7.test': True, 'master.ses7.test': True,
         # 'node2.ses7.test': True, 'node1.ses7.test': True}
         minions_responding = 0
@@ -1405,55 +1714,70 @@ class CephSaltExecutor:
         return retval
 
     @staticmethod
-    def check_dns():
+    def check_dns(probe=None):
         retval = None
         PP.println("Checking if minions have functioning DNS...")
         minion_hostnames = PillarManager.get('ceph-salt:minions:all', [])
         minion_count = len(minion_hostnames)
         PP.println("Running DNS lookups on {} minions...".format(minion_count))
-        salt_result = SaltClient.local().cmd(
-            'ceph-salt:member',
-            'ceph_salt.probe_dns',
-            minion_hostnames,
-            tgt_type='grain')
+        if probe is None:
+            salt_result = SaltClient.local().cmd(
+                'ceph-salt:member',
+                'ceph_salt.probe_dns',
+                minion_hostnames,
+                tgt_type='grain')
+        else:
+            salt_result = CephSaltExecutor._probe_values(probe, 'dns')
         log_msg = "probe_dns returned: {}".format(salt_result)
         logger.info(log_msg)
-        if all(salt_result.values()):
+        # older formulas return a bool instead of a dict
+        bad_dns = {}
+        for hostname, result in sorted(salt_result.items()):
+            if isinstance(result, dict):
+                if result.get('ok'):
+                    continue
+                bad_dns[hostname] = result.get('unresolvable', [])
+            elif not result:
+                bad_dns[hostname] = []
+        if not bad_dns:
             logger.info("All minion hostnames are resolvable on all minions")
             retval = 0
         else:
-            bad_dns_list = []
-            for hostname, result in salt_result.items():
-                if result:
-                    log_msg = ("All minion hostnames are resolvable on host {}"
-                               .format(hostname))
-                    logger.info(log_msg)
-                else:
-                    log_msg = ("All minion hostnames are NOT resolvable on host {}"
-                               .format(hostname))
-                    logger.error(log_msg)
-                    bad_dns_list.append(hostname)
-            PP.pl_red("DNS issues detected on host(s) {}".format(", ".join(bad_dns_list)))
+            for hostname, unresolvable in bad_dns.items():
+                log_msg = ("All minion hostnames are NOT resolvable on host {}"
+                           .format(hostname))
+                logger.error(log_msg)
+            PP.pl_red("DNS issues detected on host(s) {}".format(", ".join(bad_dns)))
+            for hostname, unresolvable in bad_dns.items():
+                if unresolvable:
+                    PP.pl_red("  {} cannot resolve: {}".format(hostname,
+                                                               ", ".join(unresolvable)))
             PP.pl_red("One or more minions cannot resolve the fully-qualified hostnames "
                       "of other minions. Please fix this issue and try again.")
             retval = 8
         return retval
 
     @staticmethod
-    def check_time_sync():
+    def check_time_sync(probe=None):
         retval = None
         PP.println("/time_server is disabled. Will check if minions have a time_sync "
                    "service enabled and running...")
         minion_hostnames = PillarManager.get('ceph-salt:minions:all', [])
         minion_count = len(minion_hostnames)
         PP.println("Checking time sync service on {} minions...".format(minion_count))
-        salt_result = SaltClient.local().cmd(
-            'ceph-salt:member',
-            'ceph_salt.probe_time_sync',
-            [],
-            tgt_type='grain')
+        if probe is None:
+            salt_result = SaltClient.local().cmd(
+                'ceph-salt:member',
+                'ceph_salt.probe_time_sync',
+                [],
+                tgt_type='grain')
+        else:
+            salt_result = CephSaltExecutor._probe_values(probe, 'time_sync')
         log_msg = "probe_time_sync returned: {}".format(salt_result)
         logger.info(log_msg)
+        # older formulas return a bool instead of a dict
+        salt_result = {hostname: result.get('ok') if isinstance(result, dict) else result
+                       for hostname, result in salt_result.items()}
         if all(salt_result.values()):
             logger.info("Time sync service is enabled and running on all minions")
             retval = 0
@@ -1522,7 +1846,7 @@ class CephSaltExecutor:
         return 0
 
     @staticmethod
-    def check_fqdn():
+    def check_fqdn(probe=None):
         """
         Check all minions for FQDN environment. Either all must be FQDN or all
         must be non-FQDN. Mixed FQDN/non-FQDN is not supported.
@@ -1543,11 +1867,14 @@ class CephSaltExecutor:
         minion_hostnames = PillarManager.get('ceph-salt:minions:all', [])
         minion_count = len(minion_hostnames)
         PP.println("Checking for FQDN environment on {} minions...".format(minion_count))
-        salt_result = SaltClient.local().cmd(
-            'ceph-salt:member',
-            'ceph_salt.probe_fqdn',
-            [],
-            tgt_type='grain')
+        if probe is None:
+            salt_result = SaltClient.local().cmd(
+                'ceph-salt:member',
+                'ceph_salt.probe_fqdn',
+                [],
+                tgt_type='grain')
+        else:
+            salt_result = CephSaltExecutor._probe_values(probe, 'fqdn')
         log_msg = "probe_fqdn returned: {}".format(salt_result)
         logger.info(log_msg)
         if __all_yes(salt_result.values()):
@@ -1564,80 +1891,84 @@ class CephSaltExecutor:
         PP.pl_red('Mixed FQDN/non-FQDN environment detected. Bailing out!')
         return 15
 
+    @staticmethod
+    def check_time_servers(state, probe=None):
+        if state not in ['ceph-salt', 'ceph-salt.apply']:
+            return 0
+        # check external time servers, if any
+        time_server_enabled = PillarManager.get('ceph-salt:time_server:enabled')
+        if time_server_enabled:
+            time_server_hosts = PillarManager.get('ceph-salt:time_server:server_hosts')
+            ext_time_servers = PillarManager.get('ceph-salt:time_server:external_time_servers')
+            if ext_time_servers:
+                return CephSaltExecutor.check_external_time_servers(
+                    time_server_hosts,
+                    ext_time_servers
+                )
+            return 0
+        return CephSaltExecutor.check_time_sync(probe)
+
     @staticmethod
     def check_prerequisites(minion_id, state, prompt_proceed):
-        deployed = None
+        """
+        Independent checks run concurrently, but the output and the return code are
+        the same as if the checks ran in the order they are added.
+        """
+        result = {'deployed': None, 'probe': None}
+
+        def _check_salt_master():
+            try:
+                check_salt_master_status()
+            except ValidationException as e:
+                logger.error(e)
+                PP.pl_red(e)
+                return 1
+            return 0
 
-        # check salt master is configured
-        try:
-            check_salt_master_status()
-        except ValidationException as e:
-            logger.error(e)
-            PP.pl_red(e)
-            return 1, deployed
+        def _check_config():
+            result['deployed'] = CephOrch.deployed()
+            all = PillarManager.get('ceph-salt:minions:all', [])
+            nodes = CephNodeManager.prefetch(all, ['ipsv4', 'ipsv6'])
+            error_msg = validate_config(result['deployed'], nodes)
+            if error_msg:
+                logger.error(error_msg)
+                PP.pl_red(error_msg)
+                return 3
+            return 0
 
-        # sync_all
-        retcode = CephSaltExecutor.check_sync_all()
-        if retcode > 0:
-            return retcode, deployed
-
-        deployed = CephOrch.deployed()
-
-        # check config is valid
-        all = PillarManager.get('ceph-salt:minions:all', [])
-        nodes = {}
-        for minion in all:
-            nodes[minion] = CephNode(minion)
-        error_msg = validate_config(deployed, nodes)
-        if error_msg:
-            logger.error(error_msg)
-            PP.pl_red(error_msg)
-            return 3, deployed
-
-        # ping minions
-        retcode = CephSaltExecutor.ping_minions()
-        if retcode > 0:
-            return retcode, deployed
+        def _probe():
+            result['probe'] = CephSaltExecutor.probe_minions(state)
+            return 0
 
-        # check formula
-        retcode = CephSaltExecutor.check_formula(state, prompt_proceed)
+        def _check_cluster():
+            if state in ['ceph-salt.purge']:
+                return 0
+            return CephSaltExecutor.check_cluster(state, minion_id, result['deployed'])
+
+        checks = PreflightChecks()
+        checks.add('salt_master', _check_salt_master)
+        checks.add('sync_all', CephSaltExecutor.check_sync_all, ['salt_master'])
+        checks.add('config', _check_config, ['sync_all'])
+        # 'ceph_salt.preflight' is only available once modules are synced
+        checks.add('probe', _probe, ['sync_all'])
+        checks.add('ping', lambda: CephSaltExecutor.ping_minions(result['probe']), ['probe'])
+        retcode = checks.run()
         if retcode > 0:
-            return retcode, deployed
+            return retcode, result['deployed']
 
-        # check dns
-        retcode = CephSaltExecutor.check_dns()
+        # may prompt the user, so it doesn't run concurrently with other checks
+        retcode = CephSaltExecutor.check_formula(state, prompt_proceed, result['probe'])
         if retcode > 0:
-            return retcode, deployed
-
-        # check cluster
-        if state not in ['ceph-salt.purge']:
-            retcode = CephSaltExecutor.check_cluster(state, minion_id, deployed)
-            if retcode > 0:
-                return retcode, deployed
-
-        # check external time servers, if any
-        if state in ['ceph-salt', 'ceph-salt.apply']:
-            time_server_enabled = PillarManager.get('ceph-salt:time_server:enabled')
-            if time_server_enabled:
-                time_server_hosts = PillarManager.get('ceph-salt:time_server:server_hosts')
-                ext_time_servers = PillarManager.get('ceph-salt:time_server:external_time_servers')
-                if ext_time_servers:
-                    retcode = CephSaltExecutor.check_external_time_servers(
-                        time_server_hosts,
-                        ext_time_servers
-                    )
-                    if retcode > 0:
-                        return retcode, deployed
-            else:
-                retcode = CephSaltExecutor.check_time_sync()
-                if retcode > 0:
-                    return retcode, deployed
+            return retcode, result['deployed']
 
-        # check FQDN
-        retcode = CephSaltExecutor.check_fqdn()
-        if retcode > 0:
-            return retcode, deployed
-        return 0, deployed
+        checks = PreflightChecks()
+        checks.add('dns', lambda: CephSaltExecutor.check_dns(result['probe']))
+        checks.add('cluster', _check_cluster)
+        checks.add('time_servers',
+                   lambda: CephSaltExecutor.check_time_servers(state, result['probe']))
+        checks.add('fqdn', lambda: CephSaltExecutor.check_fqdn(result['probe']))
+        retcode = checks.run()
+        return retcode, result['deployed']
 
     def run(self):
 
@@ -1681,7 +2012,11 @@ class CephSaltExecutor:
         else:
             self.renderer = TerminalRenderer(self.model)
         self.controller = CephSaltController(self.model, self.renderer)
-        self.event_proc = SaltEventProcessor(self.model.minions_names())
+        journal = None
+        if self.journal:
+            journal = EventJournal(self.journal, minion_id=self.minion_id, state=self.state,
+                                   minions=sorted(self.model.minions_names()))
+        self.event_proc = SaltEventProcessor(self.model.minions_names(), journal)
         self.event_proc.add_listener(self.controller)
         self.executor = CephSaltExecutorThread(self.controller, self.minion_id)
 
@@ -1695,8 +2030,38 @@ class CephSaltExecutor:
         return self.controller.retcode
 
 
+def run_replay(journal_file, interactive, speed):
+    """
+    Feeds the events of a journal recorded by ``SaltEventProcessor`` through the
+    same model, controller and renderer used by ``CephSaltExecutor``, without
+    calling Salt.
+    """
+    metadata, events = EventJournal.load(journal_file)
+    model = CephSaltModel(metadata.get('minion_id'), metadata.get('state'), {},
+                          metadata.get('minions', []))
+    if interactive:
+        renderer = CursesRenderer(model)
+    else:
+        renderer = TerminalRenderer(model)
+    controller = ReplayController(model, renderer)
+    event_proc = SaltEventProcessor(model.minions_names())
+    event_proc.add_listener(controller)
+    replay = CephSaltReplayThread(controller, event_proc, events, speed)
+
+    start = time.time()
+    replay.start()
+    renderer.run()
+    replay.stop()
+    replay.join()
+    logger.info("Replayed %s events of '%s' in %.3fs: %s", len(events), journal_file,
+                time.time() - start, event_proc.stats)
+    return controller.retcode
+
+
 def run_disengage_safety():
     PillarManager.set('ceph-salt:execution:safety_disengage_time', time.time())
+    # 'ceph_salt.is_safety_disengaged' reads the minions' in-memory pillar
+    PillarManager.wait_for_refresh()
     return 0
 
 
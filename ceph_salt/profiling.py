@@ -0,0 +1,242 @@
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+from .salt_utils import GrainsManager, PillarManager, SaltClient
+
+
+logger = logging.getLogger(__name__)
+
+
+Span = collections.namedtuple('Span', ['kind', 'name', 'target', 'tgt_type', 'duration'])
+
+
+class _ProfiledLocalClient:
+    """
+    Salt 'LocalClient' wrapper that records a span per job
+    """
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def cmd(self, target, func, *args, **kwargs):
+        with SaltProfiler.span('salt', func, target, kwargs.get('tgt_type', 'glob')):
+            return self._client.cmd(target, func, *args, **kwargs)
+
+    def cmd_async(self, target, func, *args, **kwargs):
+        with SaltProfiler.span('salt', func, target, kwargs.get('tgt_type', 'glob')):
+            return self._client.cmd_async(target, func, *args, **kwargs)
+
+    def cmd_iter(self, target, func, *args, **kwargs):
+        # the job runs while the returns are iterated
+        with SaltProfiler.span('salt', func, target, kwargs.get('tgt_type', 'glob')):
+            for ret in self._client.cmd_iter(target, func, *args, **kwargs):
+                yield ret
+
+
+class _ProfiledCaller:
+    """
+    Salt 'Caller' wrapper that records a span per call
+    """
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def cmd(self, func, *args, **kwargs):
+        with SaltProfiler.span('salt', func, 'master', 'caller'):
+            return self._client.cmd(func, *args, **kwargs)
+
+
+class SaltProfiler:
+    """
+    Records the time spent in Salt jobs, `GrainsManager` calls and pillar YAML
+    serialization and parsing, and reports it by Salt function, target type and
+    minion.
+    """
+    GRAINS_METHODS = ['set_grain', 'del_grain', 'bulk_set_grain', 'bulk_del_grain', 'filter_by',
+                      'get_grain', 'get_grains']
+    YAML_METHODS = {'_load_yaml': 'parse', '_save_yaml': 'serialize'}
+
+    _spans = []
+    _lock = threading.Lock()
+    _originals = []
+    _start = None
+
+    @classmethod
+    def enabled(cls):
+        return bool(cls._originals)
+
+    @classmethod
+    def _patch(cls, klass, name, wrapper):
+        original = klass.__dict__[name]
+        cls._originals.append((klass, name, original))
+        setattr(klass, name, wrapper(original))
+
+    @classmethod
+    def enable(cls):
+        if cls.enabled():
+            return
+        cls.reset()
+
+        def _client(original, proxy):
+            @classmethod
+            @functools.wraps(original.__func__)
+            def _wrapper(klass, *args, **kwargs):
+                return proxy(original.__func__(klass, *args, **kwargs))
+            return _wrapper
+
+        cls._patch(SaltClient, 'local', lambda orig: _client(orig, _ProfiledLocalClient))
+        cls._patch(SaltClient, 'caller', lambda orig: _client(orig, _ProfiledCaller))
+
+        def _grains(name):
+            def _wrap(original):
+                @classmethod
+                @functools.wraps(original.__func__)
+                def _wrapper(klass, *args, **kwargs):
+                    target = args[0] if args and name != 'filter_by' else None
+                    with cls.span('grains', 'GrainsManager.{}'.format(name), target):
+                        return original.__func__(klass, *args, **kwargs)
+                return _wrapper
+            return _wrap
+
+        for name in cls.GRAINS_METHODS:
+            cls._patch(GrainsManager, name, _grains(name))
+
+        def _yaml(op):
+            def _wrap(original):
+                func = original.__func__
+                if isinstance(original, staticmethod):
+                    @staticmethod
+                    @functools.wraps(func)
+                    def _static_wrapper(*args, **kwargs):
+                        with cls.span('yaml', op):
+                            return func(*args, **kwargs)
+                    return _static_wrapper
+
+                @classmethod
+                @functools.wraps(func)
+                def _wrapper(klass, *args, **kwargs):
+                    with cls.span('yaml', op):
+                        return func(klass, *args, **kwargs)
+                return _wrapper
+            return _wrap
+
+        for name, op in cls.YAML_METHODS.items():
+            cls._patch(PillarManager, name, _yaml(op))
+        logger.info("Salt call profiling enabled")
+
+    @classmethod
+    def disable(cls):
+        while cls._originals:
+            klass, name, original = cls._originals.pop()
+            setattr(klass, name, original)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._spans = []
+            cls._start = time.monotonic()
+
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, kind, name, target=None, tgt_type=None):
+        """
+        Records the duration of the block
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            span = Span(kind, name, target, tgt_type, time.monotonic() - start)
+            with cls._lock:
+                cls._spans.append(span)
+
+    @classmethod
+    def spans(cls, kind=None):
+        with cls._lock:
+            return [s for s in cls._spans if kind is None or s.kind == kind]
+
+    @staticmethod
+    def _minions(span):
+        if span.tgt_type == 'list':
+            return list(span.target)
+        if span.tgt_type in ('glob', None) and isinstance(span.target, str) \
+                and not any(c in span.target for c in '*?[]'):
+            return [span.target]
+        return []
+
+    @staticmethod
+    def _table(title, rows, top=None):
+        """
+        :param rows: dict of [calls, total time, max time] by key
+        """
+        lines = ['{}:'.format(title),
+                 '  {:>6} {:>10} {:>10}  {}'.format('calls', 'total(s)', 'max(s)', 'name')]
+        ordered = sorted(rows.items(), key=lambda item: item[1][1], reverse=True)
+        if top is not None:
+            ordered = ordered[:top]
+        for key, (calls, total, longest) in ordered:
+            lines.append('  {:>6} {:>10.3f} {:>10.3f}  {}'.format(calls, total, longest, key))
+        return lines
+
+    @staticmethod
+    def _add(rows, key, duration):
+        row = rows.setdefault(key, [0, 0.0, 0.0])
+        row[0] += 1
+        row[1] += duration
+        row[2] = max(row[2], duration)
+
+    @classmethod
+    def report(cls, top=10):
+        """
+        Returns the profile report as text
+        """
+        salt_spans = cls.spans('salt')
+        by_func = {}
+        by_tgt_type = {}
+        by_minion = {}
+        for span in salt_spans:
+            cls._add(by_func, span.name, span.duration)
+            cls._add(by_tgt_type, span.tgt_type, span.duration)
+            for minion in cls._minions(span):
+                cls._add(by_minion, minion, span.duration)
+        by_grains = {}
+        for span in cls.spans('grains'):
+            cls._add(by_grains, span.name, span.duration)
+        by_yaml = {}
+        for span in cls.spans('yaml'):
+            cls._add(by_yaml, span.name, span.duration)
+
+        elapsed = time.monotonic() - cls._start if cls._start is not None else 0.0
+        lines = ['ceph-salt profile: {:.3f}s elapsed, {} Salt calls in {:.3f}s'.format(
+            elapsed, len(salt_spans), sum(s.duration for s in salt_spans)), '']
+        lines.extend(cls._table('Salt functions', by_func))
+        lines.append('')
+        lines.extend(cls._table('Target types', by_tgt_type))
+        lines.append('')
+        lines.extend(cls._table('Minions (top {})'.format(top), by_minion, top))
+        lines.append('')
+        lines.append('Slowest Salt calls (top {}):'.format(top))
+        for span in sorted(salt_spans, key=lambda s: s.duration, reverse=True)[:top]:
+            target = span.target
+            if span.tgt_type == 'list':
+                target = '{} minions'.format(len(span.target))
+            lines.append('  {:>10.3f}  {} {} ({})'.format(
+                span.duration, span.name, target, span.tgt_type))
+        lines.append('')
+        lines.extend(cls._table('GrainsManager', by_grains))
+        lines.append('')
+        lines.extend(cls._table('Pillar YAML', by_yaml))
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def write_report(cls, stream):
+        stream.write(cls.report())
+        stream.flush()
@@ -1,7 +1,10 @@
 import datetime
-import fnmatch
+import json
 import logging
+import queue
+import re
 import threading
+import time
 
 import salt.config
 import salt.utils.event
@@ -49,6 +52,19 @@ class CephSaltEvent(SaltEvent):
         return '{} {}'.format(super().__str__(), self.desc)
 
 
+class GrainSetEvent(SaltEvent):
+    """
+    Event sent by a minion after setting a ceph-salt execution grain
+    """
+    def __init__(self, raw_event):
+        super().__init__(raw_event)
+        self.grain = raw_event['data']['data']['grain']
+        self.value = raw_event['data']['data']['value']
+
+    def __str__(self):
+        return '{} {}={}'.format(super().__str__(), self.grain, self.value)
+
+
 class EventListener:
     """
     This class represents a listener object that listens to particular Salt events.
@@ -96,6 +112,12 @@ class EventListener:
             event (CephSaltEvent): the salt event
         """
 
+    def handle_grain_set(self, event: GrainSetEvent):
+        """Handle grain set ceph-salt event
+        Args:
+            event (GrainSetEvent): the salt event
+        """
+
     def handle_minion_start(self, event: SaltEvent):
         """Handle minion_start salt event
         Args:
@@ -109,17 +131,103 @@ class EventListener:
         """
 
 
+class EventJournal:
+    """
+    Append-only journal, in JSON lines format, of the events dispatched by a
+    ``SaltEventProcessor``.
+
+    The first line holds the journal metadata (e.g. the minions of the execution),
+    and each of the following lines an event and the time it was received:
+    {"time": 1600000000.0, "tag": "ceph-salt/stage/begin", "data": {...}}
+    """
+    def __init__(self, path, **metadata):
+        self.path = path
+        self.metadata = metadata
+        self._file = None
+
+    def open(self):
+        self._file = open(self.path, 'w')
+        self._write(self.metadata)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, event):
+        self._write({'time': time.time(), 'tag': event['tag'], 'data': event['data']})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':'), default=str))
+        self._file.write('\n')
+        self._file.flush()
+
+    @staticmethod
+    def load(path):
+        """Loads a journal
+
+        Args:
+            path (str): the journal file path
+
+        Returns:
+            tuple: (metadata, list of event records)
+        """
+        events = []
+        with open(path, 'r') as journal_file:
+            metadata = json.loads(journal_file.readline())
+            for num, line in enumerate(journal_file, 2):
+                if not line.strip():
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # e.g. the last line of a journal whose writer was killed
+                    logger.warning("Skipping invalid line %s of journal '%s'", num, path)
+        return metadata, events
+
+
 class SaltEventProcessor(threading.Thread):
     """
     This class implements an execution loop to listen for the Salt event BUS.
     """
-    def __init__(self, minions):
+    # event wrapper class and listener handlers of each ceph-salt event tag
+    TAG_HANDLERS = {
+        'ceph-salt/grain/set': (GrainSetEvent, ['handle_grain_set']),
+        'ceph-salt/stage/begin': (CephSaltEvent, ['handle_ceph_salt_event',
+                                                  'handle_begin_stage']),
+        'ceph-salt/stage/end': (CephSaltEvent, ['handle_ceph_salt_event',
+                                                'handle_end_stage']),
+        'ceph-salt/stage/warning': (CephSaltEvent, ['handle_ceph_salt_event',
+                                                    'handle_warning_stage']),
+        'ceph-salt/step/begin': (CephSaltEvent, ['handle_ceph_salt_event',
+                                                 'handle_begin_step']),
+        'ceph-salt/step/end': (CephSaltEvent, ['handle_ceph_salt_event',
+                                               'handle_end_step']),
+        'ceph-salt/minion_reboot': (CephSaltEvent, ['handle_ceph_salt_event',
+                                                    'handle_minion_reboot']),
+        'minion_start': (SaltEvent, ['handle_minion_start']),
+    }
+    # any other 'ceph-salt/*' event
+    CEPH_SALT_TAG_PREFIX = 'ceph-salt/'
+    CEPH_SALT_HANDLERS = (CephSaltEvent, ['handle_ceph_salt_event'])
+    # 'salt/job/<jid>/ret/<minion>' event
+    JOB_RET_TAG_RE = re.compile(r'^salt/job/[^/]+/ret/')
+    STATE_APPLY_RET_HANDLERS = (JobRetEvent, ['handle_state_apply_return'])
+    # maximum number of received events waiting to be dispatched to listeners
+    QUEUE_SIZE = 1000
+
+    def __init__(self, minions, journal: EventJournal = None):
         super(SaltEventProcessor, self).__init__()
         self.running = False
         self.listeners = []
         self.io_loop = None
         self.event = threading.Event()
-        self.minions = minions
+        self.minions = set(minions)
+        self.stats = {'seen': 0, 'dispatched': 0, 'dropped': 0, 'filtered': 0,
+                      'queue_max': 0}
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.dispatcher = None
+        self.journal = journal
 
     def add_listener(self, listener):
         """Adds an event listener to the listener list
@@ -136,6 +244,10 @@ class SaltEventProcessor(threading.Thread):
 
     def start(self):
         self.running = True
+        if self.journal is not None:
+            self.journal.open()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
         super(SaltEventProcessor, self).start()
         self.event.wait()
 
@@ -158,14 +270,93 @@ class SaltEventProcessor(threading.Thread):
         """
         self.running = False
         self.io_loop.stop()
+        # wake up the dispatcher
+        self.queue.put(None)
+        self.dispatcher.join()
+        if self.journal is not None:
+            self.journal.close()
         self.listeners.clear()
+        logger.info("Salt events: %s filtered, %s seen, %s dispatched, %s dropped, "
+                    "max queue depth %s", self.stats['filtered'], self.stats['seen'],
+                    self.stats['dispatched'], self.stats['dropped'], self.stats['queue_max'])
+
+    def process(self, event):
+        """Processes a raw event that was not received from the event bus, e.g. an event
+        loaded from a journal
+
+        Args:
+            event (dict): the raw event data
+        """
+        self._process(event)
+
+    def queue_depth(self):
+        """
+        Gets the number of received events waiting to be dispatched
+        """
+        return self.queue.qsize()
+
+    def _wants_tag(self, tag):
+        return tag in self.TAG_HANDLERS \
+            or tag.startswith(self.CEPH_SALT_TAG_PREFIX) \
+            or self.JOB_RET_TAG_RE.match(tag) is not None
 
     def _handle_event_recv(self, raw):
         """
         Handles the asynchronous reception of raw events
+
+        The Salt master event bus has no server-side subscriptions, so events are
+        filtered by their tag before the event data is deserialized.
+        Events are handed over to the dispatcher thread through a bounded queue: when
+        the queue is full, reading from the event bus waits for the dispatcher.
         """
+        if isinstance(raw, bytes):
+            tag = raw.partition(salt.utils.event.TAGEND.encode())[0]
+            if not self._wants_tag(tag.decode('utf-8', 'replace')):
+                self.stats['filtered'] += 1
+                return
         mtag, data = salt.utils.event.SaltEvent.unpack(raw)
-        self._process({'tag': mtag, 'data': data})
+        while self.running:
+            try:
+                self.queue.put({'tag': mtag, 'data': data}, timeout=0.5)
+                break
+            except queue.Full:
+                logger.warning("Salt event queue is full (%s events)", self.QUEUE_SIZE)
+        self.stats['queue_max'] = max(self.stats['queue_max'], self.queue.qsize())
+
+    def _dispatch(self):
+        """
+        Dispatches queued events to listeners, until 'None' is queued
+        """
+        while True:
+            event = self.queue.get()
+            try:
+                if event is None:
+                    return
+                self._process(event)
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.exception(ex)
+            finally:
+                self.queue.task_done()
+
+    def _route(self, event):
+        """Finds the wrapper class and the listener handlers of an event
+
+        Args:
+            event (dict): the raw event data
+
+        Returns:
+            tuple: (wrapper class, handler names), or None if the event is not handled
+        """
+        tag = event['tag']
+        handlers = self.TAG_HANDLERS.get(tag)
+        if handlers is not None:
+            return handlers
+        if tag.startswith(self.CEPH_SALT_TAG_PREFIX):
+            return self.CEPH_SALT_HANDLERS
+        if self.JOB_RET_TAG_RE.match(tag):
+            if event['data'].get('fun') == 'state.apply':
+                return self.STATE_APPLY_RET_HANDLERS
+        return None
 
     def _process(self, event):
         """Processes a raw event
@@ -175,35 +366,17 @@ class SaltEventProcessor(threading.Thread):
         Args:
             event (dict): the raw event data
         """
+        self.stats['seen'] += 1
+        route = self._route(event)
+        if route is None or event['data'].get('id') not in self.minions:
+            self.stats['dropped'] += 1
+            return
         logger.debug("Process event -> %s", event)
-        wrapper = None
-        if fnmatch.fnmatch(event['tag'], 'ceph-salt/*'):
-            wrapper = CephSaltEvent(event)
-        elif event['tag'] == 'minion_start':
-            wrapper = SaltEvent(event)
-        elif fnmatch.fnmatch(event['tag'], 'salt/job/*/ret/*'):
-            if event['data'].get('fun') == 'state.apply':
-                wrapper = JobRetEvent(event)
-        if wrapper:
-            if wrapper.minion not in self.minions:
-                return
-            for listener in self.listeners:
-                if fnmatch.fnmatch(event['tag'], 'ceph-salt/*'):
-                    listener.handle_ceph_salt_event(wrapper)
-                    if event['tag'] == 'ceph-salt/stage/begin':
-                        listener.handle_begin_stage(wrapper)
-                    elif event['tag'] == 'ceph-salt/stage/end':
-                        listener.handle_end_stage(wrapper)
-                    elif event['tag'] == 'ceph-salt/step/begin':
-                        listener.handle_begin_step(wrapper)
-                    elif event['tag'] == 'ceph-salt/step/end':
-                        listener.handle_end_step(wrapper)
-                    elif event['tag'] == 'ceph-salt/minion_reboot':
-                        listener.handle_minion_reboot(wrapper)
-                    elif event['tag'] == 'ceph-salt/stage/warning':
-                        listener.handle_warning_stage(wrapper)
-                elif event['tag'] == 'minion_start':
-                    listener.handle_minion_start(wrapper)
-                elif fnmatch.fnmatch(event['tag'], 'salt/job/*/ret/*'):
-                    if event['data'].get('fun') == 'state.apply':
-                        listener.handle_state_apply_return(wrapper)
+        if self.journal is not None:
+            self.journal.write(event)
+        wrapper_class, handlers = route
+        wrapper = wrapper_class(event)
+        for listener in self.listeners:
+            for handler in handlers:
+                getattr(listener, handler)(wrapper)
+        self.stats['dispatched'] += 1
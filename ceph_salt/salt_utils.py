@@ -1,12 +1,16 @@
 import contextlib
 import copy
+import functools
 import logging
 import os
 import shutil
+import tempfile
+import threading
 
 import yaml
 
 import salt.client
+import salt.config
 import salt.minion
 from salt.exceptions import SaltException
 
@@ -17,34 +21,112 @@ logger = logging.getLogger(__name__)
 
 
 class SaltClient:
+    """
+    Process-wide pool of Salt clients.
+
+    The master configuration is parsed once and Salt clients are built lazily and then reused
+    for the lifetime of the process. 'LocalClient', 'Caller' and 'MasterMinion' instances are
+    kept per thread, so each thread (e.g. the executor and the event processor threads) reuses
+    its own client.
+    Call `invalidate()` whenever the master configuration may have changed.
+    """
+    _OPTS_ = None
+    _LOCAL_ = None
+    _CALLER_ = None
+    _MASTER_ = None
+    _LOCK_ = threading.Lock()
+    _STATS_ = {
+        'opts_loaded': 0,
+        'clients_built': 0,
+        'clients_reused': 0
+    }
 
     @classmethod
     def _opts(cls, local=True):
         """
         Retrieves the Salt opts structure
         """
-        _opts = salt.config.master_config('/etc/salt/master')
+        with cls._LOCK_:
+            if cls._OPTS_ is None:
+                cls._OPTS_ = salt.config.master_config('/etc/salt/master')
+                cls._STATS_['opts_loaded'] += 1
+            # shallow copy, so that 'file_client' changes don't leak into the cached opts
+            _opts = dict(cls._OPTS_)
         if local:
             _opts['file_client'] = 'local'
         return _opts
 
+    @classmethod
+    def _thread_pool(cls, attr):
+        with cls._LOCK_:
+            pool = getattr(cls, attr)
+            if pool is None:
+                pool = threading.local()
+                setattr(cls, attr, pool)
+        return pool
+
+    @classmethod
+    def _count(cls, stat):
+        with cls._LOCK_:
+            cls._STATS_[stat] += 1
+
+    @classmethod
+    def _pooled_client(cls, pool, key, factory):
+        clients = pool.__dict__.setdefault('clients', {})
+        client = clients.get(key)
+        if client is None:
+            client = factory()
+            clients[key] = client
+            cls._count('clients_built')
+        else:
+            cls._count('clients_reused')
+        return client
+
     @classmethod
     def caller(cls, local=True):
         """
-        Retrieves a new Salt caller client instance
+        Retrieves the Salt caller client instance of the current thread
         """
-        return salt.client.Caller(mopts=cls._opts(local))
+        return cls._pooled_client(cls._thread_pool('_CALLER_'), local,
+                                  lambda: salt.client.Caller(mopts=cls._opts(local)))
 
     @classmethod
     def local(cls):
         """
-        Retrieves a new Salt local client instance
+        Retrieves the Salt local client instance of the current thread
         """
-        return salt.client.LocalClient()
+        return cls._pooled_client(cls._thread_pool('_LOCAL_'), None,
+                                  lambda: salt.client.LocalClient(mopts=cls._opts(False)))
 
     @classmethod
     def master(cls, local=True):
-        return salt.minion.MasterMinion(cls._opts(local))
+        """
+        Retrieves the Salt master minion instance of the current thread
+        """
+        return cls._pooled_client(cls._thread_pool('_MASTER_'), local,
+                                  lambda: salt.minion.MasterMinion(cls._opts(local)))
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Drops the cached master opts and all pooled clients, so that they are rebuilt on
+        the next call (e.g. after 'salt-master' was restarted)
+        """
+        logger.info("invalidating Salt client pool: %s", cls.pool_stats())
+        with cls._LOCK_:
+            cls._OPTS_ = None
+            cls._LOCAL_ = None
+            cls._CALLER_ = None
+            cls._MASTER_ = None
+
+    @classmethod
+    def pool_stats(cls):
+        """
+        Returns the number of times the master opts were loaded and the number of Salt
+        clients that were built and reused
+        """
+        with cls._LOCK_:
+            return dict(cls._STATS_)
 
     @classmethod
     def pillar_fs_path(cls):
@@ -134,6 +216,55 @@ class GrainsManager:
         result = {minion: data.get('ret') for minion, data in ret.items()}
         cls.logger.info("Deleted '%s' grain from %s: result=%s", key, target, result)
 
+    @classmethod
+    def _bulk_cmd(cls, minions, func, args):
+        """
+        Runs a single list-targeted job on several minions, without failing the whole job
+        when some of them do not respond or fail.
+        :return: dict of ``SaltCallException`` by minion id, of the minions it failed on
+        """
+        with contextlib.redirect_stdout(None):
+            try:
+                ret = SaltClient.local().cmd(minions, func, args, tgt_type='list',
+                                             full_return=True)
+            except SaltException as ex:
+                logger.exception(ex)
+                ret = {}
+        if not isinstance(ret, dict):
+            ret = {}
+        failures = {}
+        for minion in minions:
+            data = ret.get(minion)
+            if not isinstance(data, dict):
+                failures[minion] = SaltCallException(minion, func, 'minion did not respond')
+            elif data.get('retcode', 0) != 0:
+                failures[minion] = SaltCallException(minion, func, data.get('ret'))
+        return failures
+
+    @classmethod
+    def bulk_set_grain(cls, minions, key, val):
+        """
+        Sets the same grain value on several minions with a single job.
+        :return: dict of ``SaltCallException`` by minion id, of the minions it failed on
+        """
+        cls.logger.debug("Adding '%s = %s' grain to %s minions", key, val, len(minions))
+        failures = cls._bulk_cmd(minions, 'grains.setval', [key, val])
+        cls.logger.info("Added '%s = %s' grain to %s minions: failed=%s", key, val,
+                        len(minions) - len(failures), sorted(failures))
+        return failures
+
+    @classmethod
+    def bulk_del_grain(cls, minions, key):
+        """
+        Deletes a grain from several minions with a single job.
+        :return: dict of ``SaltCallException`` by minion id, of the minions it failed on
+        """
+        cls.logger.debug("Deleting '%s' grain from %s minions", key, len(minions))
+        failures = cls._bulk_cmd(minions, 'grains.delkey', [key])
+        cls.logger.info("Deleted '%s' grain from %s minions: failed=%s", key,
+                        len(minions) - len(failures), sorted(failures))
+        return failures
+
     @classmethod
     def filter_by(cls, key, val=None):
         condition = '{}:{}'.format(key, val if val else '*')
@@ -154,6 +285,85 @@ class GrainsManager:
         cls.logger.info("Got '%s' grain from %s: result=%s", key, target, result)
         return result
 
+    @classmethod
+    def get_grains(cls, target, keys):
+        """
+        Gets several grains from several minions with a single 'grains.item' job.
+        Minions that do not return are left out of the result.
+        :return: dict of ``{minion: {key: value}}``
+        """
+        target, tgt_type = cls._format_target(target)
+        cls.logger.debug("Getting %s grains from %s", keys, target)
+        with contextlib.redirect_stdout(None):
+            ret = SaltClient.local_cmd(target, 'grains.item', keys, tgt_type=tgt_type)
+        result = {minion: data for minion, data in ret.items() if isinstance(data, dict)}
+        cls.logger.info("Got %s grains from %s: result=%s", keys, target, result)
+        return result
+
+
+def atomic_write(full_path, content, mode, owner=None):
+    """
+    Replaces a file atomically: the content is written to a temporary file in the same
+    directory, flushed to disk with a single fsync and renamed over the file, so that
+    neither salt-master nor a crash ever sees a partially written file.
+    """
+    dir_path, file_name = os.path.split(full_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.{}.'.format(file_name))
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        if owner is not None:
+            shutil.chown(tmp_path, owner, owner)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, full_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# libyaml based loader and dumper, when PyYAML was built with libyaml
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def _yaml_load(content):
+    try:
+        return yaml.load(content, Loader=_YAML_LOADER)
+    except yaml.constructor.ConstructorError:
+        # python specific tags, written by older ceph-salt versions
+        return yaml.full_load(content)
+
+
+def _yaml_dump(data):
+    try:
+        return yaml.dump(data, Dumper=_YAML_DUMPER, default_flow_style=False)
+    except yaml.representer.RepresenterError:
+        # python specific types, e.g. tuples
+        return yaml.dump(data, default_flow_style=False)
+
+
+class _RedactedValue:
+    """
+    Pillar value to log, with its 'private_key' and 'password' entries hidden.
+    The redacted copy is only built if the log record is emitted.
+    """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    @classmethod
+    def _redact(cls, value):
+        if not isinstance(value, dict):
+            return value
+        return {key: '?' if key in ('private_key', 'password') else cls._redact(val)
+                for key, val in value.items()}
+
+    def __str__(self):
+        return str(self._redact(self.value))
+
 
 class PillarManager:
 
@@ -168,9 +378,25 @@ class PillarManager:
 {% endif %}
 """
     PILLAR_FILE = "ceph-salt.sls"
+    # pillar keys whose values are never logged
+    SECRET_KEYS = ('ceph-salt:ssh:private_key', 'ceph-salt:dashboard:password')
     pillar_data = {}
     logger = logging.getLogger(__name__ + '.pillar')
 
+    # parsed pillar files by path, with the inode, mtime and size they were parsed at
+    _yaml_cache = {}
+    # inode, mtime and size of the pillar file when `pillar_data` was loaded or saved
+    _file_key = None
+
+    # nesting depth of `transaction()` blocks and whether `pillar_data` has unsaved changes
+    _txn_depth = 0
+    _txn_dirty = False
+
+    # 'ceph-salt:minions:all' when the minions' pillar was last refreshed
+    _refreshed_minions = frozenset()
+    # dispatched 'saltutil.pillar_refresh' jobs, as (jid, minions), not waited for yet
+    _pending_refreshes = []
+
     @classmethod
     def pillar_installed(cls):
         pillar_base_path = SaltClient.pillar_fs_path()
@@ -217,32 +443,29 @@ class PillarManager:
             cls._save_yaml({'ceph-salt': {}}, cls.PILLAR_FILE)
 
     @staticmethod
-    def _get_dict_value(dict_, key_path):
-        path = key_path.split(":")
+    @functools.lru_cache(maxsize=1024)
+    def _split_key_path(key_path):
+        return tuple(key_path.split(":"))
+
+    @classmethod
+    def _get_dict_value(cls, dict_, key_path):
+        path = cls._split_key_path(key_path)
         _dict = dict_
-        while True:
-            if len(path) == 1:
-                if path[0] in _dict:
-                    return _dict[path[0]]
-                return None
-            if path[0] in _dict:
-                _dict = _dict[path[0]]
-                path = path[1:]
-            else:
+        for key in path[:-1]:
+            _dict = _dict.get(key)
+            if not isinstance(_dict, dict):
                 return None
+        return _dict.get(path[-1])
 
-    @staticmethod
-    def _set_dict_value(dict_, key_path, value):
-        path = key_path.split(":")
+    @classmethod
+    def _set_dict_value(cls, dict_, key_path, value):
+        path = cls._split_key_path(key_path)
         _dict = dict_
-        while True:
-            if len(path) == 1:
-                _dict[path[0]] = value
-                return
-            if path[0] not in _dict:
-                _dict[path[0]] = {}
-            _dict = _dict[path[0]]
-            path = path[1:]
+        for key in path[:-1]:
+            if key not in _dict:
+                _dict[key] = {}
+            _dict = _dict[key]
+        _dict[path[-1]] = value
 
     @classmethod
     def _del_dict_key(cls, dict_, key_path):
@@ -264,66 +487,92 @@ class PillarManager:
         pillar_base_path = SaltClient.pillar_fs_path()
         full_path = os.path.join(pillar_base_path, custom_file)
         cls.logger.info("Reading pillar items from file: %s", full_path)
-        if not os.path.exists(full_path):
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
             return {}
+        cached = cls._yaml_cache.get(full_path)
+        if cached is not None and cached[0] == cls._yaml_cache_key(stat):
+            cls.logger.debug("Pillar file unchanged, not parsing it again: %s", full_path)
+            return copy.deepcopy(cached[1])
         with open(full_path, 'r') as file:
             try:
-                data = yaml.full_load(file)
+                data = _yaml_load(file.read())
                 if data is None:
                     data = {}
             except yaml.error.YAMLError:
                 raise PillarFileNotPureYaml(full_path)
+        cls._yaml_cache[full_path] = (cls._yaml_cache_key(stat), copy.deepcopy(data))
         return data
 
     @staticmethod
-    def _save_yaml(data, custom_file):
+    def _yaml_cache_key(stat):
+        # pillar files are replaced on save, so the inode changes on every save
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @classmethod
+    def _save_yaml(cls, data, custom_file):
         pillar_base_path = SaltClient.pillar_fs_path()
         full_path = os.path.join(pillar_base_path, custom_file)
-        with open(full_path, 'w') as file:
-            content = yaml.dump(data, default_flow_style=False)
-            if content == '{}\n':
-                file.write("")
-            else:
-                file.write(content)
-            file.write("\n")
-        shutil.chown(full_path, "salt", "salt")
-        os.chmod(full_path, 0o600)
+        content = _yaml_dump(data)
+        if content == '{}\n':
+            content = ""
+        atomic_write(full_path, content + "\n", 0o600, owner='salt')
+        # the next load of the file we have just written doesn't need to parse it
+        cls._yaml_cache[full_path] = (cls._yaml_cache_key(os.stat(full_path)),
+                                      copy.deepcopy(data))
 
     @staticmethod
     def _save_file(data, custom_file):
         pillar_base_path = SaltClient.pillar_fs_path()
         full_path = os.path.join(pillar_base_path, custom_file)
-        with open(full_path, 'w') as file:
-            file.write(data)
-        shutil.chown(full_path, "salt", "salt")
-        os.chmod(full_path, 0o644)
+        atomic_write(full_path, data, 0o644, owner='salt')
+
+    @classmethod
+    def _pillar_file_key(cls):
+        try:
+            stat = os.stat(os.path.join(SaltClient.pillar_fs_path(), cls.PILLAR_FILE))
+        except FileNotFoundError:
+            return None
+        return cls._yaml_cache_key(stat)
 
     @classmethod
     def _load(cls):
         if not cls.pillar_data:
+            # stat before reading, so that a change made while reading is noticed later
+            cls._file_key = cls._pillar_file_key()
             cls.pillar_data = cls._load_yaml(cls.PILLAR_FILE)
             cls.logger.debug("Loaded pillar data: %s", cls.pillar_data)
+            cls._refreshed_minions = cls._minions()
 
     @classmethod
-    def _hide_dict_secrets(cls, pillar_data):
-        if not isinstance(pillar_data, dict):
-            return
-        for key, val in pillar_data.items():
-            if key in ('private_key', 'password'):
-                pillar_data[key] = '?'
-            cls._hide_dict_secrets(val)
+    def refresh_if_changed(cls):
+        """
+        Drops `pillar_data` if the pillar file was changed by someone else (e.g. another
+        admin, or 'ceph-salt import') since it was loaded or saved, at the cost of a
+        single 'stat' call.
+        :return: True if the pillar file changed
+        """
+        if not cls.pillar_data or cls._txn_depth > 0:
+            return False
+        if cls._pillar_file_key() == cls._file_key:
+            return False
+        cls.logger.info("Pillar file changed on disk, reloading it")
+        cls.reload()
+        return True
 
     @classmethod
     def get(cls, key, default=None):
+        """
+        Returns the stored value itself, not a copy: use `set()` to change it
+        """
         cls._load()
         res = cls._get_dict_value(cls.pillar_data, key)
-        if key in ('ceph-salt:ssh:private_key', 'ceph-salt:dashboard:password'):
+        if key in cls.SECRET_KEYS:
             # don't log key value
             cls.logger.info("Got '%s' from pillar", key)
         else:
-            res_log = copy.deepcopy(res)
-            cls._hide_dict_secrets(res_log)
-            cls.logger.info("Got '%s' from pillar: '%s'", key, res_log)
+            cls.logger.info("Got '%s' from pillar: '%s'", key, _RedactedValue(res))
         if res is None and default is not None:
             res = default
 
@@ -333,14 +582,11 @@ class PillarManager:
     def set(cls, key, value):
         cls._load()
         cls._set_dict_value(cls.pillar_data, key, value)
-        cls._save_yaml(cls.pillar_data, cls.PILLAR_FILE)
-        SaltClient.local().cmd('*', 'saltutil.pillar_refresh', tgt_type="compound")
-        if key in ('ceph-salt:ssh:private_key', 'ceph-salt:dashboard:password'):
+        cls._changed()
+        if key in cls.SECRET_KEYS:
             cls.logger.info("Set '%s' to pillar", key)
         else:
-            value_log = copy.deepcopy(value)
-            cls._hide_dict_secrets(value_log)
-            cls.logger.info("Set '%s' to pillar: '%s'", key, value_log)
+            cls.logger.info("Set '%s' to pillar: '%s'", key, _RedactedValue(value))
 
     @classmethod
     def reset(cls, key):
@@ -349,10 +595,82 @@ class PillarManager:
         if cls._get_dict_value(cls.pillar_data, key) is None:
             return
         cls._del_dict_key(cls.pillar_data, key)
-        cls._save_yaml(cls.pillar_data, cls.PILLAR_FILE)
-        SaltClient.local().cmd('*', 'saltutil.pillar_refresh', tgt_type="compound")
+        cls._changed()
         cls.logger.info("Deleted '%s' from pillar", key)
 
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        """
+        Defers the pillar changes made by `set()` and `reset()` inside the block: the
+        pillar file is written and refreshed once, when the outermost transaction ends.
+        """
+        cls._txn_depth += 1
+        try:
+            yield
+        finally:
+            cls._txn_depth -= 1
+            if cls._txn_depth == 0 and cls._txn_dirty:
+                cls._flush()
+
+    @classmethod
+    def _changed(cls):
+        if cls._txn_depth > 0:
+            cls._txn_dirty = True
+        else:
+            cls._flush()
+
+    @classmethod
+    def _flush(cls):
+        cls._txn_dirty = False
+        cls._save_yaml(cls.pillar_data, cls.PILLAR_FILE)
+        cls._file_key = cls._pillar_file_key()
+        # minions removed by this change must drop the ceph-salt pillar too
+        minions = cls._refreshed_minions | cls._minions()
+        cls._refreshed_minions = cls._minions()
+        cls._refresh(sorted(minions))
+
+    @classmethod
+    def _minions(cls):
+        minions = cls._get_dict_value(cls.pillar_data, 'ceph-salt:minions:all')
+        return frozenset(minions) if isinstance(minions, list) else frozenset()
+
+    @classmethod
+    def _refresh(cls, minions):
+        """
+        Dispatches a 'saltutil.pillar_refresh' to `minions` without waiting for it,
+        see `wait_for_refresh`
+        """
+        if not minions:
+            return
+        jid = SaltClient.local().cmd_async(minions, 'saltutil.pillar_refresh', tgt_type='list')
+        if not jid:
+            cls.logger.warning("Failed to publish 'saltutil.pillar_refresh' to %s", minions)
+            return
+        cls._pending_refreshes.append((jid, minions))
+
+    @classmethod
+    def wait_for_refresh(cls, timeout=30):
+        """
+        Waits for the pillar refreshes dispatched since the last call to return.
+        A refresh fetches the pillar as it is when it runs, so each minion only needs
+        to return from the last refresh it was sent.
+        :return: list of the minions that did not return in `timeout` seconds
+        """
+        pending, cls._pending_refreshes = cls._pending_refreshes, []
+        waited = set()
+        missing = set()
+        for jid, minions in reversed(pending):
+            minions = [m for m in minions if m not in waited]
+            if not minions:
+                continue
+            waited.update(minions)
+            returns = SaltClient.local().get_returns(jid, minions, timeout) or {}
+            missing.update(m for m in minions if m not in returns)
+        if missing:
+            cls.logger.warning("Pillar refresh did not return from %s", sorted(missing))
+        return sorted(missing)
+
     @classmethod
     def reload(cls):
         cls.pillar_data = {}
@@ -1,5 +1,7 @@
+import contextlib
 import os
 import sys
+import threading
 from functools import wraps
 
 
@@ -9,6 +11,7 @@ class PrettyPrinter:
     """
 
     _colors_enabled = True
+    _capture = threading.local()
 
     class Colors:
         """
@@ -53,11 +56,28 @@ class PrettyPrinter:
         """
         return PrettyPrinter._format(PrettyPrinter.Colors.ORANGE, text)
 
+    @classmethod
+    @contextlib.contextmanager
+    def capture(cls):
+        """
+        Collects the lines printed by the current thread, instead of printing them
+        """
+        lines = []
+        cls._capture.lines = lines
+        try:
+            yield lines
+        finally:
+            cls._capture.lines = None
+
     @classmethod
     def println(cls, text=None):
         """
         Prints text as is with newline in the end
         """
+        lines = getattr(cls._capture, 'lines', None)
+        if lines is not None:
+            lines.append(text)
+            return
         if text:
             sys.stdout.write(u"{}\n".format(text))
             sys.stdout.flush()
@@ -11,7 +11,7 @@ import yaml
 from mock import patch
 from pyfakefs.fake_filesystem_unittest import TestCase
 
-from ceph_salt.salt_utils import SaltClient
+from ceph_salt.salt_utils import PillarManager, SaltClient
 
 
 logging.config.dictConfig({
@@ -69,6 +69,10 @@ class SaltGrainsMock:
         self.logger.info('delkey %s', key)
         del self.grains[key]
 
+    def item(self, *keys):
+        self.logger.info('item %s', keys)
+        return {key: self.grains.get(key, '') for key in keys}
+
     def enumerate_entries(self, _dict=None):
         if _dict is None:
             _dict = self.grains
@@ -111,6 +115,10 @@ class SaltUtilMock:
     def sync_all(cls):
         return cls.sync_all_result
 
+    @classmethod
+    def sync_modules(cls):
+        return cls.sync_all_result
+
     @classmethod
     def running(cls):
         return False
@@ -122,6 +130,40 @@ class StateMock:
         return os.path.exists(os.path.join(SaltMockTestCase.states_fs_path(), state)) or \
             os.path.exists(os.path.join(SaltMockTestCase.states_fs_path(), "{}.sls".format(state)))
 
+    @staticmethod
+    def apply(state, *args):  # pylint: disable=unused-argument
+        return {
+            'ceph_salt_|-{state}_|-{state}_|-set_grain'.format(state=state): {
+                '__id__': state,
+                '__run_num__': 0,
+                'result': True
+            }
+        }
+
+
+class CephSaltMock:
+    @staticmethod
+    def probe_dns(*hostnames):
+        return {'ok': True, 'unresolvable': [], 'latencies': {h: 0.001 for h in hostnames}}
+
+    @staticmethod
+    def probe_time_sync():
+        return {'ok': True, 'unit': 'chronyd.service', 'units': {}}
+
+    @staticmethod
+    def probe_fqdn():
+        return 'YES'
+
+    @classmethod
+    def preflight(cls, state, hostnames):
+        return {
+            'sls_exists': StateMock.sls_exists(state),
+            'dns': cls.probe_dns(*hostnames),
+            'time_sync': cls.probe_time_sync(),
+            'fqdn': cls.probe_fqdn(),
+            'timings': {}
+        }
+
 
 class ServiceMock:
     restart_result = True
@@ -149,6 +191,14 @@ class CephOrchMock:
         return cls.host_ls_result
 
 
+class CmdMock:
+    shell_result = 'ceph version 15.2.1 (9fd2f65f91d9246fae2c841a6222d34d121680ee) octopus (stable)'
+
+    @classmethod
+    def shell(cls, cmd):  # pylint: disable=unused-argument
+        return cls.shell_result
+
+
 class NetworkMock:
     subnets_result = []
 
@@ -162,25 +212,39 @@ class SaltLocalClientMock:
     def __init__(self):
         self.logger = logging.getLogger(SaltLocalClientMock.__name__)
         self.grains = defaultdict(SaltGrainsMock)
+        self.async_calls = []
 
-    def cmd(self, target, module, args=None, tgt_type=None, full_return=False):
-        self.logger.info('cmd %s, %s, %s, tgt_type=%s, full_return=%s',
-                         target, module, args, tgt_type, full_return)
+    def cmd_async(self, target, module, args=None, tgt_type=None):
+        self.logger.info('cmd_async %s, %s, %s, tgt_type=%s', target, module, args, tgt_type)
+        self.async_calls.append((target, module, args, tgt_type))
+        return '20200117161959615228'
 
-        if args is None:
-            args = []
+    def get_returns(self, jid, minions, timeout=None):
+        self.logger.info('get_returns %s, %s, timeout=%s', jid, minions, timeout)
+        return {minion: True for minion in minions if minion in SaltEnv.minions}
 
+    def _targets(self, target, tgt_type):
         targets = []
         if tgt_type == 'grain':
             for minion, grains in self.grains.items():
                 self.logger.info("grain filtering: %s <-> %s", grains.enumerate_entries(), target)
                 if fnmatch.filter(grains.enumerate_entries(), target):
                     targets.append(minion)
+        elif tgt_type == 'list':
+            targets.extend(target)
         else:
             targets.append(target)
+        return targets
+
+    def cmd(self, target, module, args=None, tgt_type=None, full_return=False):
+        self.logger.info('cmd %s, %s, %s, tgt_type=%s, full_return=%s',
+                         target, module, args, tgt_type, full_return)
+
+        if args is None:
+            args = []
 
         result = {}
-        for tgt in targets:
+        for tgt in self._targets(target, tgt_type):
             mod, func = ModuleUtil.parse_module(module)
             if mod == 'grains':
                 ret = getattr(self.grains[tgt], func)(*args)
@@ -196,6 +260,10 @@ class SaltLocalClientMock:
                 ret = getattr(CephOrchMock, func)(*args)
             elif mod == 'network':
                 ret = getattr(NetworkMock, func)(*args)
+            elif mod == 'cmd':
+                ret = getattr(CmdMock, func)(*args)
+            elif mod == 'ceph_salt':
+                ret = getattr(CephSaltMock, func)(*args)
             else:
                 raise NotImplementedError()
             if full_return:
@@ -282,6 +350,8 @@ class SaltMockTestCase(TestCase):
         SaltClient._LOCAL_ = None
         SaltClient._CALLER_ = None
         SaltClient._MASTER_ = None
+        PillarManager._yaml_cache = {}
+        PillarManager._pending_refreshes = []
 
         self.caller_client = SaltCallerMock()
         self.local_client = SaltLocalClientMock()
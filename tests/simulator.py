@@ -0,0 +1,285 @@
+"""
+Synthetic ceph-salt cluster built on the Salt mocks of this package.
+
+`ClusterSimulator` registers N virtual minions, answers every Salt job after a
+configurable latency, fails a configurable share of the 'state.apply' runs, and
+fires the 'ceph-salt/stage|step' and job return events that real minions send
+while applying the formula. The 'apply', 'status', 'config' and 'import' code
+paths run end to end against it, e.g.:
+
+    simulator = ClusterSimulator(self, 1000, latency=0.01, failure_rate=0.05)
+    simulator.start()
+    simulator.configure()
+    CephSaltExecutor(False, None, 'ceph-salt', {}, prompt_proceed).run()
+    print(simulator.calls)
+"""
+import collections
+import datetime
+import logging
+import os
+import random
+import threading
+import time
+
+import salt.payload
+import salt.utils.event
+from mock import patch
+
+from ceph_salt.config_shell import CEPH_SALT_OPTIONS
+from ceph_salt.core import CephNodeManager, SshKeyManager
+from ceph_salt.salt_utils import PillarManager, SaltClient
+
+from . import SaltEnv, SaltLocalClientMock
+
+
+logger = logging.getLogger(__name__)
+
+
+# stages, and their steps, of a simulated 'state.apply'
+DEFAULT_STAGES = [
+    ('Preparing', ['Installing packages', 'Configuring SSH keys']),
+    ('Configuring time sync', ['Installing chrony', 'Waiting for time sync']),
+    ('Installing cephadm', ['Installing cephadm package', 'Pulling container image']),
+    ('Adding host to ceph orch', ['Adding host', 'Setting host labels']),
+]
+
+_SSH_KEYS = []
+
+
+def _ssh_keys():
+    # generating a key pair is slow, and any key pair will do
+    if not _SSH_KEYS:
+        _SSH_KEYS.extend(SshKeyManager.generate_key_pair())
+    return _SSH_KEYS
+
+
+def _reset_minions_handler():
+    # the config shell handler caches the list of accepted minions
+    # pylint: disable=protected-access
+    CEPH_SALT_OPTIONS['ceph_cluster']['options']['minions']['handler']._minions = set()
+
+
+def _stamp():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+class SimulatedEventBus:
+    """
+    Salt master event bus returned by `salt.utils.event.get_event`
+    """
+    def __init__(self):
+        self.handler = None
+        self.fired = 0
+
+    def set_event_handler(self, handler):
+        self.handler = handler
+
+    def fire(self, tag, data):
+        if self.handler is None:
+            return
+        self.fired += 1
+        raw = b''.join([tag.encode(), salt.utils.event.TAGEND.encode(),
+                        salt.payload.dumps(data, use_bin_type=True)])
+        self.handler(raw)
+
+    def drain(self):
+        """
+        Waits until the fired events were dispatched to the listeners
+        """
+        processor = getattr(self.handler, '__self__', None)
+        if processor is not None:
+            processor.queue.join()
+
+
+class SimulatedLocalClient(SaltLocalClientMock):
+    """
+    `SaltLocalClientMock` that counts Salt jobs by function, delays them and
+    runs 'state.apply' on the simulated minions
+    """
+    def __init__(self, simulator):
+        super(SimulatedLocalClient, self).__init__()
+        self.simulator = simulator
+        self.calls = collections.Counter()
+        self._calls_lock = threading.Lock()
+
+    def _job(self, module):
+        with self._calls_lock:
+            self.calls[module] += 1
+        if self.simulator.latency:
+            time.sleep(self.simulator.latency)
+
+    def cmd(self, target, module, args=None, tgt_type=None, full_return=False):
+        self._job(module)
+        return super(SimulatedLocalClient, self).cmd(target, module, args, tgt_type,
+                                                     full_return)
+
+    def cmd_async(self, target, module, args=None, tgt_type=None):
+        self._job(module)
+        return super(SimulatedLocalClient, self).cmd_async(target, module, args, tgt_type)
+
+    def cmd_iter(self, target, module, args=None, tgt_type=None):
+        self._job(module)
+        if module != 'state.apply':
+            raise NotImplementedError()
+        for minion in self._targets(target, tgt_type):
+            yield {minion: self.simulator.apply_state(minion, args[0])}
+
+
+class ClusterSimulator:
+    """
+    N virtual minions on top of the Salt mocks of a `SaltMockTestCase`.
+
+    :param latency: seconds each Salt job takes
+    :param failure_rate: share of minions whose 'state.apply' fails
+    :param seed: seed of the choice of failing minions and failing steps
+    """
+    def __init__(self, test_case, num_minions, latency=0.0, failure_rate=0.0, seed=0,
+                 stages=None):
+        self.test_case = test_case
+        self.minions = ['node{}.ceph.test'.format(i) for i in range(1, num_minions + 1)]
+        self.latency = latency
+        self.stages = stages or DEFAULT_STAGES
+        self._random = random.Random(seed)
+        self.failing = set(self._random.sample(self.minions,
+                                               int(round(num_minions * failure_rate))))
+        self.client = SimulatedLocalClient(self)
+        self.bus = SimulatedEventBus()
+        self._jid = 0
+        self._jid_lock = threading.Lock()
+        self._log_levels = {}
+
+    @property
+    def calls(self):
+        """
+        Number of Salt jobs run, by function
+        """
+        return self.client.calls
+
+    def start(self):
+        fs = self.test_case.fs
+        patchers = [
+            patch('salt.client.LocalClient', return_value=self.client),
+            patch('salt.utils.event.get_event', return_value=self.bus),
+            patch('salt.config.client_config'),
+            # the simulated bus calls the event handler directly, and the IOLoop
+            # pipe waker does not work on the fake filesystem
+            patch('ceph_salt.salt_event.IOLoop'),
+            # there is no 'salt-master' process to look for
+            patch('ceph_salt.validate.salt_master.check_salt_master'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.test_case.addCleanup(patcher.stop)
+        self.test_case.addCleanup(self.stop)
+        # mocks log every call, which dominates the run time with thousands of minions
+        for name in ['SaltLocalClientMock', 'SaltGrainsMock']:
+            mock_logger = logging.getLogger(name)
+            self._log_levels[name] = mock_logger.level
+            mock_logger.setLevel(logging.WARNING)
+
+        SaltClient.invalidate()
+        # pylint: disable=protected-access
+        CephNodeManager._ceph_salt_nodes = {}
+        _reset_minions_handler()
+        self.test_case.local_client = self.client
+        SaltEnv.minions = list(self.minions)
+        for num, minion in enumerate(self.minions):
+            fs.create_file(os.path.join(self.test_case.pki_minions_fs_path(), minion))
+            ip = '10.{}.{}.{}'.format(num // 65536 % 256, num // 256 % 256, num % 256)
+            grains = self.client.grains[minion]
+            grains.setval('host', minion.split('.')[0])
+            grains.setval('fqdn_ip4', [ip])
+            grains.setval('ipv4', [ip, '127.0.0.1'])
+            grains.setval('ipv6', [])
+            grains.setval('oscodename', 'openSUSE Leap 15.2')
+        fs.create_file(os.path.join(self.test_case.states_fs_path(), 'ceph-salt.sls'))
+        PillarManager.install_pillar()
+        PillarManager.reload()
+
+    def stop(self):
+        for name, level in self._log_levels.items():
+            logging.getLogger(name).setLevel(level)
+        self._log_levels = {}
+        # pylint: disable=protected-access
+        CephNodeManager._ceph_salt_nodes = {}
+        _reset_minions_handler()
+        SaltClient.invalidate()
+
+    def configure(self, num_admins=1):
+        """
+        Adds all minions to the ceph-salt configuration, with a valid configuration
+        """
+        admins = self.minions[:num_admins]
+        for minion in self.minions:
+            roles = ['admin', 'cephadm'] if minion in admins else ['cephadm']
+            self.client.grains[minion].setval('ceph-salt', {'member': True,
+                                                            'roles': roles,
+                                                            'execution': {}})
+        private_key, public_key = _ssh_keys()
+        with PillarManager.transaction():
+            PillarManager.set('ceph-salt:minions:all', list(self.minions))
+            PillarManager.set('ceph-salt:minions:admin', list(admins))
+            PillarManager.set('ceph-salt:minions:cephadm', list(self.minions))
+            PillarManager.set('ceph-salt:bootstrap_minion', self.minions[0])
+            PillarManager.set('ceph-salt:bootstrap_mon_ip',
+                              self.client.grains[self.minions[0]].get('fqdn_ip4')[0])
+            PillarManager.set('ceph-salt:ssh:private_key', private_key)
+            PillarManager.set('ceph-salt:ssh:public_key', public_key)
+            PillarManager.set('ceph-salt:time_server:enabled', False)
+            PillarManager.set('ceph-salt:dashboard:username', 'admin')
+            PillarManager.set('ceph-salt:dashboard:password', 'admin')
+            PillarManager.set('ceph-salt:dashboard:password_update_required', True)
+            PillarManager.set('ceph-salt:container:images:ceph',
+                              'registry.example.com/ceph/ceph')
+
+    def _next_jid(self):
+        with self._jid_lock:
+            self._jid += 1
+            return '20200101000000{:06d}'.format(self._jid)
+
+    def _fire_ceph_salt_event(self, minion, tag, desc):
+        self.bus.fire(tag, {'id': minion, 'cmd': '_minion_event', 'pretag': None,
+                            'data': {'desc': desc}, 'tag': tag, '_stamp': _stamp()})
+
+    def apply_state(self, minion, state):
+        """
+        Applies a state on a minion: fires its stage and step events, and its job
+        return event, and returns the job return
+        """
+        failing_step = None
+        if minion in self.failing:
+            failing_step = self._random.randrange(sum(len(s[1]) for s in self.stages))
+        states = collections.OrderedDict()
+
+        def _state(name, result=True):
+            states[name] = {'__id__': name.split('_|-')[1], '__run_num__': len(states),
+                            'result': result, 'comment': '', 'changes': {}}
+
+        step_num = 0
+        failed = False
+        for stage, steps in self.stages:
+            self._fire_ceph_salt_event(minion, 'ceph-salt/stage/begin', stage)
+            _state('ceph_salt_|-begin_stage_{0}_|-{0}_|-begin_stage'.format(stage))
+            for step in steps:
+                self._fire_ceph_salt_event(minion, 'ceph-salt/step/begin', step)
+                _state('ceph_salt_|-begin_step_{0}_|-{0}_|-begin_step'.format(step))
+                failed = step_num == failing_step
+                _state('cmd_|-{0}_|-{0}_|-run'.format(step), not failed)
+                step_num += 1
+                if failed:
+                    break
+                self._fire_ceph_salt_event(minion, 'ceph-salt/step/end', step)
+                _state('ceph_salt_|-end_step_{0}_|-{0}_|-end_step'.format(step))
+            if failed:
+                break
+            self._fire_ceph_salt_event(minion, 'ceph-salt/stage/end', stage)
+            _state('ceph_salt_|-end_stage_{0}_|-{0}_|-end_stage'.format(stage))
+
+        retcode = 2 if failed else 0
+        jid = self._next_jid()
+        tag = 'salt/job/{}/ret/{}'.format(jid, minion)
+        self.bus.fire(tag, {'id': minion, 'fun': 'state.apply', 'fun_args': [state],
+                            'jid': jid, 'success': not failed, 'retcode': retcode,
+                            'return': states, 'tag': tag, '_stamp': _stamp()})
+        self.bus.drain()
+        return {'ret': states, 'retcode': retcode}
@@ -0,0 +1,262 @@
+"""
+Benchmarks of the ceph-salt entry points against a simulated cluster.
+
+Each benchmark reports the wall time, the Salt jobs run (by function), the
+pillar file writes and the peak RSS of the process, and fails if it runs more
+Salt jobs or pillar writes than recorded in `benchmark_baseline.json`.
+`PillarYamlBenchmarkTest` checks that the pillar is parsed with libyaml and
+parsed only once while unchanged, and records the timings of each parsing path.
+
+Environment variables:
+
+    CEPH_SALT_BENCHMARK_SIZES   cluster sizes to run, default '10,100'
+                                (e.g. '10,100,1000')
+    CEPH_SALT_BENCHMARK_REPORT  file to write the results to, as JSON
+    CEPH_SALT_BENCHMARK_UPDATE  if set, records the results as the new baseline
+                                instead of comparing them
+"""
+import json
+import logging
+import os
+import resource
+import time
+import unittest
+
+from mock import patch
+import yaml
+
+from ceph_salt.config_shell import run_config_cmdline, run_export, run_import, run_status
+from ceph_salt.core import CephNodeManager
+from ceph_salt.execute import CephSaltExecutor
+from ceph_salt.salt_utils import PillarManager
+
+from . import SaltMockTestCase
+from .simulator import ClusterSimulator
+
+
+logger = logging.getLogger(__name__)
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+SIZES = [int(size) for size in
+         os.environ.get('CEPH_SALT_BENCHMARK_SIZES', '10,100').split(',') if size]
+REPORT_FILE = os.environ.get('CEPH_SALT_BENCHMARK_REPORT')
+UPDATE_BASELINE = bool(os.environ.get('CEPH_SALT_BENCHMARK_UPDATE'))
+
+# results of this run, by benchmark name and cluster size
+_results = {}
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _write_json(path, data):
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=4, sort_keys=True)
+        file.write('\n')
+
+
+# read before the tests replace the filesystem with a fake one
+_baseline = _read_json(BASELINE_FILE)
+
+
+def tearDownModule():
+    if REPORT_FILE:
+        _write_json(REPORT_FILE, _results)
+    if UPDATE_BASELINE and _results:
+        baseline = dict(_baseline)
+        for name, sizes in _results.items():
+            for size, result in sizes.items():
+                if 'salt_calls' not in result:
+                    continue
+                baseline.setdefault(name, {})[size] = {
+                    'salt_calls': result['salt_calls'],
+                    'pillar_writes': result['pillar_writes']
+                }
+        _write_json(BASELINE_FILE, baseline)
+
+
+class _Benchmarks:
+    """
+    Benchmarks of a cluster of `NUM_MINIONS` minions
+    """
+    NUM_MINIONS = None
+
+    def setUp(self):
+        super(_Benchmarks, self).setUp()
+        if self.NUM_MINIONS not in SIZES:
+            self.skipTest('cluster size {} not in CEPH_SALT_BENCHMARK_SIZES'.format(
+                self.NUM_MINIONS))
+        self.simulator = ClusterSimulator(self, self.NUM_MINIONS)
+        self.simulator.start()
+
+    def tearDown(self):
+        super(_Benchmarks, self).tearDown()
+        PillarManager.reload()
+
+    def _prompt_proceed(self, msg, default):
+        pass
+
+    def _measure(self, name, func, *args):
+        self.simulator.calls.clear()
+        # pylint: disable=protected-access
+        with patch.object(PillarManager, '_save_yaml',
+                          wraps=PillarManager._save_yaml) as save_yaml:
+            start = time.perf_counter()
+            ret = func(*args)
+            wall_time = time.perf_counter() - start
+        result = {
+            'wall_time': round(wall_time, 3),
+            'salt_calls': dict(self.simulator.calls),
+            'pillar_writes': save_yaml.call_count,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        }
+        _results.setdefault(name, {})[str(self.NUM_MINIONS)] = result
+        logger.info("benchmark %s[%s]: %.3fs, %s Salt jobs %s, %s pillar writes, "
+                    "peak RSS %s KiB", name, self.NUM_MINIONS, result['wall_time'],
+                    sum(result['salt_calls'].values()), result['salt_calls'],
+                    result['pillar_writes'], result['peak_rss_kb'])
+        if not UPDATE_BASELINE:
+            self._check_baseline(name, result)
+        return ret
+
+    def _check_baseline(self, name, result):
+        expected = _baseline.get(name, {}).get(str(self.NUM_MINIONS))
+        if expected is None:
+            return
+        regressions = []
+        for func, count in sorted(result['salt_calls'].items()):
+            if count > expected['salt_calls'].get(func, 0):
+                regressions.append("'{}' Salt jobs: {} (baseline {})".format(
+                    func, count, expected['salt_calls'].get(func, 0)))
+        if result['pillar_writes'] > expected['pillar_writes']:
+            regressions.append('pillar writes: {} (baseline {})'.format(
+                result['pillar_writes'], expected['pillar_writes']))
+        if regressions:
+            self.fail('{}[{}] regressed: {}'.format(
+                name, self.NUM_MINIONS, ', '.join(regressions)))
+
+    def test_status(self):
+        self.simulator.configure()
+        self.assertTrue(self._measure('status', run_status))
+
+    def test_export(self):
+        self.simulator.configure()
+        self.assertTrue(self._measure('export', run_export, False))
+
+    def test_import(self):
+        self.fs.create_file('/config.json', contents=json.dumps({
+            'minions': {'all': self.simulator.minions,
+                        'admin': self.simulator.minions[:1],
+                        'cephadm': self.simulator.minions}
+        }))
+        self.assertTrue(self._measure('import', run_import, '/config.json'))
+
+    def test_config_minions_add(self):
+        self._measure('config_minions_add', run_config_cmdline, '/ceph_cluster/minions add *')
+        self.assertEqual(len(PillarManager.get('ceph-salt:minions:all')), self.NUM_MINIONS)
+
+    def test_config_minions_remove(self):
+        run_config_cmdline('/ceph_cluster/minions add *')
+        self._measure('config_minions_remove', run_config_cmdline,
+                      '/ceph_cluster/minions remove *')
+        self.assertEqual(PillarManager.get('ceph-salt:minions:all'), [])
+
+    def test_config_roles_add(self):
+        run_config_cmdline('/ceph_cluster/minions add *')
+        # as in a new 'ceph-salt config' process, with no node loaded yet
+        CephNodeManager.invalidate()
+        self._measure('config_roles_add', run_config_cmdline,
+                      '/ceph_cluster/roles/cephadm add *')
+        self.assertEqual(len(PillarManager.get('ceph-salt:minions:cephadm')),
+                         self.NUM_MINIONS)
+
+    def test_check_prerequisites(self):
+        self.simulator.configure()
+        retcode, _ = self._measure('check_prerequisites', CephSaltExecutor.check_prerequisites,
+                                   None, 'ceph-salt', self._prompt_proceed)
+        self.assertEqual(retcode, 0)
+
+    def test_apply(self):
+        self.simulator.configure()
+        executor = CephSaltExecutor(False, None, 'ceph-salt', {}, self._prompt_proceed)
+        self.assertEqual(self._measure('apply', executor.run), 0)
+
+
+class Benchmark10Test(_Benchmarks, SaltMockTestCase):
+    NUM_MINIONS = 10
+
+
+class Benchmark100Test(_Benchmarks, SaltMockTestCase):
+    NUM_MINIONS = 100
+
+
+class Benchmark1000Test(_Benchmarks, SaltMockTestCase):
+    NUM_MINIONS = 1000
+
+
+class PillarYamlBenchmarkTest(SaltMockTestCase):
+    """
+    Parsing of a large pillar file: pure Python loader vs. libyaml loader vs. parse cache
+    """
+    NUM_MINIONS = 1000
+    ROUNDS = 5
+
+    def setUp(self):
+        super(PillarYamlBenchmarkTest, self).setUp()
+        minions = ['node{}.ceph.test'.format(i) for i in range(self.NUM_MINIONS)]
+        PillarManager.set('ceph-salt', {
+            'minions': {'all': minions, 'admin': minions[:3], 'cephadm': minions},
+            'bootstrap_ceph_conf': {'section{}'.format(i): {'option{}'.format(j): j
+                                                            for j in range(10)}
+                                    for i in range(50)},
+            'cert': '\n'.join(['A' * 64] * 40)
+        })
+
+    def tearDown(self):
+        super(PillarYamlBenchmarkTest, self).tearDown()
+        PillarManager.reload()
+
+    def _best_of(self, func):
+        timings = []
+        for _ in range(self.ROUNDS):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def _reload_not_cached(self):
+        PillarManager._yaml_cache = {}  # pylint: disable=protected-access
+        PillarManager.reload()
+
+    @unittest.skipUnless(hasattr(yaml, 'CSafeLoader'), 'PyYAML built without libyaml')
+    def test_pillar_yaml_libyaml(self):
+        with patch('yaml.load', wraps=yaml.load) as yaml_load:
+            self._reload_not_cached()
+        yaml_load.assert_called_once()
+        self.assertIs(yaml_load.call_args[1]['Loader'], yaml.CSafeLoader)
+
+    def test_pillar_yaml_cached(self):
+        self._reload_not_cached()
+        with patch('ceph_salt.salt_utils._yaml_load') as yaml_load:
+            PillarManager.reload()
+        yaml_load.assert_not_called()
+        self.assertEqual(len(PillarManager.get('ceph-salt:minions:all')), self.NUM_MINIONS)
+
+    def test_pillar_yaml(self):
+        # timings are only recorded: they vary too much across machines to be asserted
+        file_path = os.path.join(self.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        with open(file_path) as file:
+            content = file.read()
+        result = {
+            'full_load': self._best_of(lambda: yaml.full_load(content)),
+            'reload': self._best_of(self._reload_not_cached),
+            'reload_cached': self._best_of(PillarManager.reload)
+        }
+        _results.setdefault('pillar_yaml', {})[str(self.NUM_MINIONS)] = result
+        logger.info("benchmark pillar_yaml[%s]: %s", self.NUM_MINIONS, result)
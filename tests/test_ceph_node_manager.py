@@ -0,0 +1,65 @@
+from mock import patch
+
+from ceph_salt.core import CephNodeManager
+from ceph_salt.salt_utils import GrainsManager
+from . import SaltMockTestCase, NetworkMock
+
+
+class CephNodeManagerPrefetchTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(CephNodeManagerPrefetchTest, self).setUp()
+        for i in range(1, 4):
+            minion = 'node{}.ceph.com'.format(i)
+            GrainsManager.set_grain(minion, 'ipv4', ['127.0.0.1', '10.20.39.20{}'.format(i)])
+            GrainsManager.set_grain(minion, 'ipv6', ['fe80::20{}'.format(i)])
+            GrainsManager.set_grain(minion, 'fqdn_ip4', ['127.0.0.1'])
+            GrainsManager.set_grain(minion, 'oscodename', 'openSUSE Leap 15.2')
+            GrainsManager.set_grain(minion, 'ceph-salt', {'member': True,
+                                                          'execution': {'provisioned': True}})
+        NetworkMock.subnets_result = ['10.20.39.0/24']
+        self.minions = ['node1.ceph.com', 'node2.ceph.com', 'node3.ceph.com']
+
+    def tearDown(self):
+        super(CephNodeManagerPrefetchTest, self).tearDown()
+        NetworkMock.subnets_result = []
+
+    def test_prefetch_single_job_per_source(self):
+        with patch.object(self.local_client, 'cmd', wraps=self.local_client.cmd) as cmd:
+            nodes = CephNodeManager.prefetch(self.minions, ['ipsv4', 'ipsv6', 'os_codename',
+                                                            'execution', 'public_ip',
+                                                            'subnets', 'ceph_version'])
+            self.assertEqual([call[0][1] for call in cmd.call_args_list],
+                             ['grains.item', 'network.subnets', 'cmd.shell'])
+            self.assertEqual(sorted(nodes), self.minions)
+            node = nodes['node2.ceph.com']
+            self.assertEqual(node.ipsv4, ['127.0.0.1', '10.20.39.202'])
+            self.assertEqual(node.ipsv6, ['fe80::202'])
+            self.assertEqual(node.os_codename, 'openSUSE Leap 15.2')
+            self.assertEqual(node.execution, {'provisioned': True})
+            self.assertEqual(node.public_ip, '10.20.39.202')
+            self.assertEqual(node.subnets, ['10.20.39.0/24'])
+            self.assertTrue(node.ceph_version.startswith('ceph version 15.2.1'))
+            # everything was served from the prefetched values
+            self.assertEqual(cmd.call_count, 3)
+
+    def test_prefetch_grains_only(self):
+        with patch.object(self.local_client, 'cmd', wraps=self.local_client.cmd) as cmd:
+            CephNodeManager.prefetch(self.minions, ['ipsv4', 'ipsv6'])
+            self.assertEqual(cmd.call_count, 1)
+            self.assertEqual(cmd.call_args[0][2], ['ipv4', 'ipv6'])
+            self.assertEqual(cmd.call_args[1]['tgt_type'], 'list')
+
+    def test_prefetch_missing_minion_stays_lazy(self):
+        with patch.object(GrainsManager, 'get_grains', return_value={}):
+            nodes = CephNodeManager.prefetch(self.minions, ['os_codename'])
+        self.assertEqual(nodes['node1.ceph.com'].os_codename, 'openSUSE Leap 15.2')
+
+    def test_prefetch_no_minions(self):
+        with patch.object(self.local_client, 'cmd') as cmd:
+            self.assertEqual(CephNodeManager.prefetch([], ['ipsv4']), {})
+            cmd.assert_not_called()
+
+    def test_prefetch_unknown_field(self):
+        with self.assertRaises(ValueError):
+            CephNodeManager.prefetch(self.minions, ['roles'])
@@ -1,11 +1,15 @@
 import json
+import os
 
 import pytest
+import yaml
+from mock import patch
 
-from ceph_salt.exceptions import MinionDoesNotExistInConfiguration
+from ceph_salt.core import CephNodeManager
+from ceph_salt.exceptions import MinionDoesNotExistInConfiguration, SaltCallException
 from ceph_salt.salt_utils import GrainsManager, PillarManager
 from ceph_salt.config_shell import CephSaltConfigShell, generate_config_shell_tree,\
-    run_export, run_import
+    run_export, run_import, IMPORT_JOURNAL_FILE
 
 from . import SaltMockTestCase
 
@@ -49,6 +53,90 @@ class ConfigShellTest(SaltMockTestCase):
         self.assertEqual(PillarManager.get('ceph-salt:minions:admin'), [])
         self.assertEqual(PillarManager.get('ceph-salt:bootstrap_minion'), None)
 
+    def test_ceph_cluster_minions_remove_refreshes_pillar(self):
+        self.shell.run_cmdline('/ceph_cluster/minions add node*')
+        # the 'ceph-salt:member' grain is gone by the time the pillar is saved
+        with patch.object(self.local_client, 'cmd_async',
+                          wraps=self.local_client.cmd_async) as cmd_async:
+            self.shell.run_cmdline('/ceph_cluster/minions remove node1.ceph.com')
+        cmd_async.assert_called_once_with(
+            ['node1.ceph.com', 'node2.ceph.com', 'node3.ceph.com'],
+            'saltutil.pillar_refresh', tgt_type='list')
+        self.shell.run_cmdline('/ceph_cluster/minions remove node*')
+
+    def test_ceph_cluster_minions_bulk(self):
+        orig_cmd = self.local_client.cmd
+
+        def _cmd(target, module, *args, **kwargs):
+            ret = orig_cmd(target, module, *args, **kwargs)
+            if module == 'grains.setval' and isinstance(target, list):
+                ret['node2.ceph.com'] = False
+            return ret
+
+        with patch.object(self.local_client, 'cmd', side_effect=_cmd) as cmd:
+            self.shell.run_cmdline('/ceph_cluster/minions add node*')
+            setval_calls = [c for c in cmd.call_args_list if c[0][1] == 'grains.setval']
+        self.assertEqual(len(setval_calls), 1)
+        self.assertInSysOut("Salt call target='node2.ceph.com' func='grains.setval' failed: "
+                            "minion did not respond")
+        self.assertEqual(sorted(PillarManager.get('ceph-salt:minions:all')),
+                         ['node1.ceph.com', 'node3.ceph.com'])
+
+        self.shell.run_cmdline('/ceph_cluster/roles/cephadm add node*')
+        self.assertInSysOut('2 minions added.')
+        self.assertEqual(sorted(PillarManager.get('ceph-salt:minions:cephadm')),
+                         ['node1.ceph.com', 'node3.ceph.com'])
+        self.shell.run_cmdline('/ceph_cluster/roles/cephadm remove node*')
+
+        self.shell.run_cmdline('/ceph_cluster/minions remove node*')
+        self.assertInSysOut('2 minions removed.')
+        self.assertEqual(PillarManager.get('ceph-salt:minions:all'), [])
+
+    def test_ceph_cluster_roles_bulk_cold_cache(self):
+        self.shell.run_cmdline('/ceph_cluster/minions add node*')
+        # e.g. a new 'ceph-salt config' process
+        CephNodeManager.invalidate()
+        orig_cmd = self.local_client.cmd
+
+        def _cmd(target, module, *args, **kwargs):
+            ret = orig_cmd(target, module, *args, **kwargs)
+            if module == 'grains.item' and isinstance(target, list):
+                ret.pop('node3.ceph.com', None)
+            return ret
+
+        with patch.object(self.local_client, 'cmd', side_effect=_cmd) as cmd:
+            self.shell.run_cmdline('/ceph_cluster/roles/cephadm add node*')
+            modules = [c[0][1] for c in cmd.call_args_list]
+        self.assertEqual(modules.count('grains.item'), 1)
+        self.assertEqual(modules.count('grains.setval'), 1)
+        self.assertNotIn('grains.get', modules)
+        self.assertInSysOut("Salt call target='node3.ceph.com' func='grains.item' failed: "
+                            "minion did not respond")
+        self.assertEqual(sorted(PillarManager.get('ceph-salt:minions:cephadm')),
+                         ['node1.ceph.com', 'node2.ceph.com'])
+        self.shell.run_cmdline('/ceph_cluster/roles/cephadm remove node*')
+        self.shell.run_cmdline('/ceph_cluster/minions remove node*')
+
+    def test_pillar_changed_by_someone_else(self):
+        self.shell.run_cmdline('/ceph_cluster/minions add node1.ceph.com')
+        self.clearSysOut()
+        # another admin adds 'node2.ceph.com'
+        GrainsManager.set_grain('node2.ceph.com', 'ceph-salt', {'member': True,
+                                                                'roles': [],
+                                                                'execution': {}})
+        pillar_file = '{}/{}'.format(self.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        self.fs.remove_object(pillar_file)
+        self.fs.create_file(pillar_file, contents=yaml.dump({'ceph-salt': {'minions': {
+            'all': ['node1.ceph.com', 'node2.ceph.com'], 'admin': [], 'cephadm': []}}}))
+
+        self.shell.run_cmdline('/ceph_cluster/minions remove node2.ceph.com')
+        self.assertInSysOut('1 minion removed.')
+        self.assertEqual(PillarManager.get('ceph-salt:minions:all'), ['node1.ceph.com'])
+
+        with patch.object(self.shell, 'refresh_tree') as refresh_tree:
+            self.shell.run_cmdline('/ceph_cluster/minions remove node1.ceph.com')
+            refresh_tree.assert_not_called()
+
     def test_ceph_cluster_minions_remove_with_roles(self):
         self.shell.run_cmdline('/ceph_cluster/minions add node1.ceph.com')
         self.shell.run_cmdline('/ceph_cluster/roles/admin add node1.ceph.com')
@@ -331,6 +419,92 @@ class ConfigShellTest(SaltMockTestCase):
 
         self.fs.remove('/config.json')
 
+    def test_import_resume(self):
+        self.fs.create_file('/config.json', contents=json.dumps({
+            'minions': {
+                'all': ['node1.ceph.com', 'node2.ceph.com'],
+                'admin': ['node1.ceph.com']
+            },
+            'ssh': {'private_key': 'SECRET'}}))
+        journal_path = '{}/{}'.format(self.pillar_fs_path(), IMPORT_JOURNAL_FILE)
+        failure = {'node2.ceph.com': SaltCallException('node2.ceph.com', 'grains.setval',
+                                                       'minion did not respond')}
+        with patch.object(CephNodeManager, 'save_nodes', return_value=failure):
+            self.assertFalse(run_import('/config.json'))
+        self.assertInSysOut("Import interrupted, run 'ceph-salt import --resume' to retry.")
+        with open(journal_path) as journal_file:
+            journal = journal_file.read()
+        self.assertNotIn('SECRET', journal)
+        self.assertEqual(json.loads(journal)['done'], ['remove_grains'])
+        self.assertIsNone(PillarManager.get('ceph-salt:minions:all'))
+
+        self.assertTrue(run_import(None, resume=True))
+        self.assertInSysOut('Configuration imported.')
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertGrains('node1.ceph.com',
+                          'ceph-salt', {'member': True,
+                                        'roles': ['admin'],
+                                        'execution': {}})
+        self.assertEqual(PillarManager.get('ceph-salt:minions:all'), ['node1.ceph.com',
+                                                                      'node2.ceph.com'])
+
+        self.assertFalse(run_import(None, resume=True))
+        self.assertInSysOut('There is no interrupted import to resume.')
+
+        self.shell.run_cmdline('/ceph_cluster/roles/admin remove node1.ceph.com')
+        self.shell.run_cmdline('/ceph_cluster/minions remove node*')
+        PillarManager.reset('ceph-salt:ssh')
+        self.fs.remove('/config.json')
+
+    def test_import_resume_changed_file(self):
+        self.fs.create_file('/config.json', contents=json.dumps({
+            'minions': {'all': ['node1.ceph.com']}}))
+        with patch.object(CephNodeManager, 'save_nodes', return_value={
+                'node1.ceph.com': SaltCallException('node1.ceph.com', 'grains.setval',
+                                                    'minion did not respond')}):
+            self.assertFalse(run_import('/config.json'))
+        with open('/config.json', 'w') as config_file:
+            config_file.write(json.dumps({'minions': {'all': ['node2.ceph.com']}}))
+        self.assertFalse(run_import(None, resume=True))
+        self.assertInSysOut("Cannot resume import, '/config.json' changed since the import "
+                            "was interrupted.")
+        self.fs.remove('/config.json')
+        self.assertFalse(run_import(None, resume=True))
+        self.assertInSysOut("Cannot resume import, '/config.json' does not exist anymore.")
+        os.remove('{}/{}'.format(self.pillar_fs_path(), IMPORT_JOURNAL_FILE))
+
+    def test_import_minion_not_responding(self):
+        self.fs.create_file('/config.json', contents=json.dumps({
+            'minions': {
+                'all': ['node1.ceph.com', 'node2.ceph.com'],
+                'admin': ['node1.ceph.com']
+            }}))
+        orig_cmd = self.local_client.cmd
+
+        def _cmd(target, module, *args, **kwargs):
+            ret = orig_cmd(target, module, *args, **kwargs)
+            if module == 'grains.item' and isinstance(target, list):
+                ret.pop('node2.ceph.com', None)
+            return ret
+
+        with patch.object(self.local_client, 'cmd', side_effect=_cmd):
+            self.assertFalse(run_import('/config.json'))
+        self.assertInSysOut("Salt call target='node2.ceph.com' func='grains.item' failed: "
+                            "minion did not respond")
+        self.assertGrains('node1.ceph.com',
+                          'ceph-salt', {'member': True,
+                                        'roles': ['admin'],
+                                        'execution': {}})
+
+        self.assertTrue(run_import(None, resume=True))
+        self.assertGrains('node2.ceph.com',
+                          'ceph-salt', {'member': True,
+                                        'roles': [],
+                                        'execution': {}})
+        self.shell.run_cmdline('/ceph_cluster/roles/admin remove node1.ceph.com')
+        self.shell.run_cmdline('/ceph_cluster/minions remove node*')
+        self.fs.remove('/config.json')
+
     def test_import_invalid_host(self):
         self.fs.create_file('/config.json', contents=json.dumps({
             'minions': {
@@ -8,11 +8,13 @@ import mock
 import pytest
 
 from ceph_salt.execute import CephSaltController, TerminalRenderer, CephSaltModel, Event, \
-    CursesRenderer, CephSaltExecutor
-from ceph_salt.exceptions import MinionDoesNotExistInConfiguration
+    CursesRenderer, CephSaltExecutor, MinionExecution, PreflightChecks, \
+    process_failures, run_replay
+from ceph_salt.exceptions import MinionDoesNotExistInConfiguration, ValidationException
 from ceph_salt.salt_utils import GrainsManager
-from ceph_salt.salt_event import CephSaltEvent
+from ceph_salt.salt_event import CephSaltEvent, EventJournal, GrainSetEvent
 from ceph_salt.salt_utils import PillarManager
+from ceph_salt.terminal_utils import PrettyPrinter as PP
 
 from . import SaltMockTestCase, ServiceMock, SaltUtilMock, CephOrchMock
 
@@ -93,6 +95,30 @@ class ApplyTest(SaltMockTestCase):
         with pytest.raises(MinionDoesNotExistInConfiguration):
             CephSaltModel('node3.ceph.com', 'ceph-salt', {})
 
+    def test_controller_relays_grain_set(self):
+        model = CephSaltModel(None, 'ceph-salt', {})
+        controller = CephSaltController(model, TerminalRenderer(model))
+        controller.handle_grain_set(GrainSetEvent({
+            'tag': 'ceph-salt/grain/set',
+            'data': {
+                'id': 'node1.ceph.com',
+                'data': {
+                    'grain': 'ceph-salt:execution:rebooted',
+                    'value': True
+                },
+                '_stamp': '2020-01-17T15:19:49.719389'
+            }
+        }))
+        self.assertEqual(len(self.local_client.async_calls), 1)
+        target, module, args, tgt_type = self.local_client.async_calls[0]
+        self.assertEqual(sorted(target), ['node1.ceph.com', 'node2.ceph.com'])
+        self.assertEqual(module, 'event.fire')
+        self.assertEqual(args, [{'id': 'node1.ceph.com',
+                                 'grain': 'ceph-salt:execution:rebooted',
+                                 'value': True},
+                                'ceph-salt/grain/set'])
+        self.assertEqual(tgt_type, 'list')
+
     def test_controller_with_terminal_renderer(self):
         model = CephSaltModel(None, 'ceph-salt', {})
         renderer = TerminalRenderer(model)
@@ -318,6 +344,198 @@ class ApplyTest(SaltMockTestCase):
         self.assertEqual(step.failure['state'],
                          'file_|-/etc/chrony.conf_|-/etc/chrony.conf_|-managed')
 
+    def _curses_renderer(self, minions=None):
+        patcher = mock.patch('curses.color_pair', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        model = CephSaltModel(None, 'ceph-salt', {})
+        if minions is not None:
+            # pylint: disable=protected-access
+            model._minions = {name: MinionExecution(name) for name in minions}
+        renderer = CursesRenderer(model)
+        renderer.screen.width = 80
+        renderer.screen.height = 10
+        renderer.screen.body_width = 79
+        renderer.screen.body_height = 5
+        renderer.screen.margin = 10
+        renderer.screen.num_rows = 25
+        renderer.screen.body = mock.MagicMock()
+        return model, renderer
+
+    def test_curses_renderer_renders_changed_minions(self):
+        model, renderer = self._curses_renderer()
+        tstamp = datetime.datetime.strptime('2020-01-17T15:19:58.819390', "%Y-%m-%dT%H:%M:%S.%f")
+        model.get_minion('node1.ceph.com').end(tstamp, True)
+        model.get_minion('node2.ceph.com').end(tstamp, True)
+        with mock.patch.object(renderer, '_render_minion', wraps=renderer._render_minion) as rnd:
+            renderer._update_screen()
+            # measured and rendered
+            self.assertEqual(rnd.call_count, 4)
+            rnd.reset_mock()
+            renderer._update_screen()
+            rnd.assert_not_called()
+            renderer.minion_update('node2.ceph.com')
+            renderer._update_screen()
+            self.assertEqual([call[0][0].name for call in rnd.call_args_list],
+                             ['node2.ceph.com', 'node2.ceph.com'])
+        self.assertEqual(renderer.screen.body_rows, 3)
+
+    def test_curses_renderer_moves_rows(self):
+        model, renderer = self._curses_renderer()
+        tstamp = datetime.datetime.strptime('2020-01-17T15:19:58.819390', "%Y-%m-%dT%H:%M:%S.%f")
+        model.get_minion('node2.ceph.com').end(tstamp, True)
+        renderer._update_screen()
+        self.assertEqual(renderer.screen.body_rows, 3)
+        controller = CephSaltController(model, renderer)
+        with mock.patch.object(renderer, '_render_minion', wraps=renderer._render_minion) as rnd:
+            controller.handle_begin_stage(begin_stage('node1.ceph.com', 'Stage 1', 49))
+            renderer._update_screen()
+            # node1 grew from 1 to 2 rows, node2 moved one row down
+            self.assertEqual([(call[0][0].name, call[0][2]) for call in rnd.call_args_list],
+                             [('node1.ceph.com', 0), ('node1.ceph.com', 0),
+                              ('node2.ceph.com', 3)])
+        self.assertEqual(renderer.screen.body_rows, 4)
+
+    def test_curses_renderer_window(self):
+        minions = ['node{:03}.ceph.com'.format(i) for i in range(300)]
+        model, renderer = self._curses_renderer(minions)
+        tstamp = datetime.datetime.strptime('2020-01-17T15:19:58.819390', "%Y-%m-%dT%H:%M:%S.%f")
+        for minion in minions:
+            model.get_minion(minion).end(tstamp, True)
+        rendered = []
+
+        def _render_minion(minion, minion_id, row, selected, now):
+            if not renderer.screen.dry_run:
+                rendered.append(minion_id)
+            return 1
+        with mock.patch.object(renderer, '_render_minion', side_effect=_render_minion):
+            renderer._update_screen()
+            self.assertEqual(renderer.screen.body_rows, 599)
+            # 25 rows window, 2 rows per minion
+            self.assertEqual(rendered, list(range(13)))
+            del rendered[:]
+            renderer.screen.body_pos = 400
+            renderer._update_screen()
+            self.assertEqual(renderer.screen.pad_top, 390)
+            self.assertEqual(rendered, list(range(195, 208)))
+
+    def test_preflight_checks_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def _check(msg, retcode):
+            def _func():
+                barrier.wait()
+                PP.println(msg)
+                return retcode
+            return _func
+
+        checks = PreflightChecks()
+        checks.add('first', _check('first check', 0))
+        checks.add('second', _check('second check', 0))
+        self.clearSysOut()
+        self.assertEqual(checks.run(), 0)
+        out, _ = self.capsys.readouterr()
+        self.assertEqual(out, 'first check\nsecond check\n')
+
+    def test_preflight_checks_first_failure(self):
+        calls = []
+
+        def _check(name, retcode):
+            def _func():
+                calls.append(name)
+                PP.println(name)
+                return retcode
+            return _func
+
+        checks = PreflightChecks()
+        checks.add('a', _check('a', 0))
+        checks.add('b', _check('b', 2), ['a'])
+        checks.add('c', _check('c', 3), ['b'])
+        checks.add('d', _check('d', 4), ['a'])
+        self.clearSysOut()
+        self.assertEqual(checks.run(), 2)
+        out, _ = self.capsys.readouterr()
+        self.assertEqual(out, 'a\nb\n')
+        self.assertEqual(sorted(calls), ['a', 'b', 'd'])
+
+    def test_preflight_checks_exception(self):
+        def _fail():
+            PP.println('failing')
+            raise ValidationException('error')
+
+        checks = PreflightChecks()
+        checks.add('ok', lambda: 0)
+        checks.add('fail', _fail)
+        self.clearSysOut()
+        with self.assertRaises(ValidationException):
+            checks.run()
+        self.assertInSysOut('failing')
+
+    def test_process_failures(self):
+        class _Controller:
+            def __init__(self):
+                self.failures = []
+
+            def minion_failure(self, minion, event, data):
+                self.failures.append((minion, str(event), data['__id__']))
+
+        def _state(run_num, result=True):
+            return {'__run_num__': run_num, '__id__': 'id{}'.format(run_num), 'result': result}
+
+        states = {
+            'cmd_|-id0_|-id0_|-run': _state(0, False),
+            'ceph_salt_|-begin_stage_Stage 1_|-Stage 1_|-begin_stage': _state(1),
+            'ceph_salt_|-begin_step_Step 1_|-Step 1_|-begin_step': _state(2),
+            'file_|-id3_|-id3_|-managed': _state(3, False),
+            'ceph_salt_|-end_step_Step 1_|-Step 1_|-end_step': _state(4),
+            'ceph_salt_|-begin_stage_Stage 2_|-Stage 2_|-begin_stage': _state(5),
+            'cmd_|-id6_|-id6_|-run': _state(6, False),
+        }
+        controller = _Controller()
+        process_failures(controller, 'node1.ceph.com', states)
+        self.assertEqual(controller.failures, [
+            ('node1.ceph.com', 'EV(begin_stage, Stage 2)', 'id6'),
+            ('node1.ceph.com', 'EV(begin_step, Step 1, EV(begin_stage, Stage 1))', 'id3'),
+            ('node1.ceph.com', 'None', 'id0'),
+        ])
+
+    def test_replay(self):
+        def _ceph_salt_event(tag, minion, desc, stamp):
+            return {'tag': tag, 'data': {'id': minion, 'data': {'desc': desc}, '_stamp': stamp}}
+
+        def _state_apply_ret(minion, retcode, states, stamp):
+            return {'tag': 'salt/job/20200117151959615228/ret/{}'.format(minion),
+                    'data': {'id': minion, 'fun': 'state.apply', 'success': True,
+                             'retcode': retcode, 'return': states, '_stamp': stamp}}
+
+        journal = EventJournal('/tmp/journal', minion_id=None, state='ceph-salt',
+                               minions=['node1.ceph.com', 'node2.ceph.com'])
+        journal.open()
+        for event in [
+                _ceph_salt_event('ceph-salt/stage/begin', 'node1.ceph.com', 'Stage 1',
+                                 '2020-01-17T15:19:54.719389'),
+                _ceph_salt_event('ceph-salt/stage/begin', 'node2.ceph.com', 'Stage 1',
+                                 '2020-01-17T15:19:54.819389'),
+                _ceph_salt_event('ceph-salt/stage/end', 'node1.ceph.com', 'Stage 1',
+                                 '2020-01-17T15:19:55.719389'),
+                _ceph_salt_event('ceph-salt/stage/begin', 'node3.ceph.com', 'Stage 1',
+                                 '2020-01-17T15:19:55.819389'),
+                _state_apply_ret('node1.ceph.com', 0, {}, '2020-01-17T15:19:56.719389'),
+                _state_apply_ret('node2.ceph.com', 2, {
+                    'cmd_|-id1_|-id1_|-run': {'__run_num__': 1, '__id__': 'id1',
+                                              'result': False},
+                }, '2020-01-17T15:19:57.719389')]:
+            journal.write(event)
+        journal.close()
+
+        self.clearSysOut()
+        self.assertEqual(run_replay('/tmp/journal', False, 0), 2)
+        out, _ = self.capsys.readouterr()
+        self.assertIn('[STAGE] [END  ] Stage 1', out)
+        self.assertIn('Failure in minion: node2.ceph.com', out)
+        self.assertIn('Summary: Total=2 Succeeded=1 Warnings=0 Failed=1', out)
+        self.assertEqual(self.local_client.async_calls, [])
+
     def _prompt_proceed(self, msg, default):
         pass
 
@@ -334,6 +552,50 @@ class ApplyTest(SaltMockTestCase):
     def test_check_formula_exists2(self):
         self.assertEqual(CephSaltExecutor.check_formula('ceph-salt', self._prompt_proceed), 7)
 
+    def test_check_formula_probe(self):
+        probe = {'node1.ceph.com': {'sls_exists': True}}
+        self.assertEqual(CephSaltExecutor.check_formula('ceph-salt', self._prompt_proceed,
+                                                        probe), 0)
+
+    def test_checks_probe(self):
+        probe = {
+            'node1.ceph.com': {'dns': True, 'time_sync': True, 'fqdn': 'YES'},
+            'node2.ceph.com': {'dns': False, 'time_sync': False, 'fqdn': 'NO'},
+        }
+        self.assertEqual(CephSaltExecutor.ping_minions(probe), 0)
+        self.assertEqual(CephSaltExecutor.check_dns(probe), 8)
+        self.assertInSysOut('DNS issues detected on host(s) node2.ceph.com')
+        self.assertEqual(CephSaltExecutor.check_time_sync(probe), 14)
+        self.assertEqual(CephSaltExecutor.check_fqdn(probe), 15)
+        probe['node2.ceph.com'] = {'dns': True, 'time_sync': True, 'fqdn': 'YES'}
+        self.assertEqual(CephSaltExecutor.check_dns(probe), 0)
+        self.assertEqual(CephSaltExecutor.check_time_sync(probe), 0)
+        self.assertEqual(CephSaltExecutor.check_fqdn(probe), 0)
+
+    def test_check_time_sync_units(self):
+        probe = {
+            'node1.ceph.com': {'time_sync': {'ok': True, 'unit': 'chronyd.service',
+                                             'units': {}}},
+            'node2.ceph.com': {'time_sync': {'ok': False, 'unit': None, 'units': {}}},
+        }
+        self.assertEqual(CephSaltExecutor.check_time_sync(probe), 14)
+        self.assertInSysOut('Time sync issues detected on host(s) node2.ceph.com')
+        probe['node2.ceph.com']['time_sync']['ok'] = True
+        self.assertEqual(CephSaltExecutor.check_time_sync(probe), 0)
+
+    def test_check_dns_unresolvable(self):
+        probe = {
+            'node1.ceph.com': {'dns': {'ok': True, 'unresolvable': [], 'latencies': {}}},
+            'node2.ceph.com': {'dns': {'ok': False,
+                                       'unresolvable': ['node1.ceph.com', 'node3.ceph.com'],
+                                       'latencies': {}}},
+        }
+        self.clearSysOut()
+        self.assertEqual(CephSaltExecutor.check_dns(probe), 8)
+        out, _ = self.capsys.readouterr()
+        self.assertIn('DNS issues detected on host(s) node2.ceph.com', out)
+        self.assertIn('node2.ceph.com cannot resolve: node1.ceph.com, node3.ceph.com', out)
+
     def test_check_sync_all(self):
         SaltUtilMock.sync_all_result = False
         self.fs.create_file(os.path.join(self.states_fs_path(), 'ceph-salt.sls'))
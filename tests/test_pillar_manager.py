@@ -1,4 +1,7 @@
 import os
+
+from mock import patch
+
 from ceph_salt.salt_utils import PillarManager
 from . import SaltMockTestCase
 
@@ -27,6 +30,129 @@ class PillarManagerTest(SaltMockTestCase):
         val = PillarManager.get('ceph-salt:test')
         self.assertIsNone(val)
 
+    def test_pillar_get_nested_path(self):
+        PillarManager.set('ceph-salt:test:a:b', 'value')
+        self.assertEqual(PillarManager.get('ceph-salt:test:a:b'), 'value')
+        self.assertIsNone(PillarManager.get('ceph-salt:test:a:b:c'))
+        self.assertIsNone(PillarManager.get('ceph-salt:missing:a'))
+        self.assertEqual(PillarManager.get('ceph-salt:missing:a', []), [])
+
+    def test_pillar_log_hides_secrets(self):
+        value = {'username': 'admin', 'password': 'secret'}
+        with self.assertLogs(PillarManager.logger, 'INFO') as logs:
+            PillarManager.set('ceph-salt:dashboard', value)
+            PillarManager.get('ceph-salt:dashboard')
+        self.assertNotIn('secret', '\n'.join(logs.output))
+        self.assertIn("'password': '?'", logs.output[-1])
+        self.assertEqual(value['password'], 'secret')
+
+    def test_pillar_get_not_redacted_when_not_logged(self):
+        PillarManager.set('ceph-salt:dashboard', {'password': 'secret'})
+        level = PillarManager.logger.level
+        PillarManager.logger.setLevel('WARNING')
+        try:
+            with patch('ceph_salt.salt_utils._RedactedValue._redact') as redact:
+                self.assertEqual(PillarManager.get('ceph-salt:dashboard'),
+                                 {'password': 'secret'})
+            redact.assert_not_called()
+        finally:
+            PillarManager.logger.setLevel(level)
+
+    def test_pillar_reload_unchanged_file_not_parsed(self):
+        PillarManager.set('ceph-salt:test', {'a': 1})
+        with patch('ceph_salt.salt_utils._yaml_load') as yaml_load:
+            PillarManager.reload()
+            # in-memory changes that were not saved are dropped by reload()
+            PillarManager.get('ceph-salt:test')['a'] = 2
+            PillarManager.reload()
+            yaml_load.assert_not_called()
+        self.assertEqual(PillarManager.get('ceph-salt:test'), {'a': 1})
+
+    def test_pillar_reload_changed_file(self):
+        PillarManager.set('ceph-salt:test', 'some text')
+        PillarManager.reload()
+        file_path = os.path.join(self.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        self.fs.remove_object(file_path)
+        self.fs.create_file(file_path, contents='ceph-salt:\n  test: other text\n')
+        PillarManager.reload()
+        self.assertEqual(PillarManager.get('ceph-salt:test'), 'other text')
+
+    def test_pillar_load_python_tags(self):
+        file_path = os.path.join(self.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        self.fs.remove_object(file_path)
+        self.fs.create_file(file_path, contents='ceph-salt:\n  test: !!python/tuple [1, 2]\n')
+        PillarManager.reload()
+        self.assertEqual(PillarManager.get('ceph-salt:test'), (1, 2))
+
+    def test_pillar_transaction(self):
+        file_path = os.path.join(self.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        with patch.object(PillarManager, '_save_yaml', wraps=PillarManager._save_yaml) as save, \
+                patch.object(self.local_client, 'cmd_async',
+                             wraps=self.local_client.cmd_async) as cmd_async:
+            with PillarManager.transaction():
+                PillarManager.set('ceph-salt:minions:all', ['node1.ceph.com'])
+                PillarManager.set('ceph-salt:test:a', 1)
+                with PillarManager.transaction():
+                    PillarManager.set('ceph-salt:test:b', 2)
+                PillarManager.set('ceph-salt:test:c', 3)
+                PillarManager.reset('ceph-salt:test:a')
+                self.assertEqual(PillarManager.get('ceph-salt:test:c'), 3)
+                save.assert_not_called()
+                cmd_async.assert_not_called()
+            self.assertEqual(save.call_count, 1)
+            cmd_async.assert_called_once_with(['node1.ceph.com'], 'saltutil.pillar_refresh',
+                                              tgt_type='list')
+        self.assertYamlEqual(file_path, {'ceph-salt': {'minions': {'all': ['node1.ceph.com']},
+                                                       'test': {'b': 2, 'c': 3}}})
+
+    def test_pillar_refresh_targets(self):
+        with patch.object(self.local_client, 'cmd_async',
+                          wraps=self.local_client.cmd_async) as cmd_async:
+            PillarManager.set('ceph-salt:test', 'no minions')
+            cmd_async.assert_not_called()
+            PillarManager.set('ceph-salt:minions:all', ['node1.ceph.com', 'node2.ceph.com'])
+            PillarManager.set('ceph-salt:minions:all', ['node2.ceph.com'])
+            PillarManager.set('ceph-salt:test', 'one minion')
+        self.assertEqual([c[0][0] for c in cmd_async.call_args_list], [
+            ['node1.ceph.com', 'node2.ceph.com'],
+            # the removed minion drops the ceph-salt pillar
+            ['node1.ceph.com', 'node2.ceph.com'],
+            ['node2.ceph.com'],
+        ])
+
+    def test_pillar_wait_for_refresh(self):
+        self.salt_env.minions = ['node1.ceph.com']
+        PillarManager.set('ceph-salt:minions:all', ['node1.ceph.com', 'node2.ceph.com'])
+        PillarManager.set('ceph-salt:test', 'some text')
+        with patch.object(self.local_client, 'get_returns',
+                          wraps=self.local_client.get_returns) as get_returns:
+            self.assertEqual(PillarManager.wait_for_refresh(), ['node2.ceph.com'])
+            # only the last refresh of each minion is waited for
+            get_returns.assert_called_once_with('20200117161959615228',
+                                                ['node1.ceph.com', 'node2.ceph.com'], 30)
+            self.assertEqual(PillarManager.wait_for_refresh(), [])
+            self.assertEqual(get_returns.call_count, 1)
+
+    def test_pillar_transaction_no_changes(self):
+        with patch.object(PillarManager, '_save_yaml') as save:
+            with PillarManager.transaction():
+                PillarManager.reset('ceph-salt:not:set')
+            save.assert_not_called()
+
+    def test_pillar_transaction_error(self):
+        file_path = os.path.join(self.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        with self.assertRaises(RuntimeError):
+            with PillarManager.transaction():
+                PillarManager.set('ceph-salt:test', 'some text')
+                raise RuntimeError()
+        self.assertYamlEqual(file_path, {'ceph-salt': {'test': 'some text'}})
+
+    def test_pillar_save_atomic(self):
+        PillarManager.set('ceph-salt:test', 'some text')
+        self.assertEqual(os.listdir(self.pillar_fs_path()), [PillarManager.PILLAR_FILE])
+        file_path = os.path.join(self.pillar_fs_path(), PillarManager.PILLAR_FILE)
+        self.assertEqual(os.stat(file_path).st_mode & 0o777, 0o600)
+
     def test_pillar_installed_no_top(self):
         self.fs.remove_object('/srv/pillar/ceph-salt.sls')
         self.assertFalse(PillarManager.pillar_installed())
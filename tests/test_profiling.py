@@ -0,0 +1,70 @@
+from ceph_salt.profiling import SaltProfiler
+from ceph_salt.salt_utils import GrainsManager, PillarManager, SaltClient
+
+from . import SaltMockTestCase
+
+
+class SaltProfilerTest(SaltMockTestCase):
+
+    def setUp(self):
+        super(SaltProfilerTest, self).setUp()
+        self.salt_env.minions = ['node1.ceph.com', 'node2.ceph.com']
+        SaltProfiler.enable()
+        self.addCleanup(SaltProfiler.disable)
+
+    def tearDown(self):
+        super(SaltProfilerTest, self).tearDown()
+        PillarManager.reload()
+
+    def test_disable_restores(self):
+        SaltProfiler.disable()
+        self.assertFalse(SaltProfiler.enabled())
+        self.assertIs(SaltClient.local(), self.local_client)
+        SaltProfiler.reset()
+        GrainsManager.get_grain('node1.ceph.com', 'host')
+        self.assertEqual(SaltProfiler.spans(), [])
+
+    def test_salt_spans(self):
+        SaltClient.local_cmd('node1.ceph.com', 'test.ping')
+        SaltClient.local().cmd(['node1.ceph.com', 'node2.ceph.com'], 'test.true',
+                               tgt_type='list')
+        SaltClient.caller_cmd('service.restart', ['salt-master'])
+        spans = SaltProfiler.spans('salt')
+        self.assertEqual([(s.name, s.target, s.tgt_type) for s in spans], [
+            ('test.ping', 'node1.ceph.com', 'glob'),
+            ('test.true', ['node1.ceph.com', 'node2.ceph.com'], 'list'),
+            ('service.restart', 'master', 'caller'),
+        ])
+
+    def test_grains_and_yaml_spans(self):
+        GrainsManager.set_grain('node1.ceph.com', 'ceph-salt', {'member': True})
+        GrainsManager.filter_by('ceph-salt')
+        PillarManager.set('ceph-salt:minions:all', ['node1.ceph.com'])
+        PillarManager.reload()
+        self.assertEqual([s.name for s in SaltProfiler.spans('grains')],
+                         ['GrainsManager.set_grain', 'GrainsManager.filter_by'])
+        self.assertEqual(sorted(s.name for s in SaltProfiler.spans('yaml')),
+                         ['parse', 'parse', 'serialize'])
+
+    def test_bulk_grains_spans(self):
+        minions = ['node1.ceph.com', 'node2.ceph.com']
+        GrainsManager.bulk_set_grain(minions, 'ceph-salt', {'member': True})
+        GrainsManager.bulk_del_grain(minions, 'ceph-salt')
+        spans = SaltProfiler.spans('grains')
+        self.assertEqual([(s.name, s.target) for s in spans], [
+            ('GrainsManager.bulk_set_grain', minions),
+            ('GrainsManager.bulk_del_grain', minions),
+        ])
+        self.assertRegex(SaltProfiler.report(),
+                         r' +1 +[0-9.]+ +[0-9.]+  GrainsManager.bulk_set_grain\n')
+
+    def test_report(self):
+        SaltClient.local_cmd('node1.ceph.com', 'test.ping')
+        SaltClient.local_cmd('node1.ceph.com', 'test.ping')
+        GrainsManager.get_grain('node2.ceph.com', 'host')
+        report = SaltProfiler.report()
+        self.assertIn('3 Salt calls', report)
+        self.assertRegex(report, r' +2 +[0-9.]+ +[0-9.]+  test.ping\n')
+        self.assertRegex(report, r' +2 +[0-9.]+ +[0-9.]+  node1.ceph.com\n')
+        self.assertRegex(report, r' +1 +[0-9.]+ +[0-9.]+  node2.ceph.com\n')
+        self.assertRegex(report, r' +1 +[0-9.]+ +[0-9.]+  GrainsManager.get_grain')
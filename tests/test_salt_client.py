@@ -0,0 +1,66 @@
+import threading
+
+from ceph_salt.salt_utils import SaltClient
+from . import SaltMockTestCase
+
+
+class SaltClientTest(SaltMockTestCase):
+
+    def test_opts_parsed_once(self):
+        stats = SaltClient.pool_stats()
+        SaltClient.pillar_fs_path()
+        SaltClient.pki_minions_fs_path()
+        SaltClient.pillar_fs_path()
+        self.assertEqual(SaltClient.pool_stats()['opts_loaded'], stats['opts_loaded'] + 1)
+
+    def test_opts_not_shared(self):
+        self.assertEqual(SaltClient._opts(True)['file_client'], 'local')
+        self.assertNotIn('file_client', SaltClient._opts(False))
+
+    def test_local_client_reused(self):
+        stats = SaltClient.pool_stats()
+        for _ in range(5):
+            SaltClient.local_cmd('node1', 'test.ping')
+        new_stats = SaltClient.pool_stats()
+        self.assertEqual(new_stats['clients_built'], stats['clients_built'] + 1)
+        self.assertEqual(new_stats['clients_reused'], stats['clients_reused'] + 4)
+
+    def test_caller_client_reused(self):
+        stats = SaltClient.pool_stats()
+        SaltClient.caller_cmd('service.restart', ['salt-master'])
+        SaltClient.caller_cmd('service.restart', ['salt-master'])
+        new_stats = SaltClient.pool_stats()
+        self.assertEqual(new_stats['clients_built'], stats['clients_built'] + 1)
+        self.assertEqual(new_stats['clients_reused'], stats['clients_reused'] + 1)
+
+    def test_local_client_per_thread(self):
+        SaltClient.local()
+        stats = SaltClient.pool_stats()
+        thread = threading.Thread(target=SaltClient.local)
+        thread.start()
+        thread.join()
+        SaltClient.local()
+        new_stats = SaltClient.pool_stats()
+        self.assertEqual(new_stats['clients_built'], stats['clients_built'] + 1)
+        self.assertEqual(new_stats['clients_reused'], stats['clients_reused'] + 1)
+
+    def test_master_per_thread(self):
+        masters = []
+        thread = threading.Thread(target=lambda: masters.append(SaltClient.master()))
+        thread.start()
+        thread.join()
+        stats = SaltClient.pool_stats()
+        self.assertIs(SaltClient.master(), SaltClient.master())
+        new_stats = SaltClient.pool_stats()
+        self.assertEqual(new_stats['clients_built'], stats['clients_built'] + 1)
+        self.assertEqual(new_stats['clients_reused'], stats['clients_reused'] + 1)
+        self.assertEqual(len(masters), 1)
+
+    def test_invalidate(self):
+        SaltClient.local()
+        stats = SaltClient.pool_stats()
+        SaltClient.invalidate()
+        SaltClient.local()
+        new_stats = SaltClient.pool_stats()
+        self.assertEqual(new_stats['opts_loaded'], stats['opts_loaded'] + 1)
+        self.assertEqual(new_stats['clients_built'], stats['clients_built'] + 1)
@@ -1,12 +1,14 @@
 import datetime
 import logging
+import os
+import tempfile
 import unittest
 from typing import List
 
 import mock
 
 from ceph_salt.salt_event import SaltEventProcessor, EventListener, CephSaltEvent, \
-    SaltEvent, JobRetEvent
+    SaltEvent, JobRetEvent, GrainSetEvent, EventJournal
 
 
 # pylint: disable=unused-argument
@@ -18,6 +20,7 @@ logger = logging.getLogger(__name__)
 class SaltEventStream:
     _events = []
     _handler = None
+    _received = None
 
     @classmethod
     def push_event(cls, tag, data):
@@ -28,7 +31,9 @@ class SaltEventStream:
     def flush_events(cls):
         if cls._handler:
             while cls._events:
-                cls._handler(None)  # pylint: disable=not-callable
+                cls._received = cls._events.pop(0)
+                tag = cls._received[0]
+                cls._handler(tag.encode() + b'\n\n')  # pylint: disable=not-callable
 
     @classmethod
     def set_event_handler(cls, handler):
@@ -37,9 +42,8 @@ class SaltEventStream:
 
     @classmethod
     def unpack(cls, *args, **kwargs):
-        logger.info("Unpack event: %s", cls._events)
-        tag, data = cls._events.pop(0)
-        return tag, data
+        logger.info("Unpack event: %s", cls._received)
+        return cls._received
 
 
 class TestEventListener(EventListener):
@@ -52,6 +56,7 @@ class TestEventListener(EventListener):
     minion_reboot_events = []
     minion_start_events = []
     state_apply_return_events = []
+    grain_set_events = []
 
     def handle_ceph_salt_event(self, event: CephSaltEvent):
         logger.info("received ceph-salt event: %s", event)
@@ -81,6 +86,9 @@ class TestEventListener(EventListener):
     def handle_state_apply_return(self, event: JobRetEvent):
         self.state_apply_return_events.append(event)
 
+    def handle_grain_set(self, event: GrainSetEvent):
+        self.grain_set_events.append(event)
+
 
 class TestSaltEvent(unittest.TestCase):
 
@@ -106,6 +114,11 @@ class TestSaltEvent(unittest.TestCase):
             self.processor.stop()
         self.processor = None
 
+    def _flush_events(self):
+        SaltEventStream.flush_events()
+        # wait for the dispatcher thread
+        self.processor.queue.join()
+
     def test_listener(self):
         listener = TestEventListener()
         self.processor.add_listener(listener)
@@ -172,7 +185,7 @@ class TestSaltEvent(unittest.TestCase):
             'tag': 'ceph-salt/minion_reboot',
             '_stamp': '2020-01-17T15:20:54.719389'
         })
-        SaltEventStream.flush_events()
+        self._flush_events()
 
         tstamp1 = datetime.datetime.strptime('2020-01-17T15:19:54.719389', "%Y-%m-%dT%H:%M:%S.%f")
         tstamp2 = datetime.datetime.strptime('2020-01-17T15:19:55.719389', "%Y-%m-%dT%H:%M:%S.%f")
@@ -244,7 +257,7 @@ class TestSaltEvent(unittest.TestCase):
             'tag': 'minion_start',
             '_stamp': '2020-01-17T15:20:54.719389'
         })
-        SaltEventStream.flush_events()
+        self._flush_events()
 
         self.assertEqual(len(listener.minion_start_events), 2)
 
@@ -259,6 +272,94 @@ class TestSaltEvent(unittest.TestCase):
             'fun': 'state.apply',
             'success': True
         })
-        SaltEventStream.flush_events()
+        self._flush_events()
 
         self.assertEqual(len(listener.state_apply_return_events), 1)
+
+    def test_grain_set(self):
+        listener = TestEventListener()
+        self.processor.add_listener(listener)
+        num_ceph_salt_events = len(listener.ceph_salt_events)
+
+        SaltEventStream.push_event('ceph-salt/grain/set', {
+            'id': 'node1.test.com',
+            'cmd': '_minion_event',
+            'pretag': None,
+            'data': {
+                'grain': 'ceph-salt:execution:rebooted',
+                'value': True
+            },
+            'tag': 'ceph-salt/grain/set',
+            '_stamp': '2020-01-17T15:20:54.719389'
+        })
+        self._flush_events()
+
+        self.assertEqual(len(listener.grain_set_events), 1)
+        self.assertEqual(len(listener.ceph_salt_events), num_ceph_salt_events)
+        self.assertEqual(listener.grain_set_events[0].minion, 'node1.test.com')
+        self.assertEqual(listener.grain_set_events[0].grain, 'ceph-salt:execution:rebooted')
+        self.assertTrue(listener.grain_set_events[0].value)
+
+    def test_event_stats(self):
+        SaltEventStream.push_event('salt/job/20200215120107564789/ret/node1.test.com', {
+            'id': 'node1.test.com',
+            'tag': 'salt/job/20200215120107564789/ret/node1.test.com',
+            '_stamp': '2020-01-17T15:20:54.719389',
+            'fun': 'state.apply',
+            'success': True
+        })
+        SaltEventStream.push_event('salt/job/20200215120107564789/ret/node1.test.com', {
+            'id': 'node1.test.com',
+            'tag': 'salt/job/20200215120107564789/ret/node1.test.com',
+            '_stamp': '2020-01-17T15:20:54.719389',
+            'fun': 'pkg.upgrade',
+            'success': True
+        })
+        SaltEventStream.push_event('minion_start', {
+            'id': 'node3.test.com',
+            'tag': 'minion_start',
+            '_stamp': '2020-01-17T15:20:54.719389'
+        })
+        SaltEventStream.push_event('20200117161959615228', {
+            'minions': ['node1.test.com'],
+            '_stamp': '2020-01-17T15:19:59.615651'
+        })
+        self._flush_events()
+
+        self.assertEqual(self.processor.stats['filtered'], 1)
+        self.assertEqual(self.processor.stats['seen'], 3)
+        self.assertEqual(self.processor.stats['dispatched'], 1)
+        self.assertEqual(self.processor.stats['dropped'], 2)
+        self.assertEqual(self.processor.queue_depth(), 0)
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'journal')
+            journal = EventJournal(path, minions=['node1.test.com', 'node2.test.com'])
+            journal.open()
+            self.processor.journal = journal
+
+            SaltEventStream.push_event('ceph-salt/stage/begin', {
+                'id': 'node1.test.com',
+                'data': {
+                    'desc': 'Doing stuff 1'
+                },
+                '_stamp': '2020-01-17T15:19:54.719389'
+            })
+            SaltEventStream.push_event('minion_start', {
+                'id': 'node3.test.com',
+                'tag': 'minion_start',
+                '_stamp': '2020-01-17T15:20:54.719389'
+            })
+            self._flush_events()
+            journal.close()
+            with open(path, 'a') as journal_file:
+                journal_file.write('{"time": 16')
+
+            metadata, events = EventJournal.load(path)
+
+        self.assertEqual(metadata, {'minions': ['node1.test.com', 'node2.test.com']})
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['tag'], 'ceph-salt/stage/begin')
+        self.assertEqual(events[0]['data']['data']['desc'], 'Doing stuff 1')
+        self.assertIsInstance(events[0]['time'], float)
@@ -0,0 +1,56 @@
+import json
+
+from ceph_salt.config_shell import run_config_cmdline, run_import, run_status
+from ceph_salt.execute import CephSaltExecutor
+from ceph_salt.salt_utils import PillarManager
+
+from . import SaltMockTestCase
+from .simulator import ClusterSimulator
+
+
+class ClusterSimulatorTest(SaltMockTestCase):
+    def tearDown(self):
+        super(ClusterSimulatorTest, self).tearDown()
+        PillarManager.reload()
+
+    def _prompt_proceed(self, msg, default):
+        pass
+
+    def test_apply(self):
+        simulator = ClusterSimulator(self, 20, failure_rate=0.1)
+        simulator.start()
+        simulator.configure()
+        self.clearSysOut()
+
+        executor = CephSaltExecutor(False, None, 'ceph-salt', {}, self._prompt_proceed)
+        self.assertEqual(executor.run(), 2)
+        self.assertInSysOut('Summary: Total=20 Succeeded=18 Warnings=0 Failed=2')
+        self.assertEqual(simulator.calls['state.apply'], 2)
+        self.assertEqual(simulator.calls['ceph_salt.preflight'], 1)
+        self.assertEqual(len(simulator.failing), 2)
+        for minion in simulator.failing:
+            self.assertFalse(executor.model.get_minion(minion).success)
+
+    def test_status(self):
+        simulator = ClusterSimulator(self, 20)
+        simulator.start()
+        simulator.configure()
+        self.clearSysOut()
+
+        self.assertTrue(run_status())
+        self.assertInSysOut('20 minions')
+
+    def test_config_and_import(self):
+        simulator = ClusterSimulator(self, 20)
+        simulator.start()
+
+        run_config_cmdline('/ceph_cluster/minions add node1.ceph.test')
+        run_config_cmdline('/ceph_cluster/roles/admin add node1.ceph.test')
+        self.assertEqual(PillarManager.get('ceph-salt:minions:admin'), ['node1.ceph.test'])
+
+        self.fs.create_file('/config.json', contents=json.dumps({
+            'minions': {'all': simulator.minions, 'admin': simulator.minions[:1],
+                        'cephadm': simulator.minions}
+        }))
+        self.assertTrue(run_import('/config.json'))
+        self.assertEqual(PillarManager.get('ceph-salt:minions:all'), simulator.minions)